@@ -460,6 +460,8 @@ class Application (object):
             'input.global_pressure_mapping': [(0.0, 1.0), (1.0, 0.0)],
             'view.default_zoom': 1.0,
             'view.real_alpha_checks': True,
+            'view.mipmap_mode': 'auto',
+            'view.mipmap_quality': 0.75,
             'ui.hide_menubar_in_fullscreen': True,
             'ui.hide_toolbar_in_fullscreen': True,
             'ui.hide_subwindows_in_fullscreen': True,
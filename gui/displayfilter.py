@@ -42,45 +42,84 @@ _SIM_TRITANOPIA_G_COEFFS = (0.022, 0.818, 0.160)
 _SIM_TRITANOPIA_B_COEFFS = (-0.063, 0.881, 0.182)
 
 
+# Fixed-point precision of the matrix filters' lookup tables
+
+_FIXED_SHIFT = 8
+
+
+## Filter classes
+
+
+class MatrixFilter (object):
+    """Display filter transforming RGB by a 3x3 matrix, in fixed point
+
+    Filters operate in place on NxNx4 8-bit RGBA tile arrays. Instead of
+    float maths with temporaries over the whole tile, each output
+    channel is a sum of three lookups into precomputed integer tables,
+    one per input channel, which is then rounded and clamped.
+
+    """
+
+    def __init__(self, r_coeffs, g_coeffs, b_coeffs):
+        """Initialize from the rows of the matrix
+
+        :param tuple r_coeffs: weights of R, G, B in the output's R
+        :param tuple g_coeffs: weights of R, G, B in the output's G
+        :param tuple b_coeffs: weights of R, G, B in the output's B
+
+        """
+        super(MatrixFilter, self).__init__()
+        matrix = numpy.array([r_coeffs, g_coeffs, b_coeffs], 'float64')
+        values = numpy.arange(256, dtype='float64')
+        luts = matrix[:, :, numpy.newaxis] * values * (1 << _FIXED_SHIFT)
+        self._luts = numpy.round(luts).astype('int32')
+
+    def __call__(self, dst):
+        """Filters an 8-bit RGBA array in place"""
+        channels = [dst[..., i] for i in xrange(3)]
+        outputs = []
+        for luts in self._luts:
+            acc = luts[0].take(channels[0])
+            acc += luts[1].take(channels[1])
+            acc += luts[2].take(channels[2])
+            outputs.append(acc)
+        for i, acc in enumerate(outputs):
+            acc += 1 << (_FIXED_SHIFT - 1)
+            acc >>= _FIXED_SHIFT
+            numpy.clip(acc, 0, 255, acc)
+            dst[..., i] = acc
+
+
 ## Filter functions
 
 
-def luma_only(dst):
-    """Convert an NxNx3 array to show only luma (brightness)"""
-    luma = (dst[...,0:3] * _LUMA_COEFFS).sum(axis=2)
-    dst[...,0:3] = luma[...,numpy.newaxis]
+#: Convert an RGBA array to show only luma (brightness)
+luma_only = MatrixFilter(_LUMA_COEFFS, _LUMA_COEFFS, _LUMA_COEFFS)
 
 
 def invert_colors(dst):
-    """Invert each RGB channel in an RGB array"""
-    dst[...,0:3] = 255 - dst[...,0:3]
-
-
-def sim_deuteranopia(dst):
-    """Simulate deuteranopia (insensitivity to red)"""
-    r = (dst[...,0:3] * _SIM_DEUTERANOPIA_R_COEFFS).sum(axis=2)
-    g = (dst[...,0:3] * _SIM_DEUTERANOPIA_G_COEFFS).sum(axis=2)
-    b = (dst[...,0:3] * _SIM_DEUTERANOPIA_B_COEFFS).sum(axis=2)
-    numpy.clip(r, 0, 255, dst[...,0])
-    numpy.clip(g, 0, 255, dst[...,1])
-    numpy.clip(b, 0, 255, dst[...,2])
-
-
-def sim_protanopia(dst):
-    """Simulate protanopia (insensitivity to green)"""
-    r = (dst[...,0:3] * _SIM_PROTANOPIA_R_COEFFS).sum(axis=2)
-    g = (dst[...,0:3] * _SIM_PROTANOPIA_G_COEFFS).sum(axis=2)
-    b = (dst[...,0:3] * _SIM_PROTANOPIA_B_COEFFS).sum(axis=2)
-    numpy.clip(r, 0, 255, dst[...,0])
-    numpy.clip(g, 0, 255, dst[...,1])
-    numpy.clip(b, 0, 255, dst[...,2])
-
-
-def sim_tritanopia(dst):
-    """Simulate tritanopia (insensitivity to green)"""
-    r = (dst[...,0:3] * _SIM_TRITANOPIA_R_COEFFS).sum(axis=2)
-    g = (dst[...,0:3] * _SIM_TRITANOPIA_G_COEFFS).sum(axis=2)
-    b = (dst[...,0:3] * _SIM_TRITANOPIA_B_COEFFS).sum(axis=2)
-    numpy.clip(r, 0, 255, dst[...,0])
-    numpy.clip(g, 0, 255, dst[...,1])
-    numpy.clip(b, 0, 255, dst[...,2])
+    """Invert each RGB channel in an 8-bit RGBA array"""
+    rgb = dst[..., 0:3]
+    numpy.subtract(255, rgb, out=rgb)
+
+
+#: Simulate deuteranopia (insensitivity to red)
+sim_deuteranopia = MatrixFilter(
+    _SIM_DEUTERANOPIA_R_COEFFS,
+    _SIM_DEUTERANOPIA_G_COEFFS,
+    _SIM_DEUTERANOPIA_B_COEFFS,
+)
+
+#: Simulate protanopia (insensitivity to green)
+sim_protanopia = MatrixFilter(
+    _SIM_PROTANOPIA_R_COEFFS,
+    _SIM_PROTANOPIA_G_COEFFS,
+    _SIM_PROTANOPIA_B_COEFFS,
+)
+
+#: Simulate tritanopia (insensitivity to blue)
+sim_tritanopia = MatrixFilter(
+    _SIM_TRITANOPIA_R_COEFFS,
+    _SIM_TRITANOPIA_G_COEFFS,
+    _SIM_TRITANOPIA_B_COEFFS,
+)
@@ -19,6 +19,8 @@ i.e. they convert user input into updates to the document model.
 
 import os
 import math
+import time
+import tempfile
 from warnings import warn
 import weakref
 import logging
@@ -47,6 +49,8 @@ import gui.inktool   # registration only
 import gui.buttonmap
 import gui.externalapp
 import gui.device
+import gui.overlays
+import gui.renderstats
 
 
 ## Class definitions
@@ -875,6 +879,10 @@ class Document (CanvasController):  # TODO: rename to "DocumentController"
         """Trim Layer action: discard tiles outside the frame"""
         self.model.trim_current_layer()
 
+    def crop_to_frame_cb(self, action):
+        """Crop to Frame action: trim all layers to the frame"""
+        self.model.crop_to_frame()
+
     def _update_trim_layer_action(self, *_ignored):
         """Updates the Trim Layer action's sensitivity"""
         app = self.app
@@ -983,7 +991,7 @@ class Document (CanvasController):  # TODO: rename to "DocumentController"
     def _layer_picking_iter(self):
         """Enumerates leaf layers in picking order, with paths"""
         layer_stack = self.model.layer_stack
-        layers_enum = layer_stack.deepenumerate()
+        layers_enum = layer_stack.walk()
         parents = set()
         for path, layer in layers_enum:
             if path in parents:
@@ -1765,6 +1773,43 @@ class Document (CanvasController):  # TODO: rename to "DocumentController"
         """Toggles highlighting of each redraw"""
         self.tdw.renderer.visualize_rendering = action.get_active()
 
+    def _get_render_stats(self):
+        """The main view's render statistics, enabling them if needed"""
+        renderer = self.tdw.renderer
+        if renderer.render_stats is None:
+            renderer.render_stats = gui.renderstats.RenderStats()
+        return renderer.render_stats
+
+    def show_render_stats_cb(self, action):
+        """Toggles the on-canvas render statistics display"""
+        overlays = self.tdw.display_overlays
+        for overlay in list(overlays):
+            if isinstance(overlay, gui.overlays.RenderStatsOverlay):
+                overlays.remove(overlay)
+        if action.get_active():
+            self._get_render_stats()
+            overlays.append(gui.overlays.RenderStatsOverlay(self))
+        elif not self._get_render_stats().recording:
+            self.tdw.renderer.render_stats = None
+        self.tdw.queue_draw()
+
+    def record_render_trace_cb(self, action):
+        """Toggles recording of render statistics to a JSON file"""
+        stats = self._get_render_stats()
+        if action.get_active():
+            filename = time.strftime("mypaint-render-trace-%Y%m%d-%H%M%S.json")
+            stats.start_trace(os.path.join(tempfile.gettempdir(), filename))
+            return
+        path = stats.stop_trace()
+        overlays = self.tdw.display_overlays
+        if not any(isinstance(o, gui.overlays.RenderStatsOverlay)
+                   for o in overlays):
+            self.tdw.renderer.render_stats = None
+        if path:
+            self.app.show_transient_message(
+                _("Rendering trace written to %s") % (path,),
+            )
+
     def no_double_buffering_cb(self, action):
         """Toggles double buffering"""
         self.tdw.renderer.set_double_buffered(not action.get_active())
@@ -16,6 +16,10 @@ from gettext import gettext as _
 
 import gui.mode
 import gui.cursor
+import lib.helpers
+import lib.layer
+import lib.tiledsurface
+from lib.observable import event
 
 
 ## Class defs
@@ -46,6 +50,8 @@ class FloodFillMode (gui.mode.ScrollableModeMixin,
     _fill_permitted = True
     _x = None
     _y = None
+    _preview = None
+    _preview_doc = None  # doc the preview handlers are connected for
 
     @property
     def cursor(self):
@@ -62,14 +68,55 @@ class FloodFillMode (gui.mode.ScrollableModeMixin,
         rootstack = self.doc.model.layer_stack
         rootstack.current_path_updated += self._update_ui
         rootstack.layer_properties_changed += self._update_ui
+        if self._preview_doc is None:
+            self._connect_preview_handlers(doc)
         self._update_ui()
 
     def leave(self, **kwds):
+        """Leaves the mode, ending any preview if it isn't stacked
+
+        Temporary view modes like panning and zooming are stacked on
+        top of this one, so the preview is kept for them. It's only
+        cancelled when the mode is really replaced.
+        """
         rootstack = self.doc.model.layer_stack
         rootstack.current_path_updated -= self._update_ui
         rootstack.layer_properties_changed -= self._update_ui
+        still_stacked = False
+        for mode in self.doc.modes:
+            if mode is self:
+                still_stacked = True
+                break
+        if not still_stacked:
+            self._disconnect_preview_handlers()
         return super(FloodFillMode, self).leave(**kwds)
 
+    def _connect_preview_handlers(self, doc):
+        """Starts listening for things which affect fill previews"""
+        self._preview_doc = doc
+        rootstack = doc.model.layer_stack
+        rootstack.current_path_updated += self._cancel_preview
+        rootstack.layer_properties_changed += self._cancel_preview
+        rootstack.layer_content_changed += self._cancel_preview
+        opts = self.get_options_widget()
+        opts.changed += self._options_changed_cb
+        opts.apply_requested += self._apply_preview
+        opts.cancel_requested += self._cancel_preview
+
+    def _disconnect_preview_handlers(self):
+        """Cancels any preview, and stops listening for changes"""
+        self._cancel_preview()
+        doc = self._preview_doc
+        self._preview_doc = None
+        rootstack = doc.model.layer_stack
+        rootstack.current_path_updated -= self._cancel_preview
+        rootstack.layer_properties_changed -= self._cancel_preview
+        rootstack.layer_content_changed -= self._cancel_preview
+        opts = self.get_options_widget()
+        opts.changed -= self._options_changed_cb
+        opts.apply_requested -= self._apply_preview
+        opts.cancel_requested -= self._cancel_preview
+
     @classmethod
     def get_name(cls):
         return _(u'Flood Fill')
@@ -84,7 +131,8 @@ class FloodFillMode (gui.mode.ScrollableModeMixin,
         """Flood-fill with the current settings where clicked
 
         If the current layer is not fillable, a new layer will always be
-        created for the fill.
+        created for the fill. If previews are turned on, the fill is
+        only previewed, and it's made when the preview is applied.
         """
         x, y = tdw.display_to_model(event.x, event.y)
         self._x = x
@@ -93,16 +141,81 @@ class FloodFillMode (gui.mode.ScrollableModeMixin,
         self._update_ui()
         color = self.doc.app.brush_color_manager.get_color()
         opts = self.get_options_widget()
+        if opts.preview:
+            self._start_preview(x, y, color.get_rgb())
+            return False
+        self._fill(x, y, color.get_rgb(), opts.sample_merged)
+        return False
+
+    def _fill(self, x, y, color, sample_merged):
+        """Makes a fill with the current options, as a command"""
+        opts = self.get_options_widget()
+        model = self._preview_doc.model
         make_new_layer = opts.make_new_layer
-        rootstack = tdw.doc.layer_stack
-        if not rootstack.current.get_fillable():
+        if not model.layer_stack.current.get_fillable():
             make_new_layer = True
-        tdw.doc.flood_fill(x, y, color.get_rgb(),
-                           tolerance=opts.tolerance,
-                           sample_merged=opts.sample_merged,
-                           make_new_layer=make_new_layer)
+        model.flood_fill(x, y, color,
+                         tolerance=opts.tolerance,
+                         sample_merged=sample_merged,
+                         make_new_layer=make_new_layer)
         opts.make_new_layer = False
-        return False
+
+    ## Fill previews
+
+    def _start_preview(self, x, y, color):
+        """Starts previewing a fill, replacing any earlier preview"""
+        self._cancel_preview()
+        opts = self.get_options_widget()
+        doc = self._preview_doc
+        preview = _FillPreview(doc.model, x, y, color, opts.sample_merged)
+        self._preview = preview
+        doc.tdw.overlay_layer = preview.overlay
+        self._update_preview()
+        opts.preview_active = True
+
+    def _update_preview(self):
+        """Shows the current preview at the current tolerance"""
+        opts = self.get_options_widget()
+        changed = self._preview.update(opts.tolerance)
+        if not changed.empty():
+            self._preview_doc.model.canvas_area_modified(*changed)
+
+    def _cancel_preview(self, *_ignored):
+        """Stops previewing without filling anything
+
+        Changes to the layers end the preview too, because the fill is
+        only valid for the layers as they were.
+        """
+        preview = self._preview
+        if preview is None:
+            return
+        self._preview = None
+        doc = self._preview_doc
+        if doc.tdw.overlay_layer is preview.overlay:
+            doc.tdw.overlay_layer = None
+        bbox = preview.get_bbox()
+        if not bbox.empty():
+            doc.model.canvas_area_modified(*bbox)
+        self.get_options_widget().preview_active = False
+
+    def _apply_preview(self, *_ignored):
+        """Makes the fill being previewed"""
+        preview = self._preview
+        if preview is None:
+            return
+        self._cancel_preview()
+        self._fill(preview.x, preview.y, preview.color,
+                   preview.sample_merged)
+
+    def _options_changed_cb(self, opts):
+        """Re-thresholds or restarts the preview when options change"""
+        preview = self._preview
+        if preview is None:
+            return
+        if preview.sample_merged != opts.sample_merged:
+            self._start_preview(preview.x, preview.y, preview.color)
+        else:
+            self._update_preview()
 
     def motion_notify_cb(self, tdw, event):
         """Track position, and update cursor"""
@@ -158,16 +271,69 @@ class FloodFillMode (gui.mode.ScrollableModeMixin,
         return cls._OPTIONS_WIDGET
 
 
+class _FillPreview (object):
+    """A flood fill shown as an overlay, before it is made
+
+    The distances between the seed color and the colors of the pixels
+    the fill reaches are worked out only once, and are kept tile by tile
+    in a `lib.tiledsurface.FillDistances`. Changing the tolerance only
+    re-runs the fill over those, so the preview can follow the tolerance
+    slider without any sampling, compositing, or undo history.
+    """
+
+    def __init__(self, model, x, y, color, sample_merged):
+        super(_FillPreview, self).__init__()
+        self.x = x
+        self.y = y
+        self.color = color
+        self.sample_merged = sample_merged
+        self.tolerance = None
+        self._bbox = model.get_flood_fill_bbox(x, y)
+        src = model.get_flood_fill_source(sample_merged)
+        self._distances = None
+        if src is not None:
+            self._distances = lib.tiledsurface.FillDistances(src, x, y)
+        self._surface = lib.tiledsurface.Surface()
+        self.overlay = lib.layer.SurfaceBackedLayer(surface=self._surface)
+
+    def get_bbox(self):
+        """The area currently shown as filled"""
+        return self._surface.get_bbox()
+
+    def update(self, tolerance):
+        """Fills the overlay for a tolerance
+
+        :returns: the area of the canvas which changed
+        :rtype: lib.helpers.Rect
+        """
+        changed = lib.helpers.Rect()
+        if tolerance == self.tolerance:
+            return changed
+        self.tolerance = tolerance
+        changed.expandToIncludeRect(self.get_bbox())
+        self._surface.clear()
+        if self._distances is not None:
+            filled = lib.tiledsurface.fill_tiles(
+                self._distances, self.x, self.y, self.color,
+                self._bbox, tolerance,
+            )
+            lib.tiledsurface.composite_fill(filled, self._surface)
+        changed.expandToIncludeRect(self.get_bbox())
+        return changed
+
+
 class FloodFillOptionsWidget (Gtk.Grid):
     """Configuration widget for the flood fill tool"""
 
     TOLERANCE_PREF = 'flood_fill.tolerance'
     SAMPLE_MERGED_PREF = 'flood_fill.sample_merged'
+    PREVIEW_PREF = 'flood_fill.preview'
     # "make new layer" is a temportary toggle, and is not saved to prefs
 
     DEFAULT_TOLERANCE = 0.05
     DEFAULT_SAMPLE_MERGED = False
     DEFAULT_MAKE_NEW_LAYER = False
+    DEFAULT_PREVIEW = False
 
     def __init__(self):
         Gtk.Grid.__init__(self)
@@ -239,6 +405,42 @@ class FloodFillOptionsWidget (Gtk.Grid):
         checkbut.set_active(active)
         self._make_new_layer_toggle = checkbut
 
+        row += 1
+        label = Gtk.Label()
+        label.set_markup(_("Preview:"))
+        label.set_tooltip_text(_("Whether to check fills before making them"))
+        label.set_alignment(1.0, 0.5)
+        label.set_hexpand(False)
+        self.attach(label, 0, row, 1, 1)
+
+        text = _("Adjust Before Filling")
+        checkbut = Gtk.CheckButton.new_with_label(text)
+        checkbut.set_tooltip_text(
+            _("Show what a click would fill, and let the tolerance\n"
+              "be adjusted before the fill is made"))
+        self.attach(checkbut, 1, row, 1, 1)
+        active = bool(prefs.get(self.PREVIEW_PREF, self.DEFAULT_PREVIEW))
+        checkbut.set_active(active)
+        checkbut.connect("toggled", self._preview_toggled_cb)
+        self._preview_toggle = checkbut
+
+        row += 1
+        bbox = Gtk.ButtonBox(orientation=Gtk.Orientation.HORIZONTAL)
+        bbox.set_layout(Gtk.ButtonBoxStyle.END)
+        bbox.set_spacing(6)
+        button = Gtk.Button(label=_("Cancel"))
+        button.connect("clicked", lambda *a: self.cancel_requested())
+        button.set_tooltip_text(_("Discard the fill being previewed"))
+        bbox.pack_start(button, False, False, 0)
+        self._cancel_button = button
+        button = Gtk.Button(label=_("Fill"))
+        button.connect("clicked", lambda *a: self.apply_requested())
+        button.set_tooltip_text(_("Make the fill being previewed"))
+        bbox.pack_start(button, False, False, 0)
+        self._apply_button = button
+        self.attach(bbox, 0, row, 2, 1)
+        self.preview_active = False
+
         row += 1
         align = Gtk.Alignment(0.5, 1.0, 1.0, 0.0)
         align.set_vexpand(True)
@@ -264,13 +466,47 @@ class FloodFillOptionsWidget (Gtk.Grid):
     def sample_merged(self):
         return bool(self._sample_merged_toggle.get_active())
 
+    @property
+    def preview(self):
+        return bool(self._preview_toggle.get_active())
+
+    @property
+    def preview_active(self):
+        """Whether a fill is being previewed: enables Fill and Cancel"""
+        return self._apply_button.get_sensitive()
+
+    @preview_active.setter
+    def preview_active(self, value):
+        self._apply_button.set_sensitive(bool(value))
+        self._cancel_button.set_sensitive(bool(value))
+
+    @event
+    def changed(self):
+        """Event: the tolerance or the sample-merged option changed"""
+
+    @event
+    def apply_requested(self):
+        """Event: the fill being previewed should be made"""
+
+    @event
+    def cancel_requested(self):
+        """Event: the fill being previewed should be discarded"""
+
     def _tolerance_changed_cb(self, adj):
         self.app.preferences[self.TOLERANCE_PREF] = self.tolerance
+        self.changed()
 
     def _sample_merged_toggled_cb(self, checkbut):
         self.app.preferences[self.SAMPLE_MERGED_PREF] = self.sample_merged
+        self.changed()
+
+    def _preview_toggled_cb(self, checkbut):
+        self.app.preferences[self.PREVIEW_PREF] = self.preview
+        if not self.preview:
+            self.cancel_requested()
 
     def _reset_clicked_cb(self, button):
         self._tolerance_adj.set_value(self.DEFAULT_TOLERANCE)
         self._make_new_layer_toggle.set_active(self.DEFAULT_MAKE_NEW_LAYER)
         self._sample_merged_toggle.set_active(self.DEFAULT_SAMPLE_MERGED)
+        self._preview_toggle.set_active(self.DEFAULT_PREVIEW)
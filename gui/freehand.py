@@ -10,6 +10,7 @@
 ## Imports
 
 import math
+from time import time as wallclock
 from numpy import array
 from numpy import isfinite
 from lib.helpers import clamp
@@ -77,6 +78,14 @@ class FreehandMode (gui.mode.BrushworkModeMixin,
 
     MOTION_QUEUE_PRIORITY = gobject.PRIORITY_DEFAULT_IDLE
 
+    # Each run of the motion queue processor drains as many queued
+    # events as it can within this many seconds, painting them in a
+    # single atomic section. This lets the ink catch up with the stylus
+    # when the brush is expensive, while leaving time for redraws and
+    # input handling within a typical 60Hz frame.
+
+    MOTION_QUEUE_TIME_BUDGET = 0.008
+
     # The Right Thing To Do generally is to spend as little time as
     # possible directly handling each event received. Disconnecting
     # stroke rendering from event processing buys the user the ability
@@ -155,6 +164,11 @@ class FreehandMode (gui.mode.BrushworkModeMixin,
             self.motion_processing_cbid = None
             self._last_queued_event_time = 0
 
+            # Wall-clock times at which each queued motion was queued,
+            # kept in step with motion_queue for latency measurement.
+            self.motion_queue_times = deque()
+            self.last_dequeued_time = None
+
             # Queued Event Handling
 
             # Pressure and tilt interpolation for evhack events, which
@@ -168,6 +182,10 @@ class FreehandMode (gui.mode.BrushworkModeMixin,
             # average times.
             self.avgtime = None
 
+            # Debugging: motion queue depth and input-to-ink latency.
+            # Accumulated over about a second, then logged and reset.
+            self.queue_stats = None
+
             # Button pressed while drawing
             # Not every device sends button presses, but evdev ones
             # do, and this is used as a workaround for an evdev bug:
@@ -221,21 +239,62 @@ class FreehandMode (gui.mode.BrushworkModeMixin,
                     for zx, zy, zp, zxt, zyt in self._zero_dtime_motions:
                         zt += step
                         zevent_data = (zt, zx, zy, zp, zxt, zyt)
-                        self.motion_queue.append(zevent_data)
+                        self._append_motion(zevent_data)
                     # Reset the backlog buffer
                     self._zero_dtime_motions = []
                 # Queue this event too
-                self.motion_queue.append(event_data)
+                self._append_motion(event_data)
                 # Update the timestamp used above
                 self._last_queued_event_time = time
 
+        def _append_motion(self, event_data):
+            """Append to the motion queue, recording the time queued"""
+            self.motion_queue.append(event_data)
+            self.motion_queue_times.append(wallclock())
+
+        def clear_motion_queue(self):
+            """Discard all queued motion events"""
+            self.motion_queue = deque()
+            self.motion_queue_times = deque()
+
         def next_processing_events(self):
             """Fetches zero or more events to process from the queue"""
             if len(self.motion_queue) > 0:
                 event = self.motion_queue.popleft()
+                self.last_dequeued_time = self.motion_queue_times.popleft()
                 for ievent in self.interp.feed(*event):
                     yield ievent
 
+        def update_queue_stats(self, nprocessed, latency):
+            """Record stats for one run of the queue processor
+
+            :param int nprocessed: Queued motions processed in the run
+            :param float latency: Input-to-ink time of the oldest, in s
+            :returns: Summary stats, once about every second, or None
+            :rtype: tuple
+
+            The summary is a tuple of the form ``(nruns, nprocessed,
+            max_depth, avg_latency, max_latency)``, where the depth is
+            the number of queued motions left at the end of a run.
+            """
+            depth = len(self.motion_queue)
+            now = wallclock()
+            stats = self.queue_stats
+            if stats is None:
+                stats = [now, 0, 0, 0, 0.0, 0.0]
+            t0, nruns, nproc, max_depth, sum_lat, max_lat = stats
+            nruns += 1
+            nproc += nprocessed
+            max_depth = max(max_depth, depth)
+            sum_lat += latency
+            max_lat = max(max_lat, latency)
+            if now - t0 > 1.0:
+                self.queue_stats = None
+                return (nruns, nproc, max_depth, sum_lat/nruns, max_lat)
+            self.queue_stats = [t0, nruns, nproc, max_depth,
+                                sum_lat, max_lat]
+            return None
+
     def _reset_drawing_state(self):
         """Resets all per-TDW drawing state"""
         self._remove_event_compression_workarounds()
@@ -545,15 +604,46 @@ class FreehandMode (gui.mode.BrushworkModeMixin,
     ## Motion queue processing
 
     def _motion_queue_idle_cb(self, tdw):
-        """Idle callback; processes each queued event"""
+        """Idle callback; processes queued events within a time budget"""
         drawstate = self._get_drawing_state(tdw)
         # Stop if asked to stop
         if drawstate.motion_processing_cbid is None:
-            drawstate.motion_queue = deque()
+            drawstate.clear_motion_queue()
             return False
-        # Forward one or more motion events to the canvas
-        for event in drawstate.next_processing_events():
-            self._process_queued_event(tdw, event)
+        # Forward as many motion events to the canvas as fit in the
+        # time budget, coalescing them into one atomic section so that
+        # the redraws they cause are merged.
+        t0 = wallclock()
+        deadline = t0 + self.MOTION_QUEUE_TIME_BUDGET
+        oldest_queued = None
+        nprocessed = 0
+        layer = tdw.doc.layer_stack.current
+        batched = layer.get_paintable()
+        if batched:
+            layer.begin_atomic()
+        try:
+            while len(drawstate.motion_queue) > 0:
+                for event in drawstate.next_processing_events():
+                    self._process_queued_event(tdw, event)
+                nprocessed += 1
+                if oldest_queued is None:
+                    oldest_queued = drawstate.last_dequeued_time
+                if wallclock() >= deadline:
+                    break
+        finally:
+            if batched:
+                layer.end_atomic()
+        # Debugging: queue depth and input-to-ink latency
+        if self._debug and oldest_queued is not None:
+            latency = wallclock() - oldest_queued
+            summary = drawstate.update_queue_stats(nprocessed, latency)
+            if summary:
+                logger.debug(
+                    "Motion queue: %d runs, %d motions, max depth %d, "
+                    "input-to-ink latency avg %0.1fms max %0.1fms",
+                    summary[0], summary[1], summary[2],
+                    summary[3]*1000, summary[4]*1000,
+                )
         # Stop if the queue is now empty
         if len(drawstate.motion_queue) == 0:
             drawstate.motion_processing_cbid = None
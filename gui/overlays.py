@@ -273,3 +273,88 @@ class LastPaintPosOverlay (FadingOverlay):
         cr.set_line_width(self.inner_line_width)
         cr.stroke()
         return area
+
+
+class RenderStatsOverlay (Overlay):
+    """Shows the canvas renderer's frame timing statistics
+
+    The text box is refreshed a few times a second. Because refreshing
+    it makes cheap frames of its own, it shows the slowest frame of the
+    last couple of seconds, which is what matters when tracking down
+    lag. See `gui.renderstats.RenderStats` for what the numbers mean.
+    """
+
+    margin = 12
+    padding = 6
+    refresh_interval = 500  #: milliseconds
+    period = 2.0  #: seconds of history to find the worst frame in
+    max_layers = 5  #: number of most expensive layers to list
+
+    def __init__(self, doc):
+        Overlay.__init__(self)
+        self.tdw = doc.tdw
+        self._area = None
+        GLib.timeout_add(self.refresh_interval, self._refresh_cb)
+
+    def _refresh_cb(self):
+        if self not in self.tdw.display_overlays:
+            return False
+        if self._area:
+            self.tdw.queue_draw_area(*self._area)
+        return True
+
+    def _get_text_lines(self, stats):
+        lines = [_("Render: %.1f fps") % (stats.get_fps(),)]
+        frame = stats.get_worst_frame(self.period)
+        if frame is None:
+            return lines
+        ms = lambda t: t * 1000.0
+        lines.extend([
+            _("Worst frame: %.1f ms") % (ms(frame["draw_time"]),),
+            _("Tiles: %d considered, %d visible, %d rendered") % (
+                frame["tiles_considered"],
+                frame["tiles_visible"],
+                frame["tiles_rendered"],
+            ),
+            _("Backing store chunks: %d") % (frame["chunks_rendered"],),
+            _("Surfaces: %d used, %d allocated") % (
+                frame["surface_requests"],
+                frame["surface_allocations"],
+            ),
+            _("Cache: %d hits, %d misses, %d filtered hits") % (
+                frame["cache_hits"],
+                frame["cache_misses"],
+                frame["filtered_cache_hits"],
+            ),
+            _("Composite %.1f, convert %.1f, filter %.1f, paint %.1f ms") % (
+                ms(frame["composite_time"]),
+                ms(frame["convert_time"]),
+                ms(frame["filter_time"]),
+                ms(frame["paint_time"]),
+            ),
+        ])
+        layer_times = sorted(frame["layer_times"].items(),
+                             key=lambda i: i[1], reverse=True)
+        for name, t in layer_times[:self.max_layers]:
+            lines.append(u"    %s: %.1f ms" % (name, ms(t)))
+        return lines
+
+    def paint(self, cr):
+        stats = self.tdw.renderer.render_stats
+        if stats is None:
+            return
+        text = u"\n".join(self._get_text_lines(stats))
+        layout = self.tdw.create_pango_layout(text)
+        alloc = self.tdw.get_allocation()
+        lw, lh = layout.get_pixel_size()
+        m = self.margin
+        p = self.padding
+        bx, by = m, alloc.height - lh - m - p - p
+        bw, bh = lw + p + p, lh + p + p
+        rounded_box(cr, bx, by, bw, bh, p)
+        cr.set_source_rgba(*gui.style.TRANSIENT_INFO_BG_RGBA)
+        cr.fill()
+        cr.translate(bx + p, by + p)
+        cr.set_source_rgba(*gui.style.TRANSIENT_INFO_RGBA)
+        PangoCairo.show_layout(cr, layout)
+        self._area = (int(bx), int(by), int(bw) + 1, int(bh) + 1)
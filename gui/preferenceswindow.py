@@ -79,6 +79,10 @@ class PreferencesWindow (windowing.Dialog):
         autosave_interval_spinbut = getobj("autosave_interval_spinbutton")
         self._autosave_interval_spinbutton = autosave_interval_spinbut
 
+        # Downscaling controls
+        mipmap_quality_spinbut = getobj("mipmap_quality_spinbutton")
+        self._mipmap_quality_spinbutton = mipmap_quality_spinbut
+
         # Signal hookup now everything is in the right initial state
         self._builder.connect_signals(self)
 
@@ -139,6 +143,16 @@ class PreferencesWindow (windowing.Dialog):
         real_alpha_checks_checkbutton = getobj("real_alpha_checks_checkbutton")
         real_alpha_checks_checkbutton.set_active(p['view.real_alpha_checks'])
 
+        # Downscaling when zoomed out (the quality is for "fractional")
+        mipmap_mode = p['view.mipmap_mode']
+        mipmap_mode_combo = getobj("mipmap_mode_combobox")
+        mipmap_mode_combo.set_active_id(mipmap_mode)
+        mipmap_quality_adj = getobj("mipmap_quality_adjustment")
+        mipmap_quality_adj.set_value(float(p['view.mipmap_quality']))
+        self._mipmap_quality_spinbutton.set_sensitive(
+            mipmap_mode == "fractional",
+        )
+
         # Default save format
         fmt_config = p['saving.default_format']
         fmt_combo = getobj("default_save_format_combobox")
@@ -226,6 +240,15 @@ class PreferencesWindow (windowing.Dialog):
         real = bool(button.get_active())
         self.app.preferences['view.real_alpha_checks'] = real
 
+    def mipmap_mode_combobox_changed_cb(self, combobox):
+        mode = combobox.get_active_id()
+        self.app.preferences['view.mipmap_mode'] = mode
+        self._mipmap_quality_spinbutton.set_sensitive(mode == "fractional")
+
+    def mipmap_quality_adjustment_value_changed_cb(self, adj):
+        quality = float(adj.get_value())
+        self.app.preferences['view.mipmap_quality'] = quality
+
     def default_save_format_combobox_changed_cb(self, combobox):
         formatstr = combobox.get_active_id()
         self.app.preferences['saving.default_format'] = formatstr
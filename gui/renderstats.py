@@ -0,0 +1,193 @@
+# This file is part of MyPaint.
+# Copyright (C) 2015 by the MyPaint Development Team
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+
+"""Frame timing statistics for the canvas renderer
+
+A `RenderStats` object attached to a `gui.tileddrawwidget.CanvasRenderer`
+makes one record per draw, saying where the frame's time went. Records
+are plain dicts so that they can be written out as JSON traces. Times
+are in seconds.
+
+    >>> stats = RenderStats(history=2)
+    >>> for i in xrange(3):
+    ...     frame = stats.begin_frame()
+    ...     frame["tiles_rendered"] += 4
+    ...     frame["layer_times"][u"0: Background"] += 0.001
+    ...     stats.end_frame(frame)
+    >>> len(stats.frames)
+    2
+    >>> stats.last_frame["tiles_rendered"]
+    4
+    >>> sorted(stats.last_frame["layer_times"].keys())
+    [u'0: Background']
+
+"""
+
+
+## Imports
+
+import json
+import collections
+from time import time as wallclock
+import logging
+logger = logging.getLogger(__name__)
+
+
+## Class defs
+
+
+class RenderStats (object):
+    """Records per-frame rendering statistics, optionally to a trace
+
+    Frame records contain the following keys. The canvas renderer fills
+    in the counts of tiles and the drawing and painting times, and
+    `lib.layer.tree.RootLayerStack.render_into()` fills in the rest
+    when it is passed the record as its `stats`.
+
+    * "start": wall-clock time at the start of the draw
+    * "draw_time": total time spent in the draw handler
+    * "tiles_considered": tiles in the render surfaces
+    * "tiles_visible": tiles left after visibility culling
+    * "tiles_rendered": tiles composited or fetched from the caches
+    * "chunks_rendered": backing store chunks rendered
+    * "cache_hits", "cache_misses": composited tile cache lookups
+    * "filtered_cache_hits": display-filtered tile cache hits
+    * "composite_time": time spent compositing layers
+    * "layer_times": compositing time for each top-level layer or group,
+      keyed by its index and name, e.g. ``u"2: Sketch"``
+    * "convert_time": time spent converting to 8 bits per channel
+    * "filter_time": time spent in the display filter
+    * "paint_time": time spent painting the results with Cairo
+    * "surface_requests": render target surfaces used
+    * "surface_allocations": render target surfaces newly allocated
+
+    """
+
+    def __init__(self, history=120):
+        """Initialize
+
+        :param int history: number of recent frames to keep
+
+        """
+        super(RenderStats, self).__init__()
+        self.frames = collections.deque(maxlen=history)
+        self._trace = None
+        self._trace_path = None
+
+    @property
+    def last_frame(self):
+        """The most recently completed frame record, or None"""
+        if not self.frames:
+            return None
+        return self.frames[-1]
+
+    @property
+    def recording(self):
+        """Whether frames are currently being recorded to a trace"""
+        return self._trace is not None
+
+    def begin_frame(self):
+        """Starts a new frame record, and returns it
+
+        :rtype: dict
+
+        """
+        frame = dict(
+            start = wallclock(),
+            draw_time = 0.0,
+            tiles_considered = 0,
+            tiles_visible = 0,
+            tiles_rendered = 0,
+            chunks_rendered = 0,
+            cache_hits = 0,
+            cache_misses = 0,
+            filtered_cache_hits = 0,
+            composite_time = 0.0,
+            layer_times = collections.defaultdict(float),
+            convert_time = 0.0,
+            filter_time = 0.0,
+            paint_time = 0.0,
+            surface_requests = 0,
+            surface_allocations = 0,
+        )
+        return frame
+
+    def end_frame(self, frame):
+        """Completes a frame record started by `begin_frame()`"""
+        frame["draw_time"] = wallclock() - frame["start"]
+        self.frames.append(frame)
+        if self._trace is not None:
+            self._trace.append(frame)
+
+    def get_fps(self):
+        """Average frames per second over the recent history"""
+        if len(self.frames) < 2:
+            return 0.0
+        elapsed = self.frames[-1]["start"] - self.frames[0]["start"]
+        if elapsed <= 0:
+            return 0.0
+        return (len(self.frames) - 1) / elapsed
+
+    def get_worst_frame(self, period=2.0):
+        """The slowest frame within a recent period, or None
+
+        :param float period: how far back to look, in seconds
+
+        """
+        since = wallclock() - period
+        worst = None
+        for frame in self.frames:
+            if frame["start"] < since:
+                continue
+            if worst is None or frame["draw_time"] > worst["draw_time"]:
+                worst = frame
+        return worst
+
+    def start_trace(self, path):
+        """Starts recording frames, to be written out as JSON
+
+        :param unicode path: where `stop_trace()` will write the trace
+
+        """
+        self._trace = []
+        self._trace_path = path
+        logger.info("Recording render trace to %r", path)
+
+    def stop_trace(self):
+        """Stops recording, and writes the trace file
+
+        :returns: the path written to, or None if not recording
+
+        """
+        if self._trace is None:
+            return None
+        trace, path = self._trace, self._trace_path
+        self._trace = None
+        self._trace_path = None
+        info = {
+            "frames": trace,
+        }
+        with open(path, "w") as fp:
+            json.dump(info, fp, indent=1, sort_keys=True)
+        logger.info("Wrote %d frames to render trace %r", len(trace), path)
+        return path
+
+
+## Module testing
+
+
+def _test():
+    """Run doctest strings"""
+    import doctest
+    doctest.testmod()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.DEBUG)
+    _test()
@@ -20,11 +20,13 @@ import os
 import random
 from math import floor, ceil, log, exp
 import math
+import numpy
 from numpy import isfinite
 from numpy import empty
 from warnings import warn
 import weakref
 import contextlib
+from time import time as wallclock
 import logging
 logger = logging.getLogger(__name__)
 
@@ -36,6 +38,18 @@ from drawutils import render_checks
 import gui.style
 
 
+## Constants
+
+#: Time per frame for progressive rendering of the canvas, in seconds.
+PROGRESSIVE_RENDER_TIME_BUDGET = 0.02
+
+#: Size of progressive rendering chunks, in device pixels.
+PROGRESSIVE_RENDER_CHUNK_SIZE = 2 * tiledsurface.N
+
+#: How many mipmap levels coarser quick renders of blank areas are.
+PROGRESSIVE_RENDER_COARSE_LEVELS = 2
+
+
 ## Class definitions
 
 
@@ -659,6 +673,13 @@ class CanvasRenderer(gtk.DrawingArea, DrawCursorMixin):
 
         self.visualize_rendering = False
 
+        #: Optional gui.renderstats.RenderStats for timing each frame
+        self.render_stats = None
+        self._frame_stats = None
+
+        # Reusable render targets
+        self._surface_pool = pixbufsurface.SurfacePool()
+
         self.translation_x = 0.0
         self.translation_y = 0.0
         self.scale = 1.0
@@ -698,6 +719,22 @@ class CanvasRenderer(gtk.DrawingArea, DrawCursorMixin):
         self._hq_rendering = True
         self._restore_hq_rendering_timeout_id = None
 
+        # Persistent backing store, rendered into progressively.
+        # Holds the rendered document in device space, so that panning
+        # only needs to render the strips it exposes, and model changes
+        # only the areas which changed. See _update_backing_store().
+        self.use_backing_store = True
+        self._backing = None
+        self._backing_spare = None
+        self._backing_geom_key = None
+        self._backing_content_key = None
+        self._backing_origin = None
+        self._backing_invalid = []   # model-space (x, y, w, h) rects
+        self._backing_pending = set()   # chunks needing a full render
+        self._backing_levels = {}   # chunk: mipmap level rendered at
+        self._progressive_render_idle_id = None
+        self._progressive_render_rects = []   # device areas to redraw
+
     def _init_alpha_checks(self):
         """Initialize the alpha check backgrounds"""
         # Real: checkerboard pattern, rendered via Cairo
@@ -804,9 +841,13 @@ class CanvasRenderer(gtk.DrawingArea, DrawCursorMixin):
         if w == 0 and h == 0:
             # Full redraw (used when background has changed).
             #logger.debug('Full redraw')
+            self.invalidate_backing_store()
             self.queue_draw()
             return
 
+        if self._backing is not None:
+            self._invalidate_backing_store_area(x, y, w, h)
+
         # Create an expose event with the event bbox rotated/zoomed.
         corners = [(x, y), (x+w, y), (x, y+h), (x+w, y+h)]
         corners = [self.model_to_display(x, y) for (x, y) in corners]
@@ -867,14 +908,41 @@ class CanvasRenderer(gtk.DrawingArea, DrawCursorMixin):
         # Paint checkerboard if we won't be rendering an opaque background
         model = self.doc
         render_is_opaque = model and model.layer_stack.get_render_is_opaque()
-        if (not render_is_opaque) and self._draw_real_alpha_checks:
+        real_alpha_checks = (not render_is_opaque
+                             and self._draw_real_alpha_checks)
+        if real_alpha_checks:
             cr.set_source(self._real_alpha_check_pattern)
             cr.paint()
         if not model:
             return True
+        stats = self.render_stats
+        frame = None
+        if stats is not None:
+            frame = stats.begin_frame()
+            allocations = self._surface_pool.allocations
+            requests = self._surface_pool.requests
+        self._frame_stats = frame
         # Render the document
-        render_info = self.render_prepare(cr, None)
-        self.render_execute(cr, *render_info)
+        if self._backing_store_usable(real_alpha_checks):
+            clip_exists, rect = gdk.cairo_get_clip_rectangle(cr)
+            if clip_exists:
+                clip_rect = (rect.x, rect.y, rect.width, rect.height)
+            else:
+                alloc = self.get_allocation()
+                clip_rect = (0, 0, alloc.width, alloc.height)
+            self._update_backing_store(clip_rect)
+            t0 = wallclock()
+            cr.set_source_surface(self._backing, 0, 0)
+            cr.paint()
+            if frame is not None:
+                frame["paint_time"] += wallclock() - t0
+            cr.save()   # >>>CONTEXT1
+            cr.transform(self._get_model_view_transformation())
+            cr.save()   # >>>CONTEXT2
+        else:
+            self._release_backing_store()
+            render_info = self.render_prepare(cr, None)
+            self.render_execute(cr, *render_info)
         # Model coordinate space:
         cr.restore()  # CONTEXT2<<<
         for overlay in self.model_overlays:
@@ -887,6 +955,12 @@ class CanvasRenderer(gtk.DrawingArea, DrawCursorMixin):
             cr.save()
             overlay.paint(cr)
             cr.restore()
+        self._frame_stats = None
+        if frame is not None:
+            pool = self._surface_pool
+            frame["surface_requests"] = pool.requests - requests
+            frame["surface_allocations"] = pool.allocations - allocations
+            stats.end_frame(frame)
         return True
 
     def render_get_clip_region(self, cr, device_bbox):
@@ -927,30 +1001,119 @@ class CanvasRenderer(gtk.DrawingArea, DrawCursorMixin):
 
         return clip_region, sparse
 
-    def tile_is_visible(self, tx, ty, transformation, clip_region, sparse, translation_only):
-        if not sparse:
-            return True
+    def get_visible_tiles(self, tiles, transformation, clip_region,
+                          sparse, translation_only):
+        """Filters tile coordinates down to those visible in the clip
+
+        :param tiles: candidate (tx, ty) tile coordinates
+        :param cairo.Matrix transformation: tile space to device space
+        :param tuple clip_region: device clip rectangle, (x, y, w, h)
+        :param bool sparse: whether the clip region is sparse
+        :param bool translation_only: whether the view is untransformed
+        :rtype: list
+
+        The whole grid of candidate tiles is tested at once with NumPy.
+        For rotated or zoomed views, the test is exact: the device clip
+        rectangle is mapped back into tile space, where it is a
+        parallelogram, and tested against each tile's square using
+        separating axes. The bounding box of a tile in device space
+        would let through many tiles which are just off screen.
 
-        # it is worth checking whether this tile really will be visible
-        # (to speed up the L-shaped expose event during scrolling)
-        # (speedup clearly visible; slowdown measurable when always executing this code)
+        """
+        tiles = list(tiles)
+        if not tiles or clip_region is None:
+            return tiles
+        if translation_only and not sparse:
+            return tiles
         N = tiledsurface.N
+        coords = numpy.array(tiles, dtype='float64')
+        px = coords[:, 0] * N
+        py = coords[:, 1] * N
+        cx, cy, cw, ch = clip_region
         if translation_only:
-            x, y = transformation.transform_point(tx*N, ty*N)
-            bbox = (int(x), int(y), N, N)
+            xx, yx, xy, yy, x0, y0 = list(transformation)
+            bx = numpy.trunc(xx*px + xy*py + x0)
+            by = numpy.trunc(yx*px + yy*py + y0)
+            visible = ((bx < cx+cw) & (bx+N > cx) &
+                       (by < cy+ch) & (by+N > cy))
+        else:
+            # Cairo's interpolation needs one extra pixel at the border
+            cx, cy, cw, ch = cx-1, cy-1, cw+2, ch+2
+            inverse = cairo.Matrix(*list(transformation))
+            assert not inverse.invert()
+            quad = numpy.array([
+                inverse.transform_point(cx, cy),
+                inverse.transform_point(cx+cw, cy),
+                inverse.transform_point(cx+cw, cy+ch),
+                inverse.transform_point(cx, cy+ch),
+            ])
+            # Tile axes
+            qx, qy = quad[:, 0], quad[:, 1]
+            visible = ((px < qx.max()) & (px+N > qx.min()) &
+                       (py < qy.max()) & (py+N > qy.min()))
+            # The parallelogram's edge normals
+            for i in (0, 1):
+                ex, ey = quad[i+1] - quad[i]
+                nx, ny = -ey, ex
+                proj = qx*nx + qy*ny
+                base = px*nx + py*ny
+                lo = base + min(0, N*nx) + min(0, N*ny)
+                hi = base + max(0, N*nx) + max(0, N*ny)
+                visible &= (lo < proj.max()) & (hi > proj.min())
+        return [t for t, v in zip(tiles, visible) if v]
+
+    @property
+    def _mipmap_mode(self):
+        if not self.app:
+            return "auto"
+        return self.app.preferences.get("view.mipmap_mode", "auto")
+
+    @property
+    def _mipmap_quality(self):
+        quality = 0.75
+        if self.app:
+            quality = self.app.preferences.get("view.mipmap_quality", 0.75)
+        return helpers.clamp(float(quality), 0.25, 1.0)
+
+    def _get_render_mipmap_level(self):
+        """The mipmap level to render at, for the current zoom
+
+        In the default "auto" mode, the level depends on whether
+        high-quality rendering is currently deferred (see
+        `defer_hq_rendering()`). The deferred level's pixels are up to
+        two device pixels wide, the high-quality one's at most one.
+
+        In "fractional" mode, the level is the cheapest one whose pixels
+        are no bigger than 1/quality device pixels, where quality is the
+        "view.mipmap_quality" preference. Below 1.0 this switches to the
+        smaller, cheaper level part of the way between the two levels
+        "auto" alternates between. `render_execute()` resamples the
+        chosen level to the exact zoom with a cheap bilinear filter.
+        The choice depends only on the zoom, so the cost of a frame
+        changes smoothly with it, and nothing pops when a drag-zoom
+        ends.
+
+        """
+        if self._mipmap_mode == "fractional":
+            quality = self._mipmap_quality
+            mipmap_level = int(floor(log(1.0/(self.scale*quality), 2)))
+            mipmap_level = max(0, mipmap_level)
+            return min(mipmap_level, tiledsurface.MAX_MIPMAP_LEVEL)
+
+        # HQ rendering causes a very clear slowdown on some hardware.
+        # Probably could avoid this entirely by rendering differently,
+        # but for now, if the canvas is being panned around,
+        # just render more simply.
+        if self._hq_rendering:
+            mipmap_level = max(0, int(floor(log(1.0/self.scale, 2))))
         else:
-            corners = [(tx*N, ty*N), ((tx+1)*N, ty*N), (tx*N, (ty+1)*N), ((tx+1)*N, (ty+1)*N)]
-            corners = [transformation.transform_point(x_, y_) for (x_, y_) in corners]
-            bbox = helpers.rotated_rectangle_bbox(corners)
-
-        c_r = gdk.Rectangle()
-        c_r.x, c_r.y, c_r.width, c_r.height = clip_region
-        bb_r = gdk.Rectangle()
-        bb_r.x, bb_r.y, bb_r.width, bb_r.height = bbox
-        intersects, isect_r = gdk.rectangle_intersect(bb_r, c_r)
-        return intersects
-
-    def render_prepare(self, cr, device_bbox):
+            mipmap_level = max(0, int(ceil(log(1/self.scale, 2))))
+
+        # OPTIMIZE: If we would render tile scanlines,
+        # OPTIMIZE:  we could probably use the better one above...
+        return min(mipmap_level, tiledsurface.MAX_MIPMAP_LEVEL)
+
+    def render_prepare(self, cr, device_bbox, mipmap_level=None):
         if device_bbox is None:
             allocation = self.get_allocation()
             w, h = allocation.width, allocation.height
@@ -969,18 +1132,8 @@ class CanvasRenderer(gtk.DrawingArea, DrawCursorMixin):
 
         transformation = cairo.Matrix(*self._get_model_view_transformation())
 
-        # HQ rendering causes a very clear slowdown on some hardware.
-        # Probably could avoid this entirely by rendering differently,
-        # but for now, if the canvas is being panned around,
-        # just render more simply.
-        if self._hq_rendering:
-            mipmap_level = max(0, int(floor(log(1.0/self.scale, 2))))
-        else:
-            mipmap_level = max(0, int(ceil(log(1/self.scale, 2))))
-
-        # OPTIMIZE: If we would render tile scanlines,
-        # OPTIMIZE:  we could probably use the better one above...
-        mipmap_level = min(mipmap_level, tiledsurface.MAX_MIPMAP_LEVEL)
+        if mipmap_level is None:
+            mipmap_level = self._get_render_mipmap_level()
         transformation.scale(2**mipmap_level, 2**mipmap_level)
 
         # bye bye device coordinates
@@ -1004,7 +1157,9 @@ class CanvasRenderer(gtk.DrawingArea, DrawCursorMixin):
         # don't actually use the alpha channel. Speedup factor 3 for
         # ATI/Radeon Xorg driver (and hopefully others).
         # https://bugs.freedesktop.org/show_bug.cgi?id=28670
-        surface = pixbufsurface.Surface(x1, y1, x2-x1+1, y2-y1+1)
+        # The surface comes from a pool, and goes back to it once
+        # render_execute() has painted it.
+        surface = self._surface_pool.get(x1, y1, x2-x1+1, y2-y1+1)
 
         return transformation, surface, sparse, mipmap_level, clip_region
 
@@ -1025,17 +1180,19 @@ class CanvasRenderer(gtk.DrawingArea, DrawCursorMixin):
         if not self._draw_real_alpha_checks:
             fake_alpha_check_tile = self._fake_alpha_check_tile
 
-        tiles = []
-        for tx, ty in surface.get_tiles():
-            if self.tile_is_visible(tx, ty, transformation, clip_region,
-                                    sparse, translation_only):
-                tiles.append((tx, ty))
+        tiles = self.get_visible_tiles(surface.get_tiles(), transformation,
+                                       clip_region, sparse, translation_only)
+        frame = self._frame_stats
+        if frame is not None:
+            frame["tiles_considered"] += len(surface.get_tiles())
+            frame["tiles_visible"] += len(tiles)
 
         self.doc._layers.render_into(
             surface, tiles, mipmap_level,
             overlay = self.overlay_layer,
             opaque_base_tile = fake_alpha_check_tile,
             filter = self.display_filter,
+            stats = frame,
         )
 
         gdk.cairo_set_source_pixbuf(
@@ -1047,32 +1204,312 @@ class CanvasRenderer(gtk.DrawingArea, DrawCursorMixin):
         if self.scale > self.pixelize_threshold:
             pattern = cr.get_source()
             pattern.set_filter(cairo.FILTER_NEAREST)
+        elif self._mipmap_mode == "fractional":
+            # The level is at most 1/quality times too coarse, so plain
+            # bilinear is good enough, and its cost per pixel is fixed.
+            pattern = cr.get_source()
+            pattern.set_filter(cairo.FILTER_BILINEAR)
 
+        t0 = wallclock()
         cr.paint()
+        if frame is not None:
+            frame["paint_time"] += wallclock() - t0
+        # Cairo has its own copy of the pixels now
+        self._surface_pool.release(surface)
 
         if self.visualize_rendering:
             # visualize painted bboxes (blue)
             cr.set_source_rgba(0, 0, random.random(), 0.4)
             cr.paint()
 
+    ## Backing store and progressive rendering
+
+    def _backing_store_usable(self, real_alpha_checks):
+        """True if the next draw can be done via the backing store
+
+        The backing store holds opaque renders only, because the real
+        alpha checks are anchored to the device, not to the model.
+
+        """
+        return (self.use_backing_store
+                and not real_alpha_checks
+                and not self.visualize_rendering)
+
+    def invalidate_backing_store(self):
+        """Marks the whole backing store as needing a re-render
+
+        The current pixels are kept on screen until they are replaced.
+
+        """
+        self._backing_content_key = None
+
+    def _release_backing_store(self):
+        """Frees the backing store's memory"""
+        self._backing = None
+        self._backing_spare = None
+        self._backing_geom_key = None
+        self._backing_content_key = None
+        self._backing_invalid = []
+        self._backing_pending.clear()
+        self._backing_levels.clear()
+        self._progressive_render_rects = []
+
+    def _invalidate_backing_store_area(self, x, y, w, h):
+        """Marks a model area as needing a re-render into the backing store
+
+        Areas are combined into their bbox when too many pile up
+        between draws: one larger render is cheaper than lots of small
+        overlapping ones.
+
+        """
+        invalid = self._backing_invalid
+        invalid.append((int(x), int(y), int(w), int(h)))
+        if len(invalid) > 16:
+            x1 = min(r[0] for r in invalid)
+            y1 = min(r[1] for r in invalid)
+            x2 = max(r[0]+r[2] for r in invalid)
+            y2 = max(r[1]+r[3] for r in invalid)
+            self._backing_invalid = [(x1, y1, x2-x1, y2-y1)]
+
+    def _update_backing_store(self, clip_rect):
+        """Brings the backing store up to date with the view and model
+
+        :param tuple clip_rect: device area being drawn, (x, y, w, h)
+
+        The backing store holds the rendered document in device space.
+        For a fixed zoom, rotation and mirroring, a change in the view's
+        translation only moves the rendered pixels by whole device
+        pixels, so panning shifts ("blits") the existing pixels and
+        only renders the newly exposed strips.
+
+        Rendering is progressive. Blank areas get a quick render at a
+        coarser mipmap level straight away. Full-quality rendering then
+        happens in chunks, nearest the pointer first, until
+        `PROGRESSIVE_RENDER_TIME_BUDGET` has been used up. Chunks not
+        rendered keep showing their last pixels, and are finished off
+        in follow-up frames.
+
+        The mipmap level isn't part of what makes the whole store stale.
+        When panning defers high-quality rendering, the pixels already
+        rendered are kept and only the exposed strips are rendered at
+        the cheaper level. Chunks rendered at a coarser level than the
+        current one are re-rendered progressively once it comes back.
+
+        """
+        t0 = wallclock()
+        alloc = self.get_allocation()
+        w, h = alloc.width, alloc.height
+        matrix = self._get_model_view_transformation()
+        ox, oy = [int(round(c)) for c in matrix.transform_point(0, 0)]
+        mipmap_level = self._get_render_mipmap_level()
+        geom_key = (w, h, self.doc, self.scale, self.rotation, self.mirrored)
+        content_key = (self.display_filter, self.overlay_layer,
+                       self._draw_real_alpha_checks)
+        blank = []
+        stale = []
+        if self._backing is None or geom_key != self._backing_geom_key:
+            if (self._backing is None or self._backing.get_width() != w
+                    or self._backing.get_height() != h):
+                self._backing = cairo.ImageSurface(cairo.FORMAT_RGB24, w, h)
+                self._backing_spare = None
+            self._backing_geom_key = geom_key
+            self._backing_content_key = content_key
+            self._backing_pending.clear()
+            self._backing_levels.clear()
+            blank.append((0, 0, w, h))
+        else:
+            dx = ox - self._backing_origin[0]
+            dy = oy - self._backing_origin[1]
+            if abs(dx) >= w or abs(dy) >= h:
+                blank.append((0, 0, w, h))
+            elif dx or dy:
+                self._scroll_backing_store(dx, dy)
+                if dx > 0:
+                    blank.append((0, 0, dx, h))
+                elif dx < 0:
+                    blank.append((w+dx, 0, -dx, h))
+                if dy > 0:
+                    blank.append((0, 0, w, dy))
+                elif dy < 0:
+                    blank.append((0, h+dy, w, -dy))
+            if content_key != self._backing_content_key:
+                self._backing_content_key = content_key
+                stale.append((0, 0, w, h))
+            for model_rect in self._backing_invalid:
+                stale.append(self._model_to_display_bbox(*model_rect))
+        self._backing_origin = (ox, oy)
+        self._backing_invalid = []
+
+        # Blank areas can't wait: fill them in quickly at low quality.
+        pending = self._backing_pending
+        coarse_level = min(mipmap_level + PROGRESSIVE_RENDER_COARSE_LEVELS,
+                           tiledsurface.MAX_MIPMAP_LEVEL)
+        for rect in blank:
+            if coarse_level == mipmap_level:
+                stale.append(rect)
+                continue
+            self._render_into_backing_store(rect, coarse_level)
+            pending.update(self._get_backing_chunks(rect))
+        for rect in stale:
+            pending.update(self._get_backing_chunks(rect))
+        levels = self._backing_levels
+        pending.update(k for (k, l) in levels.iteritems() if l > mipmap_level)
+
+        # Forget chunks which have been scrolled out of view
+        c = PROGRESSIVE_RENDER_CHUNK_SIZE
+        cx1, cy1 = (-ox) // c, (-oy) // c
+        cx2, cy2 = (w - ox - 1) // c, (h - oy - 1) // c
+        for chunk in list(pending):
+            cx, cy = chunk
+            if not (cx1 <= cx <= cx2 and cy1 <= cy <= cy2):
+                pending.discard(chunk)
+        for chunk in list(levels):
+            cx, cy = chunk
+            if not (cx1 <= cx <= cx2 and cy1 <= cy <= cy2):
+                del levels[chunk]
+
+        # Full-quality rendering, nearest the focus point first
+        fx, fy = self._get_progressive_render_focus()
+        centers = {}
+        for (cx, cy) in pending:
+            centers[(cx, cy)] = (cx*c + ox + c/2.0, cy*c + oy + c/2.0)
+        order = sorted(
+            pending,
+            key = lambda k: (centers[k][0]-fx)**2 + (centers[k][1]-fy)**2,
+        )
+        redraw_rects = self._progressive_render_rects
+        rendered = False
+        for (cx, cy) in order:
+            if rendered and (wallclock() - t0) > PROGRESSIVE_RENDER_TIME_BUDGET:
+                break
+            rect = (cx*c + ox, cy*c + oy, c, c)
+            self._render_into_backing_store(rect, mipmap_level)
+            pending.discard((cx, cy))
+            levels[(cx, cy)] = mipmap_level
+            rendered = True
+            if self._frame_stats is not None:
+                self._frame_stats["chunks_rendered"] += 1
+            if not _rect_contains(clip_rect, rect):
+                redraw_rects.append(rect)
+
+        # Chunks rendered but not yet shown get drawn once the pending
+        # input has been handled, and so does the next chunk left over,
+        # which keeps the progressive rendering going.
+        for chunk in order:
+            if chunk in pending:
+                cx, cy = chunk
+                redraw_rects.append((cx*c + ox, cy*c + oy, c, c))
+                break
+        if redraw_rects:
+            if not self._progressive_render_idle_id:
+                self._progressive_render_idle_id = gobject.idle_add(
+                    self._progressive_render_idle_cb,
+                )
+
+    def _progressive_render_idle_cb(self):
+        """Queues redraws of the areas progressive rendering updated"""
+        self._progressive_render_idle_id = None
+        rects = self._progressive_render_rects
+        self._progressive_render_rects = []
+        alloc = self.get_allocation()
+        for x, y, w, h in rects:
+            x1, y1 = max(0, x), max(0, y)
+            x2, y2 = min(alloc.width, x+w), min(alloc.height, y+h)
+            if x2 > x1 and y2 > y1:
+                self.queue_draw_area(x1, y1, x2-x1, y2-y1)
+        return False
+
+    def _get_progressive_render_focus(self):
+        """Device position around which rendering is done first
+
+        This is the pointer if it is over the canvas, or the last
+        painting position if that is in view, or else the center.
+
+        """
+        alloc = self.get_allocation()
+        w, h = alloc.width, alloc.height
+        x, y = self.get_pointer()   # FIXME: deprecated in GTK3
+        if 0 <= x < w and 0 <= y < h:
+            return x, y
+        painting_pos = self._tdw.last_painting_pos
+        if painting_pos is not None:
+            x, y = self.model_to_display(*painting_pos)
+            if 0 <= x < w and 0 <= y < h:
+                return x, y
+        return w/2.0, h/2.0
+
+    def _get_backing_chunks(self, rect):
+        """Progressive rendering chunks overlapping a device area
+
+        Chunks are measured from the device position of the model
+        origin, so their keys don't change when the view pans.
+
+        """
+        x, y, w, h = rect
+        if w <= 0 or h <= 0:
+            return []
+        ox, oy = self._backing_origin
+        c = PROGRESSIVE_RENDER_CHUNK_SIZE
+        cx1, cy1 = (x - ox) // c, (y - oy) // c
+        cx2, cy2 = (x + w - 1 - ox) // c, (y + h - 1 - oy) // c
+        return [(cx, cy) for cx in xrange(cx1, cx2+1)
+                for cy in xrange(cy1, cy2+1)]
+
+    def _model_to_display_bbox(self, x, y, w, h):
+        """Device bbox of a model area, padded for filtering"""
+        corners = [(x, y), (x+w, y), (x, y+h), (x+w, y+h)]
+        corners = [self.model_to_display(x_, y_) for (x_, y_) in corners]
+        x, y, w, h = helpers.rotated_rectangle_bbox(corners)
+        return (x-2, y-2, w+4, h+4)
+
+    def _scroll_backing_store(self, dx, dy):
+        """Shifts the backing store's pixels by a whole-pixel offset
+
+        Cairo can't copy a surface onto itself reliably, so this draws
+        into a spare surface of the same size, and swaps the two.
+
+        """
+        src = self._backing
+        dst = self._backing_spare
+        if dst is None:
+            dst = cairo.ImageSurface(cairo.FORMAT_RGB24,
+                                     src.get_width(), src.get_height())
+        cr = cairo.Context(dst)
+        cr.set_operator(cairo.OPERATOR_SOURCE)
+        cr.set_source_surface(src, dx, dy)
+        cr.paint()
+        dst.flush()
+        self._backing = dst
+        self._backing_spare = src
+
+    def _render_into_backing_store(self, rect, mipmap_level):
+        """Renders the document into a device-space area of the backing"""
+        x, y, w, h = rect
+        x1, y1 = max(0, x), max(0, y)
+        x2 = min(self._backing.get_width(), x + w)
+        y2 = min(self._backing.get_height(), y + h)
+        if x2 <= x1 or y2 <= y1:
+            return
+        cr = cairo.Context(self._backing)
+        cr.rectangle(x1, y1, x2-x1, y2-y1)
+        cr.clip()
+        cr.set_operator(cairo.OPERATOR_SOURCE)
+        render_info = self.render_prepare(cr, None, mipmap_level)
+        self.render_execute(cr, *render_info)
+        cr.restore()  # CONTEXT2<<<
+        cr.restore()  # CONTEXT1<<<
+        self._backing.flush()
+
     def scroll(self, dx, dy, ongoing=True):
         self.translation_x -= dx
         self.translation_y -= dy
         if ongoing:
             self.defer_hq_rendering()
+        # The backing store is blitted once per redraw rather than
+        # once per motion event, and then only the exposed strips are
+        # rendered. See _update_backing_store().
         self.queue_draw()
 
-        # This speeds things up nicely when scrolling is already
-        # fast, but produces temporary artefacts and an
-        # annoyingly non-constant framerate otherwise.
-        #self.window.scroll(int(-dx), int(-dy))
-        # It might be worth it if it was done only once per
-        # redraw, instead of once per motion event. Maybe try to
-        # implement something like "queue_scroll" with priority
-        # similar to redraw? (The GTK commit responsible for bug
-        # http://bugzilla.gnome.org/show_bug.cgi?id=702392 might
-        # solve this problem, I think.)
-
     def get_center(self):
         """Return the center position in display coordinates.
         """
@@ -1124,7 +1561,12 @@ class CanvasRenderer(gtk.DrawingArea, DrawCursorMixin):
         However it's slow enough to make rendering
         lag appreciably when scrolling.
 
+        This does nothing in the "fractional" mipmap mode,
+        which has a steady cost: see `_get_render_mipmap_level()`.
+
         """
+        if self._mipmap_mode == "fractional":
+            return
         if self._restore_hq_rendering_timeout_id:
             glib.source_remove(self._restore_hq_rendering_timeout_id)
             self._restore_hq_rendering_timeout_id = None
@@ -1147,6 +1589,21 @@ class CanvasRenderer(gtk.DrawingArea, DrawCursorMixin):
 ## Testing
 
 
+def _rect_contains(outer, inner):
+    """True if rectangle `outer` contains `inner`, both (x, y, w, h)
+
+    >>> _rect_contains((0, 0, 10, 10), (2, 2, 8, 8))
+    True
+    >>> _rect_contains((0, 0, 10, 10), (2, 2, 9, 8))
+    False
+
+    """
+    ox, oy, ow, oh = outer
+    ix, iy, iw, ih = inner
+    return (ox <= ix and oy <= iy
+            and ix + iw <= ox + ow and iy + ih <= oy + oh)
+
+
 def _make_testbed_model():
     import lib.brush
     import lib.document
@@ -0,0 +1,348 @@
+# This file is part of MyPaint.
+# Copyright (C) 2015 by the MyPaint Development Team
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+
+"""Headless rendering of documents to image files
+
+This renders OpenRaster, PNG, or JPEG documents to PNG or JPEG images
+without any windows, using `lib.document.Document`. It is intended for
+making previews of many files in batch jobs, for example:
+
+    python -m lib.batchrender -o previews/ -m 2 -f jpeg art/*.ora
+
+Layers can be hidden or shown by name (with shell-style wildcards), the
+area to render can be set explicitly, and the output can be split into
+tiles of a fixed size. Files are rendered in parallel by a pool of
+worker processes.
+
+"""
+
+
+## Imports
+
+import os
+import sys
+import fnmatch
+import multiprocessing
+from optparse import OptionParser
+import logging
+logger = logging.getLogger(__name__)
+
+import lib.document
+import lib.pixbuf
+from lib.errors import FileHandlingError
+from lib.errors import AllocationError
+
+
+## Constants
+
+#: Output formats, and their filename extensions
+OUTPUT_FORMATS = {
+    "png": ".png",
+    "jpeg": ".jpg",
+}
+
+
+## Class defs
+
+
+class RenderJob (object):
+    """What to render from a single document, and where to
+
+    Instances are picklable so that they can be sent to worker
+    processes.
+
+    """
+
+    def __init__(self, filename, output, format="png", frame=None,
+                 mipmap_level=0, hide=(), show=(), background=True,
+                 tile_size=None, quality=90):
+        """Initialize
+
+        :param unicode filename: the document to load
+        :param unicode output: output path; tiles are suffixed
+        :param str format: "png" or "jpeg"
+        :param tuple frame: model area to render, (x, y, w, h).
+          Default: the document's frame if enabled, else its bbox.
+        :param int mipmap_level: render at 1/2**mipmap_level size
+        :param hide: layer name patterns to hide
+        :param show: layer name patterns to show (after hiding)
+        :param bool background: render the background layer
+        :param int tile_size: split the output into tiles this big
+        :param int quality: JPEG quality, 0-100
+
+        """
+        super(RenderJob, self).__init__()
+        if format not in OUTPUT_FORMATS:
+            raise ValueError("Unknown output format %r" % (format,))
+        self.filename = filename
+        self.output = output
+        self.format = format
+        self.frame = frame
+        self.mipmap_level = int(mipmap_level)
+        self.hide = tuple(hide)
+        self.show = tuple(show)
+        self.background = bool(background)
+        self.tile_size = tile_size
+        self.quality = quality
+
+    def __repr__(self):
+        return "<RenderJob %r -> %r>" % (self.filename, self.output)
+
+    def run(self):
+        """Loads the document, and renders it
+
+        :returns: the list of files written
+
+        """
+        doc = lib.document.Document()
+        try:
+            doc.load(self.filename)
+            self._set_layer_visibility(doc.layer_stack)
+            return self._render(doc)
+        finally:
+            doc.cleanup()
+
+    def _set_layer_visibility(self, root):
+        """Applies the hide and show patterns to the loaded layers"""
+        for patterns, visible in [(self.hide, False), (self.show, True)]:
+            if not patterns:
+                continue
+            for path, layer in root.walk():
+                name = layer.name or u""
+                if any(fnmatch.fnmatchcase(name, p) for p in patterns):
+                    layer.visible = visible
+        root.background_visible = self.background
+
+    def _get_areas(self, doc):
+        """Yields (suffix, x, y, w, h) areas to render, at mipmap size
+
+        >>> job = RenderJob("in.ora", "out.png", frame=(0, 0, 100, 70),
+        ...                 tile_size=64)
+        >>> for area in job._get_areas(None):
+        ...     print area
+        (u'_0_0', 0, 0, 64, 64)
+        (u'_1_0', 64, 0, 36, 64)
+        (u'_0_1', 0, 64, 64, 6)
+        (u'_1_1', 64, 64, 36, 6)
+        >>> job.tile_size = None
+        >>> job.mipmap_level = 1
+        >>> list(job._get_areas(None))
+        [(u'', 0, 0, 50, 35)]
+
+        """
+        if self.frame is not None:
+            x, y, w, h = self.frame
+        else:
+            x, y, w, h = doc.get_effective_bbox()
+        if w <= 0 or h <= 0:
+            x, y, w, h = 0, 0, lib.document.N, lib.document.N
+        level = self.mipmap_level
+        x, y = x >> level, y >> level
+        w, h = max(1, w >> level), max(1, h >> level)
+        if not self.tile_size:
+            yield (u"", x, y, w, h)
+            return
+        size = int(self.tile_size)
+        for row, ty in enumerate(xrange(y, y+h, size)):
+            for col, tx in enumerate(xrange(x, x+w, size)):
+                tw = min(size, x+w-tx)
+                th = min(size, y+h-ty)
+                yield (u"_%d_%d" % (col, row), tx, ty, tw, th)
+
+    def _render(self, doc):
+        root = doc.layer_stack
+        alpha = not self.background
+        stem, ext = os.path.splitext(self.output)
+        if not ext:
+            ext = OUTPUT_FORMATS[self.format]
+        written = []
+        for suffix, x, y, w, h in self._get_areas(doc):
+            output = stem + suffix + ext
+            if self.format == "png":
+                root.save_as_png(
+                    output, x, y, w, h,
+                    alpha = alpha,
+                    render_background = self.background,
+                    mipmap_level = self.mipmap_level,
+                )
+            else:
+                pixbuf = root.render_as_pixbuf(
+                    x, y, w, h,
+                    alpha = False,
+                    render_background = self.background,
+                    mipmap_level = self.mipmap_level,
+                )
+                lib.pixbuf.save(pixbuf, output, "jpeg",
+                                quality=str(self.quality))
+            written.append(output)
+        return written
+
+
+## Worker pool
+
+
+def _run_job(job):
+    """Runs a job in a worker process, returning (job, files, error)"""
+    try:
+        return (job, job.run(), None)
+    except (FileHandlingError, AllocationError, IOError) as e:
+        return (job, [], unicode(e))
+    except Exception as e:
+        logger.exception("Failed to render %r", job.filename)
+        return (job, [], repr(e))
+
+
+def run_jobs(jobs, nworkers=None):
+    """Runs render jobs in parallel, yielding results as they finish
+
+    :param list jobs: the RenderJobs to run
+    :param int nworkers: number of worker processes; default: one per CPU
+    :returns: iterator yielding (job, files_written, error_or_None)
+
+    Separate processes are used rather than `lib.workerpool` threads:
+    loading and rendering a document runs a lot of Python code which
+    holds the GIL, and one broken file can't upset the others.
+
+    """
+    if nworkers == 1 or len(jobs) <= 1:
+        for job in jobs:
+            yield _run_job(job)
+        return
+    pool = multiprocessing.Pool(processes=nworkers)
+    try:
+        for result in pool.imap_unordered(_run_job, jobs):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
+
+
+## Command line
+
+
+def get_output_names(filenames, ext):
+    """Output filenames for some inputs, relative to the output dir
+
+    :param list filenames: the input files
+    :param str ext: extension for the outputs, e.g. ".png"
+    :returns: a list of relative output filenames, one per input
+
+    Outputs are normally named after the inputs' basenames:
+
+    >>> get_output_names(["art/a.ora", "art/b.png"], ".png")
+    ['a.png', 'b.png']
+
+    If two inputs have the same basename, each output keeps its
+    input's directory relative to the directory the inputs share,
+    so that the workers can't overwrite each other's files:
+
+    >>> get_output_names(["art/a/x.ora", "art/b/x.ora", "y.ora"], ".jpg")
+    ['art/a/x.jpg', 'art/b/x.jpg', 'y.jpg']
+
+    Names which would still collide get a numeric suffix:
+
+    >>> get_output_names(["x.ora", "x.png", "x.ora"], ".png")
+    ['x.png', 'x_1.png', 'x_2.png']
+
+    """
+    stems = [os.path.splitext(os.path.basename(f))[0] for f in filenames]
+    if len(set(stems)) < len(stems):
+        dirs = [os.path.dirname(os.path.abspath(f)) for f in filenames]
+        common = os.path.commonprefix([d.split(os.sep) for d in dirs])
+        common = os.sep.join(common) or os.sep
+        for i, d in enumerate(dirs):
+            rel = os.path.relpath(d, common)
+            if rel != os.curdir:
+                stems[i] = os.path.join(rel, stems[i])
+    names = []
+    used = set()
+    for stem in stems:
+        name = stem + ext
+        n = 0
+        while name in used:
+            n += 1
+            name = "%s_%d%s" % (stem, n, ext)
+        used.add(name)
+        names.append(name)
+    return names
+
+
+def _parse_frame(option, opt_str, value, parser):
+    try:
+        frame = tuple(int(v) for v in value.split(","))
+        assert len(frame) == 4
+    except (ValueError, AssertionError):
+        raise parser.error("%s needs X,Y,W,H" % (opt_str,))
+    parser.values.frame = frame
+
+
+def main(argv=None):
+    """Command-line entry point"""
+    parser = OptionParser("usage: %prog [options] FILE [FILE ...]")
+    parser.add_option("-o", "--output-dir", metavar="DIR", default=".",
+                      help="write images to DIR (default: current dir)")
+    parser.add_option("-f", "--format", choices=sorted(OUTPUT_FORMATS),
+                      default="png", help="png or jpeg (default: png)")
+    parser.add_option("-q", "--quality", type="int", default=90,
+                      help="JPEG quality (default: 90)")
+    parser.add_option("-m", "--mipmap", type="int", default=0,
+                      metavar="L", help="render at 1/2**L size")
+    parser.add_option("--frame", type="string", action="callback",
+                      callback=_parse_frame, metavar="X,Y,W,H",
+                      help="model area to render (default: doc frame)")
+    parser.add_option("--hide", action="append", default=[],
+                      metavar="NAME", help="hide layers matching NAME")
+    parser.add_option("--show", action="append", default=[],
+                      metavar="NAME", help="show layers matching NAME")
+    parser.add_option("--no-background", action="store_false",
+                      dest="background", default=True,
+                      help="render without the background layer")
+    parser.add_option("-t", "--tile-size", type="int", metavar="PX",
+                      help="write tiles of PX by PX pixels")
+    parser.add_option("-j", "--jobs", type="int", metavar="N",
+                      help="render N files at once (default: CPUs)")
+    parser.set_defaults(frame=None)
+    options, filenames = parser.parse_args(argv)
+    if not filenames:
+        parser.print_help()
+        return 1
+
+    jobs = []
+    names = get_output_names(filenames, OUTPUT_FORMATS[options.format])
+    for filename, name in zip(filenames, names):
+        output = os.path.join(options.output_dir, name)
+        jobs.append(RenderJob(
+            filename, output,
+            format = options.format,
+            frame = options.frame,
+            mipmap_level = options.mipmap,
+            hide = options.hide,
+            show = options.show,
+            background = options.background,
+            tile_size = options.tile_size,
+            quality = options.quality,
+        ))
+    for job in jobs:
+        output_dir = os.path.dirname(job.output)
+        if output_dir and not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+
+    failures = 0
+    for job, written, error in run_jobs(jobs, options.jobs):
+        if error:
+            failures += 1
+            print >>sys.stderr, "%s: %s" % (job.filename, error)
+        else:
+            print "%s: wrote %d file(s)" % (job.filename, len(written))
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    sys.exit(main())
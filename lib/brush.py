@@ -8,6 +8,7 @@
 
 import mypaintlib
 import helpers
+from cache import LRUCache
 
 import urllib
 import copy
@@ -27,6 +28,9 @@ OLDFORMAT_BRUSHFILE_VERSION = 2
 BRUSH_SETTINGS = set([s.cname for s in brushsettings.settings])
 ALL_SETTINGS = BRUSH_SETTINGS.union(STRING_VALUE_SETTINGS)
 
+#: Number of parsed settings strings kept by get_cached_brushinfo()
+SETTINGS_CACHE_SIZE = 32
+
 
 def brushinfo_quote(string):
     """Quote a string for serialisation of brushes.
@@ -486,10 +490,21 @@ class Brush (mypaintlib.PythonBrush):
 
     """
 
-    def __init__(self, brushinfo):
+    def __init__(self, brushinfo, observe=True):
+        """Initialize from a BrushInfo
+
+        :param BrushInfo brushinfo: Settings to use
+        :param bool observe: Track future changes to brushinfo
+
+        Pass ``observe=False`` for short-lived brushes made from a
+        shared, unchanging BrushInfo, such as the ones returned by
+        `get_cached_brushinfo()`. This avoids leaking observers.
+
+        """
         super(Brush, self).__init__()
         self.brushinfo = brushinfo
-        brushinfo.observers.append(self._update_from_brushinfo)
+        if observe:
+            brushinfo.observers.append(self._update_from_brushinfo)
         self._update_from_brushinfo(ALL_SETTINGS)
 
     def _update_from_brushinfo(self, settings):
@@ -512,6 +527,60 @@ class Brush (mypaintlib.PythonBrush):
                 self.set_mapping_point(setting.index, input.index, i, x, y)
 
 
+## Settings string cache
+
+_settings_cache = LRUCache(capacity=SETTINGS_CACHE_SIZE)
+
+
+def _get_cache_entry(settings_str):
+    """Internal: cached (settings_str, BrushInfo) pair for a string"""
+    entry = _settings_cache.get(settings_str)
+    if entry is None:
+        entry = (settings_str, BrushInfo(settings_str))
+        _settings_cache[settings_str] = entry
+    return entry
+
+
+def get_cached_brushinfo(settings_str):
+    """Returns a shared, parsed BrushInfo for a settings string
+
+    :param str settings_str: Serialized brush settings
+    :rtype: BrushInfo
+
+    Parsing is done at most once for each distinct string while it
+    remains in the bounded cache. The returned object is shared, and
+    must not be modified. Clone it if you need to make changes.
+
+    >>> bi = BrushInfo()
+    >>> s1 = bi.save_to_string()
+    >>> get_cached_brushinfo(s1) is get_cached_brushinfo(s1[:])
+    True
+
+    """
+    return _get_cache_entry(settings_str)[1]
+
+
+def intern_settings_string(settings_str):
+    """Returns a canonical, shared copy of a settings string
+
+    :param str settings_str: Serialized brush settings
+    :rtype: str
+
+    Strokes recorded with the same brush settings can use this to share
+    a single string object in memory.
+
+    >>> bi = BrushInfo()
+    >>> s1 = bi.save_to_string()
+    >>> s2 = "".join(list(s1))
+    >>> s1 is s2
+    False
+    >>> intern_settings_string(s2) is intern_settings_string(s1)
+    True
+
+    """
+    return _get_cache_entry(settings_str)[0]
+
+
 if __name__ == "__main__":
     import doctest
     doctest.testmod()
@@ -71,3 +71,11 @@ class LRUCache (object):
             while len(self._cache) >= self._capacity:
                 self._cache.popitem(last=False)
         self._cache[key] = item
+
+    def pop(self, key, default=None):
+        """Removes an item, returning it (or default if it's absent)
+
+        Removal doesn't count as a cache hit or miss.
+
+        """
+        return self._cache.pop(key, default)
@@ -536,6 +536,35 @@ class TrimLayer (Command):
         layer.load_snapshot(self.before)
 
 
+class CropToFrame (Command):
+    """Trim every layer in the document to the document frame"""
+
+    display_name = _("Crop to Frame")
+
+    def __init__(self, doc, **kwds):
+        super(CropToFrame, self).__init__(doc, **kwds)
+        self.before = None
+
+    def redo(self):
+        layers = self.doc.layer_stack
+        frame = self.doc.get_frame()
+        self.before = []
+        for path, layer in layers.walk():
+            if isinstance(layer, lib.layer.LayerStack):
+                continue
+            if not layer.get_trimmable():
+                continue
+            # Snapshots share tile data with the layer until it's
+            # written to, so only the trimmed edges get copied.
+            self.before.append((layer, layer.save_snapshot()))
+            layer.trim(frame)
+
+    def undo(self):
+        for layer, snapshot in reversed(self.before):
+            layer.load_snapshot(snapshot)
+        self.before = None
+
+
 class ClearLayer (Command):
     """Clears the current layer"""
 
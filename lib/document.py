@@ -43,6 +43,7 @@ import layer
 import brush
 from observable import event
 import lib.pixbuf
+import lib.cache
 from lib.errors import FileHandlingError
 from lib.errors import AllocationError
 import lib.idletask
@@ -140,9 +141,7 @@ class AutosaveInfo (namedtuple("AutosaveInfo", _AUTOSAVE_INFO_FIELDS)):
                 width = max(0, int(image_elem.attrib.get('w', 0)))
                 height = max(0, int(image_elem.attrib.get('h', 0)))
                 num_layers = max(0, len(image_elem.findall(".//layer")) - 1)
-        thumbnail = None
-        if os.path.exists(thumbnail_path):
-            thumbnail = lib.pixbuf.load_from_file(thumbnail_path)
+        thumbnail = _load_autosave_thumbnail(thumbnail_path)
         cache_in_use = False
         cache_dir_path = os.path.dirname(path)
         activity_file_path = os.path.join(cache_dir_path, CACHE_ACTIVITY_FILE)
@@ -269,6 +268,7 @@ class Document (object):
         self._autosave_processor = None
         self._autosave_countdown_id = None
         self._autosave_dirty = False
+        self._autosave_thumbnail = None
         if not painting_only:
             self._autosave_processor = lib.idletask.Processor()
             self.command_stack.stack_updated += self._command_stack_updated_cb
@@ -518,10 +518,10 @@ class Document (object):
         # This is a (very) local extension to the format.
         t_str = "{:3f}".format(self.unsaved_painting_time)
         image_elem.attrib['mypaint_unsaved_painting_time'] = t_str
-        # Thumbnail generation.
-        rootstack_sshot = self.layer_stack.save_snapshot()
-        rootstack_clone = layer.RootLayerStack(doc=None)
-        rootstack_clone.load_snapshot(rootstack_sshot)
+        # Thumbnail generation. The thumbnail is rendered now, so that it
+        # matches the layers being saved. This is cheap because the layer
+        # stack only updates the parts changed since its last thumbnail.
+        thumbnail = self.layer_stack.render_thumbnail(image_bbox)
         thumbdir_rel = "Thumbnails"
         thumbdir = os.path.join(oradir, thumbdir_rel)
         if not os.path.exists(thumbdir):
@@ -530,8 +530,7 @@ class Document (object):
         thumbfile_rel = os.path.join(thumbdir_rel, thumbfile_basename)
         taskproc.add_work(
             self._autosave_thumbnail_cb,
-            rootstack_clone,
-            image_bbox,
+            thumbnail,
             os.path.join(thumbdir, thumbfile_basename)
         )
         manifest.add(thumbfile_rel)
@@ -550,19 +549,21 @@ class Document (object):
             manifest = manifest,
         )
 
-    def _autosave_thumbnail_cb(self, rootstack, bbox, filename):
+    def _autosave_thumbnail_cb(self, thumbnail, filename):
         """Autosaved backup task: write Thumbnails/thumbnail.png
 
-        This runs every time currently for the same reason we rewrite
-        stack.xml each time. It would be a big win if we didn't have to
-        do this though.
+        The file is only rewritten if the thumbnail is actually
+        different from the one last written.
 
         """
         assert not self._painting_only
-        thumbnail = rootstack.render_thumbnail(bbox)
+        if thumbnail is self._autosave_thumbnail:
+            if os.path.exists(filename):
+                return False
         tmpname = filename + u".TMP"
         lib.pixbuf.save(thumbnail, tmpname)
         lib.fileutils.replace(tmpname, filename)
+        self._autosave_thumbnail = thumbnail
         return False
 
     def _autosave_stackxml_cb(self, image_elem, filename):
@@ -742,6 +743,16 @@ class Document (object):
             return
         self.do(command.TrimLayer(self))
 
+    def crop_to_frame(self):
+        """Trim all layers to the extent of the document frame
+
+        This has no effect if the frame is not currently enabled.
+
+        """
+        if not self._frame_enabled:
+            return
+        self.do(command.CropToFrame(self))
+
     @event
     def effective_bbox_changed(self):
         """Event: the effective bounding box was changed"""
@@ -864,6 +875,22 @@ class Document (object):
         :param make_new_layer: Write output to a new layer on top
         :type make_new_layer: bool
 
+        The fill is limited to `get_flood_fill_bbox()`.
+        """
+        bbox = self.get_flood_fill_bbox(x, y)
+        if not self.layer_stack.current.get_fillable():
+            make_new_layer = True
+        cmd = command.FloodFill(self, x, y, color, bbox, tolerance,
+                                sample_merged, make_new_layer)
+        self.do(cmd)
+
+    def get_flood_fill_bbox(self, x, y):
+        """Returns the limits of a flood fill starting at a point
+
+        :param x: Starting point X coordinate
+        :param y: Starting point Y coordinate
+        :rtype: lib.helpers.Rect
+
         Filling an infinite canvas requires limits. If the frame is
         enabled, this limits the maximum size of the fill, and filling
         outside the frame is not possible.
@@ -875,8 +902,6 @@ class Document (object):
         rapidly as needed on blank layers.
         """
         bbox = helpers.Rect(*tuple(self.get_effective_bbox()))
-        if not self.layer_stack.current.get_fillable():
-            make_new_layer = True
         if bbox.empty():
             bbox = helpers.Rect()
             bbox.x = N*int(x//N)
@@ -885,9 +910,20 @@ class Document (object):
             bbox.h = N
         elif not self.frame_enabled:
             bbox.expandToIncludePoint(x, y)
-        cmd = command.FloodFill(self, x, y, color, bbox, tolerance,
-                                sample_merged, make_new_layer)
-        self.do(cmd)
+        return bbox
+
+    def get_flood_fill_source(self, sample_merged=False):
+        """Returns what a flood fill samples, as flood_fill() would
+
+        :param sample_merged: Use all visible layers when sampling
+        :type sample_merged: bool
+        :returns: an object supporting readonly tile_request(), or None
+
+        See `lib.layer.LayerBase.get_fill_source()`.
+        """
+        if sample_merged:
+            return self.layer_stack.get_fill_source()
+        return self.layer_stack.current.get_fill_source()
 
     ## Graphical refresh
 
@@ -983,12 +1019,7 @@ class Document (object):
         the layers. It disregards the user-chosen frame.
 
         """
-        res = helpers.Rect()
-        for layer in self.layer_stack.deepiter():
-            # OPTIMIZE: only visible layers?
-            bbox = layer.get_bbox()
-            res.expandToIncludeRect(bbox)
-        return res
+        return self.layer_stack.get_bbox()
 
     def get_full_redraw_bbox(self):
         """Returns the full-redraw bounding box of the document
@@ -1668,6 +1699,30 @@ def get_app_cache_root():
     return app_cache_root
 
 
+#: Decoded autosave thumbnails, keyed by path and modification time
+_AUTOSAVE_THUMBNAILS = lib.cache.LRUCache(capacity=32)
+
+
+def _load_autosave_thumbnail(path):
+    """Loads an autosave's thumbnail, or returns None if it has none
+
+    Autosaves only rewrite their thumbnail if it has changed, so
+    listings of the available autosaves reuse earlier decodes for the
+    ones which have not changed since the last listing.
+
+    """
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError:
+        return None
+    key = (path, mtime)
+    thumbnail = _AUTOSAVE_THUMBNAILS.get(key)
+    if thumbnail is None:
+        thumbnail = lib.pixbuf.load_from_file(path)
+        _AUTOSAVE_THUMBNAILS[key] = thumbnail
+    return thumbnail
+
+
 def get_available_autosaves():
     """Get all known autosaves
 
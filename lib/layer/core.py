@@ -613,6 +613,16 @@ class LayerBase (TileBlittable, TileCompositable):
         """
         pass
 
+    def get_fill_source(self):
+        """Returns what flood fills starting in this layer sample
+
+        :returns: an object supporting readonly tile_request(), or None
+
+        The base implementation returns None: nothing is sampled.
+
+        """
+        return None
+
     ## Rendering
 
     def get_tile_coords(self):
@@ -1301,8 +1301,25 @@ class PaintingLayer (SurfaceBackedLayer, core.ExternallyEditable):
         self._surface.flood_fill(x, y, color, bbox, tolerance,
                                  dst_surface=dst_layer._surface)
 
+    def get_fill_source(self):
+        """Flood fills sample this layer's own surface"""
+        return self._surface
+
     ## Painting
 
+    def begin_atomic(self):
+        """Begin a batch of painting operations
+
+        Calls to `stroke_to()` or `render_strokes()` made between this
+        and the matching `end_atomic()` are coalesced into a single
+        redraw notification. Pairs of calls may be nested.
+        """
+        self._surface.begin_atomic()
+
+    def end_atomic(self):
+        """End a batch of painting operations, notifying observers"""
+        self._surface.end_atomic()
+
     def stroke_to(self, brush, x, y, pressure, xtilt, ytilt, dtime):
         """Render a part of a stroke to the canvas surface
 
@@ -1339,7 +1356,25 @@ class PaintingLayer (SurfaceBackedLayer, core.ExternallyEditable):
         :param stroke: The stroke to render
         :type stroke: lib.stroke.Stroke
         """
-        stroke.render(self._surface)
+        self.render_strokes([stroke])
+
+    def render_strokes(self, strokes):
+        """Render a sequence of captured strokes to the canvas
+
+        :param strokes: The strokes to render, in painting order
+        :type strokes: iterable of lib.stroke.Stroke
+
+        All the strokes are replayed in a single atomic section, with
+        each stroke's events passed to the brush engine in one call.
+        Observers are notified once, for the combined area changed.
+        """
+        surface = self._surface
+        surface.begin_atomic()
+        try:
+            for stroke in strokes:
+                stroke.render_dabs(surface.backend)
+        finally:
+            surface.end_atomic()
         self.autosave_dirty = True
 
     def add_stroke_shape(self, stroke, before):
@@ -1620,15 +1655,12 @@ class PaintingLayerMove (SurfaceBackedLayerMove):
         super(PaintingLayerMove, self).cleanup()
         dx = self._final_dx
         dy = self._final_dy
-        # Arrange for the strokemap to be moved too;
-        # this happens in its own background idler.
-        for stroke in self._layer.strokes:
-            stroke.translate(dx, dy)
-            # Minor problem: huge strokemaps take a long time to move, and the
-            # translate must be forced to completion before drawing or any
-            # further layer moves. This can cause apparent hangs for no
-            # reason later on. Perhaps it would be better to process them
-            # fully in this hourglass-cursor phase after all?
+        # Arrange for the strokemap to be moved too. Like the surface,
+        # it's untouched during the drag, and its tiles are moved in the
+        # worker pool now. Anything needing them waits for just those.
+        if dx or dy:
+            for stroke in self._layer.strokes:
+                stroke.translate(dx, dy)
         # The tile memory is the canonical source of a painting layer,
         # so we'll need to autosave it.
         self._layer.autosave_dirty = True
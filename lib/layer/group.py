@@ -67,6 +67,7 @@ class LayerStack (core.LayerBase, lib.autosave.Autosaveable):
     def __init__(self, **kwargs):
         """Initialize, with no sub-layers"""
         self._layers = []  # must be done before supercall
+        self._bbox_cache = None  # (content generation, bbox)
         super(LayerStack, self).__init__(**kwargs)
         # Blank background, for use in rendering
         N = tiledsurface.N
@@ -333,12 +334,30 @@ class LayerStack (core.LayerBase, lib.autosave.Autosaveable):
     ## Info methods
 
     def get_bbox(self):
-        """Returns the inherent (data) bounding box of the stack"""
+        """Returns the inherent (data) bounding box of the stack
+
+        Within a tree, the union of the sublayers' bounding boxes is
+        remembered until the root's content generation changes.
+
+        """
+        generation = self._get_content_generation()
+        cached = self._bbox_cache
+        if generation is not None and cached and cached[0] == generation:
+            return cached[1].copy()
         result = helpers.Rect()
         for layer in self._layers:
             result.expandToIncludeRect(layer.get_bbox())
+        if generation is not None:
+            self._bbox_cache = (generation, result.copy())
         return result
 
+    def _get_content_generation(self):
+        """The root's content generation, or None if not in a tree"""
+        root = self.root
+        if root is None:
+            return None
+        return root.content_generation
+
     def get_full_redraw_bbox(self):
         """Returns the full update notification bounding box of the stack"""
         result = super(LayerStack, self).get_full_redraw_bbox()
@@ -445,10 +464,14 @@ class LayerStack (core.LayerBase, lib.autosave.Autosaveable):
         """
         assert dst_layer is not self
         assert dst_layer is not None
-        src = lib.surface.TileRequestWrapper(self)
+        src = self.get_fill_source()
         dst = dst_layer._surface
         tiledsurface.flood_fill(src, x, y, color, bbox, tolerance, dst)
 
+    def get_fill_source(self):
+        """Flood fills sample the stack's composited tiles"""
+        return lib.surface.TileRequestWrapper(self)
+
     def get_fillable(self):
         """False! Stacks can't be filled interactively or directly."""
         return False
@@ -556,11 +579,15 @@ class LayerStackSnapshot (core.LayerBaseSnapshot):
     def restore_to_layer(self, layer):
         super(LayerStackSnapshot, self).restore_to_layer(layer)
         layer._layers = []
+        layer._bbox_cache = None
         for layer_class, snap in zip(self.layer_classes,
                                      self.layer_snaps):
             child = layer_class()
             child.load_snapshot(snap)
             layer._layers.append(child)
+        root = layer.root
+        if root is not None:
+            root._invalidate_walk_index()
 
 
 class LayerStackMove (object):
@@ -15,11 +15,13 @@
 from gi.repository import GdkPixbuf
 
 import re
+import contextlib
 import numpy
 import logging
 logger = logging.getLogger(__name__)
 from warnings import warn
 from copy import deepcopy
+from time import time
 import os.path
 
 from lib.gettext import C_
@@ -28,7 +30,9 @@ import lib.tiledsurface as tiledsurface
 import lib.helpers as helpers
 from lib.observable import event
 import lib.pixbuf
+import lib.pixbufsurface
 import lib.cache
+import lib.surface
 from lib.modes import *
 import data
 import group
@@ -94,6 +98,10 @@ class RootLayerStack (group.LayerStack):
     INITIAL_MODE = lib.mypaintlib.CombineNormal
     PERMITTED_MODES = {INITIAL_MODE}
 
+    #: Content changes touching more tiles than this clear the render
+    #: cache, rather than invalidating it tile by tile.
+    _RENDER_CACHE_MAX_INVALIDATED_TILES = 256
+
 
     ## Initialization
 
@@ -103,9 +111,15 @@ class RootLayerStack (group.LayerStack):
         :param doc: The model document. May be None for testing.
         :type doc: lib.document.Document
         """
+        self._walk_index = None  # must be done before supercall
         super(RootLayerStack, self).__init__(**kwargs)
         self.doc = doc
         self._render_cache = lib.cache.LRUCache()
+        self._filtered_render_cache = lib.cache.LRUCache(capacity=512)
+        # Content generation count, and the last thumbnail rendered
+        # for each set of rendering options
+        self._content_generation = 0
+        self._thumbnail_caches = {}
         # Background
         default_bg = (255, 255, 255)
         self._default_background = default_bg
@@ -120,13 +134,84 @@ class RootLayerStack (group.LayerStack):
         # Current layer
         self._current_path = ()
         # Self-observation
-        self.layer_content_changed += self._clear_render_cache
+        self.layer_content_changed += self._invalidate_render_cache_area
         self.layer_properties_changed += self._clear_render_cache
         self.layer_deleted += self._clear_render_cache
         self.layer_inserted += self._clear_render_cache
 
+    @property
+    def content_generation(self):
+        """Count of changes to the tree's content or structure
+
+        This increases every time the layer content changes, or layers
+        are added, removed, or have their properties changed. It can be
+        used to tell whether something derived from the tree is stale.
+
+        """
+        return self._content_generation
+
+    def _get_content_generation(self):
+        return self._content_generation
+
     def _clear_render_cache(self, *_ignored):
         self._render_cache.clear()
+        self._filtered_render_cache.clear()
+        self._content_generation += 1
+        for thumb in self._thumbnail_caches.itervalues():
+            thumb.dirty_tiles = None
+
+    def _get_walk_index(self):
+        """The flattened walk order of the tree, built on demand"""
+        index = self._walk_index
+        if index is None:
+            index = _WalkIndex(self)
+            self._walk_index = index
+        return index
+
+    def _invalidate_walk_index(self):
+        """Drops the flattened walk order after a structure change"""
+        self._walk_index = None
+
+    def _invalidate_render_cache_area(self, root, layer, x, y, w, h):
+        """Drops cached renders of the tiles a content change touches
+
+        The render cache is shared by all views of the document, at all
+        mipmap levels, so invalidating it tile by tile means that
+        unrelated tiles needn't be composited again by every view.
+        Large or unbounded changes just clear the whole cache.
+
+        """
+        if w <= 0 or h <= 0:
+            self._clear_render_cache()
+            return
+        N = tiledsurface.N
+        tx1, ty1 = int(x) // N, int(y) // N
+        tx2, ty2 = int(x + w - 1) // N, int(y + h - 1) // N
+        ntiles = (tx2 - tx1 + 1) * (ty2 - ty1 + 1)
+        if ntiles > self._RENDER_CACHE_MAX_INVALIDATED_TILES:
+            self._clear_render_cache()
+            return
+        self._content_generation += 1
+        for thumb in self._thumbnail_caches.itervalues():
+            if thumb.dirty_tiles is None:
+                continue
+            thumb.dirty_tiles.update(
+                (tx, ty)
+                for ty in xrange(ty1, ty2 + 1)
+                for tx in xrange(tx1, tx2 + 1)
+            )
+            if len(thumb.dirty_tiles) > _ThumbnailCache.MAX_DIRTY_TILES:
+                thumb.dirty_tiles = None
+        caches = (self._render_cache, self._filtered_render_cache)
+        flags = [(a, b) for a in (False, True) for b in (False, True)]
+        for level in xrange(tiledsurface.MAX_MIPMAP_LEVEL + 1):
+            for ty in xrange(ty1 >> level, (ty2 >> level) + 1):
+                for tx in xrange(tx1 >> level, (tx2 >> level) + 1):
+                    for dst_has_alpha, render_background in flags:
+                        key = (tx, ty, dst_has_alpha, level,
+                               render_background)
+                        for cache in caches:
+                            cache.pop(key)
 
     def clear(self):
         """Clear the layer and set the default background"""
@@ -236,7 +321,7 @@ class RootLayerStack (group.LayerStack):
             yield layer
 
     def render_into(self, surface, tiles, mipmap_level, overlay=None,
-                    opaque_base_tile=None, filter=None):
+                    opaque_base_tile=None, filter=None, stats=None):
         """Tiled rendering: used for display only
 
         :param surface: target rgba8 surface
@@ -249,6 +334,7 @@ class RootLayerStack (group.LayerStack):
         :type overlay: SurfaceBackedLayer
         :param array opaque_base_tile: optional fallback base tile
         :param callable filter: display filter
+        :param dict stats: optional frame record to add statistics to
 
         Rendering for the display may write non-opaque tiles
         to the target surface.
@@ -270,6 +356,9 @@ class RootLayerStack (group.LayerStack):
         assuming it really does contain opaque RGBA data.
 
         * IN FLUX: the opaque base may change to a surface or a layer
+
+        If `stats` is passed, it's updated with counts and timings as
+        described in `gui.renderstats.RenderStats`.
         """
         # Decide a rendering mode
         render_background = self._get_render_background()
@@ -284,9 +373,34 @@ class RootLayerStack (group.LayerStack):
             previewing = self.current
         if self._current_layer_solo:
             solo = self.current
+        # Filtered output is cached too, as 8-bit tiles. The cache is
+        # keyed like the composited one, so it's invalidated along with
+        # it, and each entry holds a tile per (filter, base tile) pair.
+        # Arrays can't be hashed, so base tiles are keyed by id(), and
+        # each variant keeps a reference to the base tile it was made
+        # with. That stops the id being reused while the variant lives.
+        filtered_cache = None
+        if filter and layers is None and overlay is None:
+            filtered_cache = self._filtered_render_cache
+        variant_key = (filter, id(opaque_base_tile))
         # Blit loop. Could this be done in C++?
         for tx, ty in tiles:
             with surface.tile_request(tx, ty, readonly=False) as dst:
+                variants = None
+                if filtered_cache is not None:
+                    cache_key = (tx, ty, dst_has_alpha, mipmap_level,
+                                 render_background)
+                    variants = filtered_cache.get(cache_key)
+                    if variants is None:
+                        variants = {}
+                        filtered_cache[cache_key] = variants
+                    variant = variants.get(variant_key)
+                    if variant is not None and variant[0] is opaque_base_tile:
+                        dst[...] = variant[1]
+                        if stats is not None:
+                            stats["tiles_rendered"] += 1
+                            stats["filtered_cache_hits"] += 1
+                        continue
                 self.composite_tile(
                     dst, dst_has_alpha, tx, ty,
                     mipmap_level,
@@ -296,9 +410,18 @@ class RootLayerStack (group.LayerStack):
                     previewing=previewing,
                     solo=solo,
                     opaque_base_tile=opaque_base_tile,
+                    stats=stats,
                 )
                 if filter:
+                    if stats is not None:
+                        t0 = time()
                     filter(dst)
+                    if stats is not None:
+                        stats["filter_time"] += time() - t0
+                if stats is not None:
+                    stats["tiles_rendered"] += 1
+                if variants is not None:
+                    variants[variant_key] = (opaque_base_tile, dst.copy())
 
     def render_thumbnail(self, bbox, **options):
         """Renders a 256x256 thumbnail of the stack
@@ -307,6 +430,16 @@ class RootLayerStack (group.LayerStack):
         :type bbox: tuple
         :param **options: Passed to `render_as_pixbuf()`.
         :rtype: GtkPixbuf
+
+        The thumbnail is composited from the smallest mipmap level which
+        is still at least 256 pixels across. The last thumbnail made
+        with each combination of options is remembered along with the
+        content generation it was made for.
+        If nothing has changed since, the same pixbuf is returned again;
+        otherwise only the tiles changed since are composited again.
+        Only the ``alpha`` and ``render_background`` options are
+        supported for remembered thumbnails.
+
         """
         x, y, w, h = bbox
         if w == 0 or h == 0:
@@ -317,11 +450,50 @@ class RootLayerStack (group.LayerStack):
                max(w, h) >= 512):
             mipmap_level += 1
             x, y, w, h = x/2, y/2, w/2, h/2
-        pixbuf = self.render_as_pixbuf(x, y, w, h,
-                                       mipmap_level=mipmap_level,
-                                       **options)
-        assert pixbuf.get_width() == w and pixbuf.get_height() == h
-        return helpers.scale_proportionally(pixbuf, 256, 256)
+        if set(options) - {"alpha", "render_background"}:
+            pixbuf = self.render_as_pixbuf(x, y, w, h,
+                                           mipmap_level=mipmap_level,
+                                           **options)
+            assert pixbuf.get_width() == w and pixbuf.get_height() == h
+            return helpers.scale_proportionally(pixbuf, 256, 256)
+
+        alpha = bool(options.get("alpha", False))
+        render_background = options.get("render_background")
+        if render_background is None:
+            render_background = self.background_visible
+        options_key = (alpha, bool(render_background))
+        key = (x, y, w, h, mipmap_level) + options_key
+        thumb = self._thumbnail_caches.get(options_key)
+        if thumb is None or thumb.key != key:
+            thumb = _ThumbnailCache(key)
+            thumb.surface = lib.pixbufsurface.Surface(x, y, w, h)
+            tiles = thumb.surface.get_tiles()
+        elif thumb.generation == self._content_generation:
+            return thumb.pixbuf
+        elif thumb.dirty_tiles is None:
+            tiles = thumb.surface.get_tiles()
+        else:
+            all_tiles = thumb.surface.get_tiles()
+            tiles = set(
+                (tx >> mipmap_level, ty >> mipmap_level)
+                for (tx, ty) in thumb.dirty_tiles
+            )
+            tiles.intersection_update(all_tiles)
+        surface = thumb.surface
+        for tx, ty in tiles:
+            with surface.tile_request(tx, ty, readonly=False) as dst:
+                self.blit_tile_into(dst, alpha, tx, ty,
+                                    mipmap_level=mipmap_level,
+                                    render_background=render_background)
+        thumb.pixbuf = helpers.scale_proportionally(surface.pixbuf, 256, 256)
+        if thumb.pixbuf is surface.pixbuf:
+            # Small documents are not scaled, but the surface's pixbuf
+            # will be drawn on again by later updates.
+            thumb.pixbuf = thumb.pixbuf.copy()
+        thumb.generation = self._content_generation
+        thumb.dirty_tiles = set()
+        self._thumbnail_caches[options_key] = thumb
+        return thumb.pixbuf
 
     ## Rendering: common layer API
 
@@ -337,7 +509,7 @@ class RootLayerStack (group.LayerStack):
 
     def composite_tile(self, dst, dst_has_alpha, tx, ty, mipmap_level=0,
                        layers=None, render_background=None, overlay=None,
-                       opaque_base_tile=None,
+                       opaque_base_tile=None, stats=None,
                        **kwargs):
         """Composite a tile's data, respecting flags/layers list
 
@@ -347,6 +519,7 @@ class RootLayerStack (group.LayerStack):
         :param bool render_background: Render the internal bg layer
         :param BaseLayer overlay: Overlay layer
         :param array opaque_base_tile: Fallback base tile
+        :param dict stats: Frame record to add statistics to
 
         The root layer has flags which ensure it is always visible, so the
         result is generally indistinguishable from `blit_tile_into()`.
@@ -384,53 +557,111 @@ class RootLayerStack (group.LayerStack):
                 and not (kwargs.get("solo") or kwargs.get("previewing"))
             )
             if using_cache:
+                # The cache holds the composited 15-bit tile before
+                # any view-specific steps, so that all views can share
+                # it regardless of their opaque base tiles.
                 cache_key = (tx, ty, dst_has_alpha, mipmap_level,
-                             render_background, id(opaque_base_tile))
+                             render_background)
                 dst = self._render_cache.get(cache_key)
             if dst is None:
                 dst = numpy.empty((N, N, 4), dtype='uint16')
             else:
                 cache_hit = True
+            if stats is not None and using_cache:
+                stats["cache_hits" if cache_hit else "cache_misses"] += 1
         else:
             dst_8bit = None
 
         if not cache_hit:
-            dst_over_opaque_base = None
-            if dst_has_alpha and opaque_base_tile is not None:
-                dst_over_opaque_base = dst
-                lib.mypaintlib.tile_copy_rgba16_into_rgba16(
-                    opaque_base_tile,
-                    dst_over_opaque_base,
-                )
-                dst = numpy.empty((N, N, 4), dtype='uint16')
-
+            if stats is not None:
+                t_start = time()
+                layer_times = stats["layer_times"]
             background_surface.blit_tile_into(dst, dst_has_alpha, tx, ty,
                                               mipmap_level)
-            for layer in reversed(self):
+            for i in reversed(xrange(len(self))):
+                layer = self[i]
+                if stats is not None:
+                    t0 = time()
                 layer.composite_tile(dst, dst_has_alpha, tx, ty,
                                      mipmap_level, layers=layers, **kwargs)
+                if stats is not None:
+                    key = u"%d: %s" % (i, layer.name or u"")
+                    layer_times[key] += time() - t0
             if overlay:
                 overlay.composite_tile(dst, dst_has_alpha, tx, ty,
                                        mipmap_level, layers=set([overlay]),
                                        **kwargs)
-
-            if dst_over_opaque_base is not None:
-                dst_has_alpha = False
-                lib.mypaintlib.tile_combine(
-                    lib.mypaintlib.CombineNormal,
-                    dst, dst_over_opaque_base,
-                    dst_has_alpha, 1.0,
-                )
-                dst = dst_over_opaque_base
-
             if cache_key is not None:
                 self._render_cache[cache_key] = dst
+            if stats is not None:
+                stats["composite_time"] += time() - t_start
+
+        # Per-view steps. Cached tiles must not be modified by these.
+        if dst_has_alpha and opaque_base_tile is not None:
+            if dst_8bit is None:
+                # The caller's array receives the result
+                src = dst.copy()
+                dst_over_opaque_base = dst
+            else:
+                src = dst
+                dst_over_opaque_base = numpy.empty((N, N, 4), dtype='uint16')
+            lib.mypaintlib.tile_copy_rgba16_into_rgba16(
+                opaque_base_tile,
+                dst_over_opaque_base,
+            )
+            dst_has_alpha = False
+            lib.mypaintlib.tile_combine(
+                lib.mypaintlib.CombineNormal,
+                src, dst_over_opaque_base,
+                dst_has_alpha, 1.0,
+            )
+            dst = dst_over_opaque_base
 
         if dst_8bit is not None:
+            if stats is not None:
+                t0 = time()
             if dst_has_alpha:
                 lib.mypaintlib.tile_convert_rgba16_to_rgba8(dst, dst_8bit)
             else:
                 lib.mypaintlib.tile_convert_rgbu16_to_rgbu8(dst, dst_8bit)
+            if stats is not None:
+                stats["convert_time"] += time() - t0
+
+    ## Flood fill
+
+    def flood_fill(self, x, y, color, bbox, tolerance, dst_layer=None):
+        """Fills a point on the surface with a color (into other only!)
+
+        See `PaintingLayer.flood_fill() for parameters and semantics.
+        The root stack samples all visible layers as they are displayed
+        at full size, using `get_merged_tile_source()`.
+        """
+        assert dst_layer is not self
+        assert dst_layer is not None
+        dst_layer.autosave_dirty = True
+        src = self.get_fill_source()
+        dst = dst_layer._surface
+        tiledsurface.flood_fill(src, x, y, color, bbox, tolerance, dst)
+
+    def get_fill_source(self):
+        """Sample-merged fills use `get_merged_tile_source()`"""
+        return self.get_merged_tile_source()
+
+    def get_merged_tile_source(self):
+        """Returns read-only tile access to the visible image, at full size
+
+        :rtype: lib.surface.TileAccessible
+
+        The returned object composites tiles of all visible layers
+        lazily, when they are first requested. It goes through the
+        render cache, so tiles already composited for display are
+        reused, and tiles it composites can then be shown without
+        compositing them again. Use it only while the layers are
+        unchanged: for example, to compute a fill before writing the
+        results back.
+
+        """
+        return _MergedTileSource(self)
 
     ## Symmetry axis
 
@@ -1087,18 +1318,40 @@ class RootLayerStack (group.LayerStack):
             False
 
         The special background layer itself is never returned by walk().
+
+        The walk order is cached until the next time a layer is added
+        to or removed from the tree. The `visible` and `bghit` tests
+        are made against the layers' current properties as the walk
+        skips over the substacks they exclude.
+
+            >>> root.deepget([1]).visible = True
+            >>> [p for p, l in root.walk(visible=True)]
+            [(1,), (1, 0), (1, 1), (2,)]
+            >>> [p for p, l in root.walk(visible=True, bghit=True)]
+            [(1,), (2,)]
+            >>> stack = root.deepget([1])
+            >>> stack.remove(stack[1])
+            >>> [p for p, l in root.walk()]
+            [(0,), (1,), (1, 0), (2,)]
+
         """
-        queue = [((i,), c) for i, c in enumerate(self)]
-        while len(queue) > 0:
-            path, layer = queue.pop(0)
+        index = self._get_walk_index()
+        paths = index.paths
+        layers = index.layers
+        ends = index.ends
+        i = 0
+        n = len(layers)
+        while i < n:
+            layer = layers[i]
             if visible and not layer.visible:
+                i = ends[i]
                 continue
-            yield (path, layer)
-            if not isinstance(layer, group.LayerStack):
-                continue
-            if bghit and (layer.mode != PASS_THROUGH_MODE):
-                continue
-            queue[:0] = [(path + (i,), c) for i, c in enumerate(layer)]
+            yield (paths[i], layer)
+            if bghit and ends[i] > i + 1:
+                if layer.mode != PASS_THROUGH_MODE:
+                    i = ends[i]
+                    continue
+            i += 1
 
     def deepiter(self):
         """Iterates across all descendents of the stack
@@ -1164,6 +1417,10 @@ class RootLayerStack (group.LayerStack):
             return default
         if len(path) == 0:
             return self
+        index = self._get_walk_index()
+        layer = index.layers_by_path.get(tuple(path))
+        if layer is not None:
+            return layer
         unused_path = list(path)
         layer = self
         while len(unused_path) > 0:
@@ -1307,10 +1564,11 @@ class RootLayerStack (group.LayerStack):
         """
         if layer is self:
             return ()
-        for path, ly in self.walk():
-            if ly is layer:
-                return tuple(path)
-        return None
+        index = self._get_walk_index()
+        i = index.positions.get(id(layer))
+        if i is None or index.layers[i] is not layer:
+            return None
+        return index.paths[i]
 
     ## Convenience methods for commands
 
@@ -1382,10 +1640,9 @@ class RootLayerStack (group.LayerStack):
         elif index is not None:
             if index < 0:
                 raise ValueError("negative layer index %r" % (index,))
-            for i, (path, layer) in enumerate(self.deepenumerate()):
-                if i == index:
-                    assert self.deepget(path) is layer
-                    return path
+            walk_index = self._get_walk_index()
+            if index < len(walk_index.paths):
+                return walk_index.paths[index]
             if not usecurrent:
                 raise ValueError("layer not found with index=%r" %
                                  (index,))
@@ -1543,6 +1800,21 @@ class RootLayerStack (group.LayerStack):
         ...     assert normized not in orig_layers  # always a new layer
         >>> assert list(root.walk()) == orig_walk  # structure unchanged
 
+        """
+        return self._layer_new_normalized(path)
+
+    def _layer_new_normalized(self, path, backdrop_cache=None):
+        """Normalize a layer, sharing backdrop renders via a cache
+
+        :param tuple path: Path to normalize
+        :param dict backdrop_cache: Backdrop tiles, for other operations
+        :returns: New normalized layer
+        :rtype: lib.layer.data.PaintingLayer
+
+        See `layer_new_normalized()`. If a backdrop cache dict is given,
+        backdrop tiles composited for this layer are stored in it so
+        that later normalizations in the same operation can reuse them.
+
         """
         srclayer = self.deepget(path)
         if not srclayer:
@@ -1581,25 +1853,66 @@ class RootLayerStack (group.LayerStack):
                 dstlayer.strokes[:0] = layer.strokes
         # Render loop
         logger.debug("Normalize: render using backdrop %r", backdrop_layers)
-        dstsurf = dstlayer._surface
         N = tiledsurface.N
-        for tx, ty in tiles:
-            bd = numpy.zeros((N, N, 4), dtype='uint16')
-            for layer in backdrop_layers:
-                if layer is self._background_layer:
-                    surf = self._background_layer._surface
-                    surf.blit_tile_into(bd, True, tx, ty, 0)
-                    # FIXME: shouldn't need this special case
-                else:
-                    layer.composite_tile(bd, True, tx, ty, mipmap_level=0)
-            with dstsurf.tile_request(tx, ty, readonly=False) as dst:
-                lib.mypaintlib.tile_copy_rgba16_into_rgba16(bd, dst)
-                srclayer.composite_tile(dst, True, tx, ty, mipmap_level=0)
-                if backdrop_layers:
-                    dst[:, :, 3] = 0  # minimize alpha (discard original)
-                    lib.mypaintlib.tile_flat2rgba(dst, bd)
+
+        def _render_tile(tx, ty):
+            if backdrop_layers:
+                bd = self._get_backdrop_tile(backdrop_layers, tx, ty,
+                                             backdrop_cache)
+                dst = bd.copy()
+            else:
+                dst = numpy.zeros((N, N, 4), dtype='uint16')
+            srclayer.composite_tile(dst, True, tx, ty, mipmap_level=0)
+            if backdrop_layers:
+                dst[:, :, 3] = 0  # minimize alpha (discard original)
+                lib.mypaintlib.tile_flat2rgba(dst, bd)
+            return dst
+
+        _run_tile_plan(tiles, _render_tile, dstlayer._surface)
         return dstlayer
 
+    def _get_backdrop_tile(self, backdrop_layers, tx, ty, cache=None):
+        """Composites one tile of a backdrop, possibly using a cache
+
+        :param list backdrop_layers: Backdrop, as from `_get_backdrop()`
+        :param int tx: Tile X coordinate
+        :param int ty: Tile Y coordinate
+        :param dict cache: Backdrop tiles already composited, or None
+        :returns: The backdrop tile, which must not be modified
+        :rtype: numpy.ndarray
+
+        Cached backdrops are keyed by the layers making them up, so any
+        cached backdrop which is made of the first few layers of the one
+        wanted can be used as a starting point. Merge Down uses this to
+        build the upper layer's backdrop from the lower one's.
+
+        """
+        ids = tuple(id(l) for l in backdrop_layers)
+        start = 0
+        bd = None
+        if cache is not None:
+            for n in xrange(len(ids), 0, -1):
+                cached = cache.get((tx, ty, ids[:n]))
+                if cached is not None:
+                    if n == len(ids):
+                        return cached
+                    bd = cached.copy()
+                    start = n
+                    break
+        if bd is None:
+            N = tiledsurface.N
+            bd = numpy.zeros((N, N, 4), dtype='uint16')
+        for layer in backdrop_layers[start:]:
+            if layer is self._background_layer:
+                surf = self._background_layer._surface
+                surf.blit_tile_into(bd, True, tx, ty, 0)
+                # FIXME: shouldn't need this special case
+            else:
+                layer.composite_tile(bd, True, tx, ty, mipmap_level=0)
+        if cache is not None:
+            cache[(tx, ty, ids)] = bd
+        return bd
+
     def get_merge_down_target(self, path):
         """Returns the target path for Merge Down, after checks
 
@@ -1662,12 +1975,15 @@ class RootLayerStack (group.LayerStack):
         if not target_path:
             raise ValueError("Invalid path for Merge Down")
         backdrop_layers = self._get_backdrop(target_path)
-        # Normalize input
+        # Normalize input. The source's backdrop is usually the target's
+        # plus the target, so the backdrops are only composited once.
         merge_layers = []
+        backdrop_cache = {}
         for p in [target_path, path]:
             assert p is not None
-            layer = self.layer_new_normalized(p)
+            layer = self._layer_new_normalized(p, backdrop_cache)
             merge_layers.append(layer)
+        backdrop_cache.clear()
         assert None not in merge_layers
         # Build output strokemap, determine set of data tiles to merge
         dstlayer = data.PaintingLayer()
@@ -1688,11 +2004,15 @@ class RootLayerStack (group.LayerStack):
         logger.debug("Merge Down: backdrop=%r", backdrop_layers)
         logger.debug("Merge Down: normalized source=%r", merge_layers)
         # Rendering loop
-        dstsurf = dstlayer._surface
-        for tx, ty in tiles:
-            with dstsurf.tile_request(tx, ty, readonly=False) as dst:
-                for layer in merge_layers:
-                    layer.composite_tile(dst, True, tx, ty, mipmap_level=0)
+        N = tiledsurface.N
+
+        def _render_tile(tx, ty):
+            dst = numpy.zeros((N, N, 4), dtype='uint16')
+            for layer in merge_layers:
+                layer.composite_tile(dst, True, tx, ty, mipmap_level=0)
+            return dst
+
+        _run_tile_plan(tiles, _render_tile, dstlayer._surface)
         return dstlayer
 
     def layer_new_merge_visible(self):
@@ -1740,18 +2060,23 @@ class RootLayerStack (group.LayerStack):
         if name != '':
             dstlayer.name = name
         # Render & subtract backdrop (= the background, if visible)
-        dstsurf = dstlayer._surface
         bgsurf = self._background_layer._surface
-        for tx, ty in tiles:
-            with dstsurf.tile_request(tx, ty, readonly=False) as dst:
-                self.composite_tile(
-                    dst, True, tx, ty, mipmap_level=0,
-                    render_background=self._background_visible
-                )
-                if self._background_visible:
-                    with bgsurf.tile_request(tx, ty, readonly=True) as bg:
-                        dst[:, :, 3] = 0  # minimize alpha (discard original)
-                        lib.mypaintlib.tile_flat2rgba(dst, bg)
+        bg_visible = self._background_visible
+        N = tiledsurface.N
+
+        def _render_tile(tx, ty):
+            dst = numpy.zeros((N, N, 4), dtype='uint16')
+            self.composite_tile(
+                dst, True, tx, ty, mipmap_level=0,
+                render_background=bg_visible,
+            )
+            if bg_visible:
+                with bgsurf.tile_request(tx, ty, readonly=True) as bg:
+                    dst[:, :, 3] = 0  # minimize alpha (discard original)
+                    lib.mypaintlib.tile_flat2rgba(dst, bg)
+            return dst
+
+        _run_tile_plan(tiles, _render_tile, dstlayer._surface)
         return dstlayer
 
     ## Loading
@@ -1954,6 +2279,7 @@ class RootLayerStack (group.LayerStack):
         """Event: notifies that a sub-layer's properties have changed"""
 
     def _notify_layer_deleted(self, parent, oldchild, oldindex):
+        self._invalidate_walk_index()
         assert parent.root is self
         assert oldchild.root is not self
         path = self.deepindex(parent)
@@ -1966,6 +2292,7 @@ class RootLayerStack (group.LayerStack):
         """Event: notifies that a sub-layer has been deleted"""
 
     def _notify_layer_inserted(self, parent, newchild, newindex):
+        self._invalidate_walk_index()
         assert parent.root is self
         assert newchild.root is self
         path = self.deepindex(newchild)
@@ -1988,6 +2315,114 @@ class RootLayerStack (group.LayerStack):
         return RootLayerStackSnapshot(self)
 
 
+class _ThumbnailCache (object):
+    """A thumbnail made by RootLayerStack.render_thumbnail()
+
+    The root keeps the last one for each combination of the "alpha" and
+    "render_background" options, so that callers using different options
+    don't keep replacing each other's thumbnails.
+
+    """
+
+    #: Above this many changed tiles, the whole thumbnail is redone
+    MAX_DIRTY_TILES = 4096
+
+    def __init__(self, key):
+        super(_ThumbnailCache, self).__init__()
+        self.key = key  # (x, y, w, h, mipmap_level, alpha, render_bg)
+        self.generation = None  # content generation rendered
+        self.surface = None  # lib.pixbufsurface.Surface at mipmap_level
+        self.pixbuf = None  # the scaled thumbnail
+        self.dirty_tiles = set()  # changed since, at level 0; None=all
+
+
+class _WalkIndex (object):
+    """The layers of a RootLayerStack, flattened into walk order
+
+    Layers are listed in the order `RootLayerStack.walk()` visits them,
+    with substacks before their children. For each layer, `ends` holds
+    the position just past its last descendent, so that a walk can skip
+    over a substack's children in one step.
+
+    """
+
+    def __init__(self, root):
+        super(_WalkIndex, self).__init__()
+        self.paths = []
+        self.layers = []
+        self.ends = []
+        self._add_children(root, ())
+        self.positions = dict(
+            (id(layer), i) for i, layer in enumerate(self.layers)
+        )
+        self.layers_by_path = dict(zip(self.paths, self.layers))
+
+    def _add_children(self, stack, parent_path):
+        for i, layer in enumerate(stack):
+            path = parent_path + (i,)
+            pos = len(self.layers)
+            self.paths.append(path)
+            self.layers.append(layer)
+            self.ends.append(None)
+            if isinstance(layer, group.LayerStack):
+                self._add_children(layer, path)
+            self.ends[pos] = len(self.layers)
+
+
+class _MergedTileSource (lib.surface.TileAccessible):
+    """Read-only, cached tile access to a root stack's visible image
+
+    See `RootLayerStack.get_merged_tile_source()`. The tiles are
+    shared with the render cache, so they must not be modified.
+
+    """
+
+    def __init__(self, root):
+        super(_MergedTileSource, self).__init__()
+        self._root = root
+        self._render_background = root._get_render_background()
+        # Composite the way the display does, so that cache entries
+        # can be shared with it.
+        self._opaque = root.get_render_is_opaque()
+        self._tiles = {}
+
+    @contextlib.contextmanager
+    def tile_request(self, tx, ty, readonly):
+        """Context manager that fetches a composited tile"""
+        if not readonly:
+            raise ValueError("Only readonly tile requests are supported")
+        tile = self._tiles.get((tx, ty))
+        if tile is None:
+            tile = self._get_tile(tx, ty)
+            self._tiles[(tx, ty)] = tile
+        yield tile
+
+    def _get_tile(self, tx, ty):
+        root = self._root
+        cache = root._render_cache
+        dst_has_alpha = not self._opaque
+        cache_key = (tx, ty, dst_has_alpha, 0, self._render_background)
+        tile = cache.get(cache_key)
+        if tile is not None:
+            if self._opaque:
+                # Opaque renders needn't set their alpha, but the fill
+                # compares it.
+                tile = tile.copy()
+                tile[:, :, 3] = 1 << 15
+            return tile
+        N = tiledsurface.N
+        tile = numpy.empty((N, N, 4), dtype='uint16')
+        root.composite_tile(tile, dst_has_alpha, tx, ty, 0,
+                            render_background=self._render_background)
+        if self._opaque:
+            tile[:, :, 3] = 1 << 15
+        cache[cache_key] = tile
+        return tile
+
+    def get_bbox(self):
+        return self._root.get_bbox()
+
+
 class RootLayerStackSnapshot (group.LayerStackSnapshot):
     """Snapshot of a root layer stack's state"""
 
@@ -2004,6 +2439,28 @@ class RootLayerStackSnapshot (group.LayerStackSnapshot):
         layer.current_path = self.current_path
 
 
+## Tile plans
+
+def _run_tile_plan(tiles, render_tile, dstsurf):
+    """Renders tiles, and stores the non-empty ones
+
+    :param iterable tiles: (tx, ty) tile coordinates to render
+    :param callable render_tile: ``render_tile(tx, ty)`` -> 15-bit tile
+    :param lib.tiledsurface.MyPaintSurface dstsurf: Output surface
+
+    Tiles are rendered in row order. Tiles which come out fully
+    transparent are not stored. The render function must not modify
+    any model state, and must not use cached 8-bit rendering.
+
+    """
+    for tx, ty in sorted(tiles):
+        rgba = render_tile(tx, ty)
+        if rgba is None or not rgba[:, :, 3].any():
+            continue
+        with dstsurf.tile_request(tx, ty, readonly=False) as dst:
+            dst[...] = rgba
+
+
 ## Layer path tuple functions
 
 
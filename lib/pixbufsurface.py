@@ -20,6 +20,7 @@ from gi.repository import GdkPixbuf
 import mypaintlib
 import helpers
 import lib.surface
+import lib.cache
 from lib.surface import TileAccessible, TileBlittable
 from lib.errors import FileHandlingError
 from lib.errors import AllocationError
@@ -51,19 +52,79 @@ class Surface (TileAccessible, TileBlittable):
 
     """
 
-    def __init__(self, x, y, w, h, data=None):
+    def __init__(self, x, y, w, h, data=None, capacity=None):
+        """Initialize, allocating memory for an area
+
+        :param int x: left edge of the area, in pixels
+        :param int y: top edge of the area
+        :param int w: width of the area
+        :param int h: height of the area
+        :param array data: optional initial RGB or RGBA 8bpp data
+        :param tuple capacity: optional minimum size to allocate for,
+          as a (columns, rows) count of tiles. See `retarget()`.
+
+        """
         super(Surface, self).__init__()
         assert w > 0 and h > 0
-        # We create and use a pixbuf enlarged to the tile boundaries internally.
-        # Variables ex, ey, ew, eh and epixbuf store the enlarged version.
+        # We create and use a pixbuf enlarged to the tile boundaries
+        # internally, and possibly further to the requested capacity.
+        tw, th = _get_tile_extents(x, y, w, h)
+        if capacity is not None:
+            tw = max(tw, capacity[0])
+            th = max(th, capacity[1])
+        try:
+            self._storage = GdkPixbuf.Pixbuf.new(
+                GdkPixbuf.Colorspace.RGB, True, 8,
+                tw*N, th*N,
+            )
+        except Exception as te:
+            logger.exception("GdkPixbuf.Pixbuf.new() failed")
+            raise AllocationError(_POSSIBLE_OOM_USERTEXT)
+        if self._storage is None:
+            logger.error("GdkPixbuf.Pixbuf.new() returned NULL")
+            raise AllocationError(_POSSIBLE_OOM_USERTEXT)
+        self._storage_array = helpers.gdkpixbuf2numpy(self._storage)
+        assert len(self._storage_array) > 0
+        #: Size of the allocated memory, as (columns, rows) of tiles
+        self.capacity = (tw, th)
+        self._set_target(x, y, w, h, data)
+
+    def can_retarget(self, x, y, w, h):
+        """True if `retarget()` can reuse this surface for an area"""
+        tw, th = _get_tile_extents(x, y, w, h)
+        return tw <= self.capacity[0] and th <= self.capacity[1]
+
+    def retarget(self, x, y, w, h):
+        """Moves the surface to a new area, reusing its memory
+
+        :param int x: left edge of the new area, in pixels
+        :param int y: top edge of the new area
+        :param int w: width of the new area
+        :param int h: height of the new area
+        :raises ValueError: the area doesn't fit within `capacity`
+
+        Afterwards, the surface is as if it had just been constructed
+        for the new area: its pixels are fully transparent.
+
+        """
+        if not self.can_retarget(x, y, w, h):
+            raise ValueError("%r doesn't fit in %dx%d tiles"
+                             % ((x, y, w, h), self.capacity[0],
+                                self.capacity[1]))
+        self._set_target(x, y, w, h)
+
+    def _set_target(self, x, y, w, h, data=None):
+        """Sets up the pixbufs and tile views for an area"""
+        assert w > 0 and h > 0
+        # Variables ex, ey, ew, eh and epixbuf describe the area
+        # enlarged to the tile boundaries.
         self.x, self.y, self.w, self.h = x, y, w, h
         #print x, y, w, h
         tx = self.tx = x/N
         ty = self.ty = y/N
         self.ex = tx*N
         self.ey = ty*N
-        tw = (x+w-1)/N - tx + 1
-        th = (y+h-1)/N - ty + 1
+        tw, th = _get_tile_extents(x, y, w, h)
 
         self.ew = tw*N
         self.eh = th*N
@@ -74,38 +135,23 @@ class Surface (TileAccessible, TileBlittable):
         assert self.ex <= x and self.ey <= y
 
         # Tile-aligned pixbuf: also accessible by tile
-        try:
-            self.epixbuf = GdkPixbuf.Pixbuf.new(
-                GdkPixbuf.Colorspace.RGB, True, 8,
-                self.ew, self.eh
-            )
-        except Exception as te:
-            logger.exception("GdkPixbuf.Pixbuf.new() failed")
-            raise AllocationError(_POSSIBLE_OOM_USERTEXT)
-        if self.epixbuf is None:
-            logger.error("GdkPixbuf.Pixbuf.new() returned NULL")
-            raise AllocationError(_POSSIBLE_OOM_USERTEXT)
+        if (tw, th) == self.capacity:
+            self.epixbuf = self._storage
+        else:
+            self.epixbuf = self._new_subpixbuf(self._storage, 0, 0,
+                                               self.ew, self.eh)
 
         # External subpixbuf, also accessible by tile.
         dx = x-self.ex
         dy = y-self.ey
-        try:
-            self.pixbuf = self.epixbuf.new_subpixbuf(dx, dy, w, h)
-        except Exception as te:
-            logger.exception("GdkPixbuf.Pixbuf.new_subpixbuf() failed")
-            raise AllocationError(_POSSIBLE_OOM_USERTEXT)
-        if self.pixbuf is None:
-            logger.error("GdkPixbuf.Pixbuf.new_subpixbuf() returned NULL")
-            raise AllocationError(_POSSIBLE_OOM_USERTEXT)
+        self.pixbuf = self._new_subpixbuf(self.epixbuf, dx, dy, w, h)
 
         assert self.ew <= w + 2*N-2
         assert self.eh <= h + 2*N-2
 
-        self.epixbuf.fill(0x00000000)  # keep undefined regions transparent
-
         # Make it accessible by tile
-        arr = helpers.gdkpixbuf2numpy(self.epixbuf)
-        assert len(arr) > 0
+        arr = self._storage_array[:self.eh, :self.ew]
+        arr[...] = 0  # keep undefined regions transparent
 
         discard_transparent = False
 
@@ -129,6 +175,19 @@ class Surface (TileAccessible, TileBlittable):
                     continue
                 self.tile_memory_dict[(self.tx+tx, self.ty+ty)] = buf
 
+    @staticmethod
+    def _new_subpixbuf(pixbuf, x, y, w, h):
+        """Makes a subpixbuf sharing memory with its parent"""
+        try:
+            sub = pixbuf.new_subpixbuf(x, y, w, h)
+        except Exception as te:
+            logger.exception("GdkPixbuf.Pixbuf.new_subpixbuf() failed")
+            raise AllocationError(_POSSIBLE_OOM_USERTEXT)
+        if sub is None:
+            logger.error("GdkPixbuf.Pixbuf.new_subpixbuf() returned NULL")
+            raise AllocationError(_POSSIBLE_OOM_USERTEXT)
+        return sub
+
     def get_bbox(self):
         return lib.surface.get_tiles_bbox(self.get_tiles())
 
@@ -157,6 +216,88 @@ class Surface (TileAccessible, TileBlittable):
         mypaintlib.tile_convert_rgba8_to_rgba16(src, dst)
 
 
+class SurfacePool (object):
+    """Pool of reusable render target Surfaces
+
+    Allocating a big GdkPixbuf for every redraw is slow, and churns
+    memory. A pool hands out Surfaces retargeted to the requested area
+    instead, allocating only when it has nothing suitable.
+
+    Requests are grouped into size classes, measured in tiles and
+    rounded up, so that areas of similar sizes share surfaces. Only a
+    few size classes are kept; the least recently used ones are freed.
+
+    """
+
+    #: Size classes are multiples of this many tiles in each direction
+    SIZE_CLASS_STEP = 4
+
+    #: Most unused surfaces kept per size class
+    MAX_FREE_PER_CLASS = 2
+
+    def __init__(self, max_classes=8):
+        super(SurfacePool, self).__init__()
+        self._free = lib.cache.LRUCache(capacity=max_classes)
+        #: Number of surfaces handed out by `get()`
+        self.requests = 0
+        #: Number of surfaces allocated by `get()`
+        self.allocations = 0
+
+    def _get_size_class(self, x, y, w, h):
+        step = self.SIZE_CLASS_STEP
+        tw, th = _get_tile_extents(x, y, w, h)
+        return (-(-tw // step) * step, -(-th // step) * step)
+
+    def get(self, x, y, w, h):
+        """Returns a blank Surface covering an area
+
+        :rtype: Surface
+
+        Pass the surface back to `release()` when it's finished with.
+
+        """
+        self.requests += 1
+        size_class = self._get_size_class(x, y, w, h)
+        free = self._free.get(size_class)
+        if free:
+            surface = free.pop()
+            surface.retarget(x, y, w, h)
+            return surface
+        self.allocations += 1
+        return Surface(x, y, w, h, capacity=size_class)
+
+    def release(self, surface):
+        """Returns a Surface from `get()` to the pool for reuse"""
+        size_class = surface.capacity
+        free = self._free.get(size_class)
+        if free is None:
+            free = []
+            self._free[size_class] = free
+        if len(free) < self.MAX_FREE_PER_CLASS:
+            free.append(surface)
+
+    def clear(self):
+        """Frees all unused surfaces"""
+        self._free.clear()
+
+
+## Helper functions
+
+
+def _get_tile_extents(x, y, w, h):
+    """Number of columns and rows of tiles an area touches
+
+    >>> _get_tile_extents(0, 0, N, N)
+    (1, 1)
+    >>> _get_tile_extents(-1, 10, N, 2*N)
+    (2, 3)
+
+    """
+    tw = (x+w-1)/N - x/N + 1
+    th = (y+h-1)/N - y/N + 1
+    return (tw, th)
+
+
 def render_as_pixbuf(surface, *rect, **kwargs):
     """Renders a surface within a given rectangle as a GdkPixbuf
 
@@ -56,4 +56,28 @@ public:
     return res;
   }
 
+  // Replay a whole array of recorded events in one call.
+  // The array is Nx6 float64, one row per event, with columns
+  // (dtime, x, y, pressure, xtilt, ytilt) as in lib.stroke.
+  // Returns the number of events processed, which is less than N
+  // only if an exception happened in the surface code.
+  int stroke_events_to (Surface * surface, PyObject * obj)
+  {
+    PyArrayObject* events = (PyArrayObject*)obj;
+    assert(PyArray_Check(obj));
+    assert(PyArray_NDIM(events) == 2);
+    assert(PyArray_DIM(events, 1) == 6);
+    assert(PyArray_TYPE(events) == NPY_FLOAT64);
+    assert(PyArray_ISCARRAY(events));
+    const int n = PyArray_DIM(events, 0);
+    const npy_float64 * ev = (npy_float64*)PyArray_DATA(events);
+    for (int i=0; i<n; i++, ev+=6) {
+      Brush::stroke_to (surface, ev[1], ev[2], ev[3], ev[4], ev[5], ev[0]);
+      if (PyErr_Occurred()) {
+        return i;
+      }
+    }
+    return n;
+  }
+
 };
@@ -6,9 +6,10 @@
 # the Free Software Foundation; either version 2 of the License, or
 # (at your option) any later version.
 
-import brush
 import numpy
 
+import lib.brush
+
 
 class Stroke (object):
     """Replayable record of a stroke's data
@@ -34,7 +35,9 @@ class Stroke (object):
         assert not self.finished
 
         bi = brush.brushinfo
-        self.brush_settings = bi.save_to_string()
+        self.brush_settings = lib.brush.intern_settings_string(
+            bi.save_to_string(),
+        )
         self.brush_name = bi.get_string_property("parent_brush_name")
 
         states = brush.get_states_as_array()
@@ -73,11 +76,42 @@ class Stroke (object):
 
     empty = property(is_empty)
 
+    def get_events(self):
+        """Returns the recorded events as an array
+
+        :returns: Nx6 array of (dtime, x, y, pressure, xtilt, ytilt)
+        :rtype: numpy.ndarray
+
+        """
+        assert self.finished
+        version, data = self.stroke_data[0], self.stroke_data[1:]
+        assert version == '2'
+        data = numpy.fromstring(data, dtype='float64')
+        data.shape = (len(data)/6, 6)
+        return data
+
     def render(self, surface):
+        """Render the whole stroke to a surface in one atomic section"""
+        surface.begin_atomic()
+        self.render_dabs(surface.backend)
+        surface.end_atomic()
+
+    def render_dabs(self, backend):
+        """Render the stroke's dabs to a surface backend
+
+        :param backend: the C++ backend of a surface, in an atomic section
+
+        This does no begin_atomic()/end_atomic() of its own, so that
+        callers can render several strokes in a single atomic section.
+        See `lib.layer.PaintingLayer.render_strokes()`.
+
+        """
         assert self.finished
 
-        # OPTIMIZE: check if parsing of settings is a performance bottleneck
-        b = brush.Brush(brush.BrushInfo(self.brush_settings))
+        # Parsed settings are shared between replays of the same brush.
+        # The engine must be fresh each time for a deterministic replay.
+        bi = lib.brush.get_cached_brushinfo(self.brush_settings)
+        b = lib.brush.Brush(bi, observe=False)
 
         states = numpy.fromstring(self.brush_state, dtype='float32')
         b.set_states_from_array(states)
@@ -85,15 +119,13 @@ class Stroke (object):
         #b.set_print_inputs(1)
         #print 'replaying', len(self.stroke_data), 'bytes'
 
-        version, data = self.stroke_data[0], self.stroke_data[1:]
-        assert version == '2'
-        data = numpy.fromstring(data, dtype='float64')
-        data.shape = (len(data)/6, 6)
-
-        surface.begin_atomic()
-        for dtime, x, y, pressure, xtilt, ytilt in data:
-            b.stroke_to(surface.backend, x, y, pressure, xtilt, ytilt, dtime)
-        surface.end_atomic()
+        events = self.get_events()
+        n = b.stroke_events_to(backend, events)
+        if n != len(events):
+            raise RuntimeError(
+                "Stroke replay stopped after %d of %d events"
+                % (n, len(events))
+            )
 
     def copy_using_different_brush(self, brushinfo):
         assert self.finished
@@ -101,7 +133,9 @@ class Stroke (object):
         clone = Stroke()
         clone.__dict__.update(self.__dict__)
         # Except for the brush-specific stuff
-        clone.brush_settings = brushinfo.save_to_string()
+        clone.brush_settings = lib.brush.intern_settings_string(
+            brushinfo.save_to_string(),
+        )
         clone.brush_name = brushinfo.get_string_property("parent_brush_name")
         # note: we keep self.brush_state intact, even if the new brush
         # has different meanings for the states. This should cause
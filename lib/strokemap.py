@@ -17,6 +17,7 @@ import mypaintlib
 
 import tiledsurface
 import idletask
+import workerpool
 
 TILE_SIZE = N = mypaintlib.TILE_SIZE
 
@@ -27,11 +28,25 @@ class StrokeShape (object):
     This class stores the shape of a stroke in as a 1-bit bitmap. The
     information is stored in compressed memory blocks of the size of a
     tile (for fast lookup).
+
+    Strokemap tiles for freshly painted strokes are calculated by
+    background worker threads. Methods which need the tile data wait
+    only for the tiles they need.
     """
     def __init__(self):
         object.__init__(self)
         self.tasks = idletask.Processor()
         self.strokemap = {}
+        #: Tiles still being worked on in the worker pool: {(tx, ty): Job}
+        self._pending = {}
+
+    def __deepcopy__(self, memo):
+        """Deep copies share the (immutable) compressed tile data"""
+        self._finish_pending()
+        self.tasks.finish_all()
+        clone = StrokeShape()
+        clone.strokemap = self.strokemap.copy()
+        return clone
 
     def init_from_snapshots(self, snapshot_before, snapshot_after):
         """Set the shape from a before- and after-stroke pair of snapshots
@@ -48,21 +63,32 @@ class StrokeShape (object):
         changes = a_tiles.symmetric_difference(b_tiles)
         tiles_modified = set([pos for pos, data in changes])
 
-        # for each tile, calculate the exact difference (not now, later, when idle)
-        for tx, ty in tiles_modified:
-            func = self._update_strokemap_with_percept_diff
-            self.tasks.add_work(func, a, b, tx, ty)
-
-    def _update_strokemap_with_percept_diff(self, before, after, tx, ty):
-        # get the pixel data to compare
-        data_before = before.get((tx, ty), tiledsurface.transparent_tile).rgba
-        data_after = after.get((tx, ty), tiledsurface.transparent_tile).rgba
-        # calculate pixel changes, and add to the stroke's tiled bitmap
-        differences = numpy.empty((N, N), 'uint8')
-        mypaintlib.tile_perceptual_change_strokemap(data_before, data_after,
-                                                    differences)
-        self.strokemap[tx, ty] = zlib.compress(differences.tostring())
-        return False
+        # For each tile, calculate the exact difference in the background.
+        # Snapshot tiles are read-only, so the workers can share them.
+        pool = workerpool.get_shared_pool()
+        transparent = tiledsurface.transparent_tile
+        for pos in tiles_modified:
+            tile_before = a.get(pos, transparent)
+            tile_after = b.get(pos, transparent)
+            job = pool.add_work(_calc_percept_diff, tile_before, tile_after)
+            self._pending[pos] = job
+
+    def _finish_tile(self, tx, ty):
+        """Wait for any background work on one tile to complete"""
+        job = self._pending.pop((tx, ty), None)
+        if job is not None:
+            data = job.wait()
+            if data is not None:
+                self.strokemap[tx, ty] = data
+
+    def _finish_pending(self):
+        """Wait for all background work to complete"""
+        pending = self._pending
+        self._pending = {}
+        for pos, job in pending.iteritems():
+            data = job.wait()
+            if data is not None:
+                self.strokemap[pos] = data
 
     def init_from_string(self, data, translate_x, translate_y):
         assert not self.strokemap
@@ -81,6 +107,7 @@ class StrokeShape (object):
         assert translate_y % N == 0
         translate_x /= N
         translate_y /= N
+        self._finish_pending()
         self.tasks.finish_all()
         data = ''
         for (tx, ty), compressed_bitmap in self.strokemap.iteritems():
@@ -91,6 +118,7 @@ class StrokeShape (object):
 
     def touches_pixel(self, x, y):
         self.tasks.finish_all()
+        self._finish_tile(x/N, y/N)
         data = self.strokemap.get((x/N, y/N))
         if data:
             data = numpy.fromstring(zlib.decompress(data), dtype='uint8')
@@ -98,6 +126,7 @@ class StrokeShape (object):
             return data[y % N, x % N]
 
     def render_to_surface(self, surf):
+        self._finish_pending()
         self.tasks.finish_all()
         for (tx, ty), data in self.strokemap.iteritems():
             data = numpy.fromstring(zlib.decompress(data), dtype='uint8')
@@ -109,59 +138,44 @@ class StrokeShape (object):
                 tile[:, :, 1] = tile[:, :, 3]/2
                 tile[:, :, 2] = tile[:, :, 3]/2
 
-    @staticmethod
-    def _translate_tile(src, src_tx, src_ty, slices_x, slices_y,
-                        targ_strokemap):
-        """Idle task: translate a single tile into an output strokemap"""
-        src = numpy.fromstring(zlib.decompress(src), dtype='uint8')
-        src.shape = (N, N)
-        is_integral = len(slices_x) == 1 and len(slices_y) == 1
-        for (src_x0, src_x1), (targ_tdx, targ_x0, targ_x1) in slices_x:
-            for (src_y0, src_y1), (targ_tdy, targ_y0, targ_y1) in slices_y:
-                targ_tx = src_tx + targ_tdx
-                targ_ty = src_ty + targ_tdy
-                if is_integral:
-                    targ_strokemap[targ_tx, targ_ty] = src
-                else:
-                    targ = targ_strokemap.get((targ_tx, targ_ty), None)
-                    if targ is None:
-                        targ = numpy.zeros((N, N), 'uint8')
-                        targ_strokemap[targ_tx, targ_ty] = targ
-                    targ[targ_y0:targ_y1, targ_x0:targ_x1] \
-                        = src[src_y0:src_y1, src_x0:src_x1]
-        return False
-
-    def _recompress_tile(self, tx, ty, data):
-        """Idle task: recompress a single translated tile's data"""
-        if data.any():
-            self.strokemap[tx, ty] = zlib.compress(data.tostring())
-        return False
-
-    def _start_tile_recompression(self, src_strokemap):
-        """Idle task: starts recompressing data from the temp strokemap"""
-        for (tx, ty), data in src_strokemap.iteritems():
-            self.tasks.add_work(self._recompress_tile, tx, ty, data)
-        return False
-
     def translate(self, dx, dy):
-        """Translate the shape by (dx, dy)"""
+        """Translate the shape by (dx, dy)
+
+        Translated tiles are assembled in the shared worker pool, in the
+        same way as freshly painted strokes' tiles are computed.
+
+        """
         # Finish any previous translations or handling of painted strokes
+        self._finish_pending()
         self.tasks.finish_all()
         # Source data
         src_strokemap = self.strokemap
         self.strokemap = {}
+        dx, dy = int(dx), int(dy)
+        if dx % N == 0 and dy % N == 0:
+            # Whole-tile moves just re-key the compressed data
+            tdx, tdy = dx // N, dy // N
+            for (tx, ty), data in src_strokemap.iteritems():
+                self.strokemap[tx + tdx, ty + tdy] = data
+            return
         slices_x = tiledsurface.calc_translation_slices(int(dx))
         slices_y = tiledsurface.calc_translation_slices(int(dy))
-        # Temporary working strokemap, uncompressed
-        tmp_strokemap = {}
-        # Queue moves
+        # Which parts of which source tiles make up each target tile
+        targets = {}
         for (src_tx, src_ty), src in src_strokemap.iteritems():
-            self.tasks.add_work(self._translate_tile, src,
-                                src_tx, src_ty, slices_x, slices_y,
-                                tmp_strokemap)
-        # Recompression of any tile can only start after all the above is
-        # complete. Luckily the idle-processor does things in order.
-        self.tasks.add_work(self._start_tile_recompression, tmp_strokemap)
+            for (src_x0, src_x1), (targ_tdx, targ_x0, targ_x1) in slices_x:
+                for (src_y0, src_y1), (targ_tdy, targ_y0, targ_y1) \
+                        in slices_y:
+                    targ_t = (src_tx + targ_tdx, src_ty + targ_tdy)
+                    targets.setdefault(targ_t, []).append((
+                        src,
+                        (src_y0, src_y1, src_x0, src_x1),
+                        (targ_y0, targ_y1, targ_x0, targ_x1),
+                    ))
+        # Queue the moves
+        pool = workerpool.get_shared_pool()
+        for targ_t, parts in targets.iteritems():
+            self._pending[targ_t] = pool.add_work(_translate_tile, parts)
 
     def trim(self, rect):
         """Trim the shape to a rectangle, discarding data outside it
@@ -173,10 +187,43 @@ class StrokeShape (object):
 
         Only complete tiles are discarded by this method.
         """
+        self._finish_pending()
         self.tasks.finish_all()
-        x, y, w, h = rect
+        x, y, w, h = [int(c) for c in rect]
         logger.debug("Trimming stroke to %dx%d%+d%+d", w, h, x, y)
-        for tx, ty in list(self.strokemap.keys()):
-            if tx*N+N < x or ty*N+N < y or tx*N > x+w or ty*N > y+h:
-                self.strokemap.pop((tx, ty))
+        if w <= 0 or h <= 0:
+            self.strokemap.clear()
+            return False
+        tx0, ty0 = x // N, y // N
+        tx1, ty1 = (x+w-1) // N, (y+h-1) // N
+        self.strokemap = dict(
+            (pos, data) for (pos, data) in self.strokemap.iteritems()
+            if tx0 <= pos[0] <= tx1 and ty0 <= pos[1] <= ty1
+        )
         return bool(self.strokemap)
+
+
+def _translate_tile(parts):
+    """Worker job: assemble a translated, compressed strokemap tile
+
+    :param list parts: [(compressed_src, src_slice, targ_slice)]
+    :returns: the compressed tile, or None if it would be empty
+
+    """
+    targ = numpy.zeros((N, N), 'uint8')
+    for src, (sy0, sy1, sx0, sx1), (ty0, ty1, tx0, tx1) in parts:
+        src = numpy.fromstring(zlib.decompress(src), dtype='uint8')
+        src.shape = (N, N)
+        targ[ty0:ty1, tx0:tx1] = src[sy0:sy1, sx0:sx1]
+    if not targ.any():
+        return None
+    return zlib.compress(targ.tostring())
+
+
+def _calc_percept_diff(tile_before, tile_after):
+    """Worker job: calculate a compressed strokemap tile from two tiles"""
+    differences = numpy.empty((N, N), 'uint8')
+    mypaintlib.tile_perceptual_change_strokemap(tile_before.rgba,
+                                                tile_after.rgba,
+                                                differences)
+    return zlib.compress(differences.tostring())
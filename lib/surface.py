@@ -169,12 +169,217 @@ class TileRequestWrapper (TileAccessible):
         return getattr(self._obj, attr)
 
 
+class TileDict (dict):
+    """Dict of tiles keyed by (tx, ty), which tracks its bounding box
+
+    This behaves exactly like a dict, but it keeps an index of the keys
+    in each tile row, and counts of the keys in each column, so that its
+    data bounding box can be returned without looking at every tile.
+
+    >>> tiles = TileDict()
+    >>> tiles[(0, 0)] = "a"
+    >>> tiles[(2, 1)] = "b"
+    >>> tuple(tiles.get_bbox()) == (0, 0, 3*N, 2*N)
+    True
+    >>> tiles.pop((2, 1))
+    'b'
+    >>> tuple(tiles.get_bbox()) == (0, 0, N, N)
+    True
+    >>> tiles.update({(-1, 5): "c"})
+    >>> tuple(tiles.get_bbox()) == (-N, 0, 2*N, 6*N)
+    True
+    >>> tiles.clear()
+    >>> tiles.get_bbox().empty()
+    True
+
+    When a key at the edge is removed, the bounding box is shrunk lazily
+    the next time it is asked for, using the row and column counts.
+
+    The row index also makes it quick to find the keys inside or outside
+    ranges of tiles, a row at a time.
+
+    >>> tiles = TileDict(((tx, ty), None) for tx in xrange(4)
+    ...                  for ty in xrange(4))
+    >>> sorted(tiles.keys_in_range(1, 2, 2, 9))
+    [(1, 2), (1, 3), (2, 2), (2, 3)]
+    >>> len(tiles.keys_outside(1, 1, 2, 2))
+    12
+
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(TileDict, self).__init__(*args, **kwargs)
+        self._reindex()
+
+    def _reindex(self):
+        self._rows = {}  # {ty: set([tx, ...])}
+        self._cols = {}  # {tx: count}
+        for key in self.iterkeys():
+            self._add_to_index(key)
+        self._extents = None  # (tx0, ty0, tx1, ty1) inclusive, or None
+
+    def _add_to_index(self, key):
+        tx, ty = key
+        row = self._rows.get(ty)
+        if row is None:
+            self._rows[ty] = set([tx])
+        else:
+            row.add(tx)
+        self._cols[tx] = self._cols.get(tx, 0) + 1
+
+    def _added(self, key):
+        tx, ty = key
+        self._add_to_index(key)
+        ext = self._extents
+        if ext is not None:
+            self._extents = (
+                min(ext[0], tx), min(ext[1], ty),
+                max(ext[2], tx), max(ext[3], ty),
+            )
+        elif len(self) == 1:
+            self._extents = (tx, ty, tx, ty)
+
+    def _removed(self, key):
+        tx, ty = key
+        ext = self._extents
+        row = self._rows[ty]
+        row.discard(tx)
+        if not row:
+            del self._rows[ty]
+            if ext is not None and ty in (ext[1], ext[3]):
+                self._extents = None  # shrunk: work it out when needed
+        n = self._cols[tx] - 1
+        if n:
+            self._cols[tx] = n
+        else:
+            del self._cols[tx]
+            if ext is not None and tx in (ext[0], ext[2]):
+                self._extents = None
+
+    def __setitem__(self, key, value):
+        if key not in self:
+            super(TileDict, self).__setitem__(key, value)
+            self._added(key)
+        else:
+            super(TileDict, self).__setitem__(key, value)
+
+    def __delitem__(self, key):
+        super(TileDict, self).__delitem__(key)
+        self._removed(key)
+
+    def pop(self, key, *default):
+        if key not in self:
+            return super(TileDict, self).pop(key, *default)
+        value = super(TileDict, self).pop(key)
+        self._removed(key)
+        return value
+
+    def popitem(self):
+        key, value = super(TileDict, self).popitem()
+        self._removed(key)
+        return key, value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).iteritems():
+            self[key] = value
+
+    def clear(self):
+        super(TileDict, self).clear()
+        self._reindex()
+
+    def copy(self):
+        # Snapshots copy tile dicts a lot, so avoid counting again
+        result = dict.__new__(TileDict)
+        dict.update(result, self)
+        result._rows = dict((ty, set(row))
+                            for (ty, row) in self._rows.iteritems())
+        result._cols = self._cols.copy()
+        result._extents = self._extents
+        return result
+
+    def __reduce__(self):
+        return (self.__class__, (dict(self),))
+
+    def get_bbox(self):
+        """Returns the data bounding box of the tiles, in model coords
+
+        :rtype: lib.helpers.Rect
+
+        """
+        if not self:
+            return lib.helpers.Rect()
+        ext = self._extents
+        if ext is None:
+            ext = (min(self._cols), min(self._rows),
+                   max(self._cols), max(self._rows))
+            self._extents = ext
+        tx0, ty0, tx1, ty1 = ext
+        return lib.helpers.Rect(N*tx0, N*ty0,
+                                N*(tx1-tx0+1), N*(ty1-ty0+1))
+
+    def keys_in_range(self, tx0, ty0, tx1, ty1):
+        """Returns the keys within an inclusive range of tile coords
+
+        :rtype: list
+
+        Only the rows in the range are looked at. Narrow ranges are
+        looked up column by column, and wide ones by filtering the row.
+
+        """
+        keys = []
+        width = tx1 - tx0 + 1
+        if width <= 0 or ty1 < ty0:
+            return keys
+        rows = self._rows
+        if ty1 - ty0 + 1 < len(rows):
+            row_items = ((ty, rows.get(ty)) for ty in xrange(ty0, ty1+1))
+        else:
+            row_items = rows.iteritems()
+        for ty, row in row_items:
+            if row is None or ty < ty0 or ty > ty1:
+                continue
+            if width < len(row):
+                keys.extend((tx, ty) for tx in xrange(tx0, tx1+1)
+                            if tx in row)
+            else:
+                keys.extend((tx, ty) for tx in row if tx0 <= tx <= tx1)
+        return keys
+
+    def keys_outside(self, tx0, ty0, tx1, ty1):
+        """Returns the keys outside an inclusive range of tile coords
+
+        :rtype: list
+
+        Rows outside the range are taken whole. Rows inside it are
+        only looked at if some column lies outside the range.
+
+        """
+        keys = []
+        cols_outside = any((tx < tx0 or tx > tx1) for tx in self._cols)
+        for ty, row in self._rows.iteritems():
+            if ty < ty0 or ty > ty1:
+                keys.extend((tx, ty) for tx in row)
+            elif cols_outside:
+                keys.extend((tx, ty) for tx in row
+                            if tx < tx0 or tx > tx1)
+        return keys
+
+
 def get_tiles_bbox(tcoords):
     """Convert tile coords to a data bounding box
 
     :param tcoords: iterable of (tx, ty) coordinate pairs
 
+    If `tcoords` is a `TileDict`, its tracked bounding box is used.
+
     """
+    if isinstance(tcoords, TileDict):
+        return tcoords.get_bbox()
     res = lib.helpers.Rect()
     for tx, ty in tcoords:
         res.expandToIncludeRect(lib.helpers.Rect(N*tx, N*ty, N, N))
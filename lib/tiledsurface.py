@@ -15,6 +15,7 @@ import time
 import sys
 import os
 import contextlib
+import collections
 import logging
 logger = logging.getLogger(__name__)
 
@@ -24,6 +25,7 @@ import mypaintlib
 import helpers
 import math
 import pixbufsurface
+import workerpool
 import lib.surface
 from lib.surface import TileAccessible, TileBlittable, TileCompositable
 from errors import FileHandlingError
@@ -70,6 +72,19 @@ mipmap_dirty_tile = _Tile()
 del mipmap_dirty_tile.rgba
 
 
+def _tile_is_empty(rgba):
+    """True if a tile array is all zeros
+
+    Each pixel is tested as one 64-bit word where the array's layout
+    allows it, which is much quicker than testing each channel.
+    """
+    try:
+        words = rgba.view('uint64')
+    except ValueError:
+        words = rgba
+    return not words.any()
+
+
 ## Class defs: surfaces
 
 class _SurfaceSnapshot (object):
@@ -90,7 +105,7 @@ class MyPaintSurface (TileAccessible, TileBlittable, TileCompositable):
 
         # TODO: pass just what it needs access to, not all of self
         self._backend = mypaintlib.TiledSurface(self)
-        self.tiledict = {}
+        self.tiledict = lib.surface.TileDict()
         self.observers = []
 
         # Used to implement repeating surfaces, like Background
@@ -107,9 +122,16 @@ class MyPaintSurface (TileAccessible, TileBlittable, TileCompositable):
             assert mipmap_surfaces is not None
             self._mipmaps = mipmap_surfaces
 
+        # Nesting depth of begin_atomic() calls, and the tiles written
+        # to since the outermost one: checked for emptiness at the end.
+        self._atomic_depth = 0
+        self._atomic_tiles = set()
+
+        # Offset (dx, dy) of an ongoing interactive move, if any
+        self._move_offset = None
+
         # Forwarding API
         self.set_symmetry_state = self._backend.set_symmetry_state
-        self.begin_atomic = self._backend.begin_atomic
 
         self.get_color = self._backend.get_color
         self.get_alpha = self._backend.get_alpha
@@ -139,10 +161,59 @@ class MyPaintSurface (TileAccessible, TileBlittable, TileCompositable):
                 s.mipmap = None
         return mipmaps
 
+    def begin_atomic(self):
+        """Begin a sequence of drawing operations
+
+        Atomic sections nest. Only the outermost pair of
+        begin_atomic()/end_atomic() calls has any effect, so callers
+        can coalesce many small updates into a single redraw
+        notification.
+
+        """
+        if self._atomic_depth == 0:
+            self._backend.begin_atomic()
+        self._atomic_depth += 1
+
     def end_atomic(self):
+        """End a sequence of drawing operations, notifying observers
+
+        Tiles written to during the atomic section which ended up fully
+        transparent, for example by erasing, are released here.
+
+            >>> surf = MyPaintSurface()
+            >>> surf.begin_atomic()
+            >>> with surf.tile_request(0, 0, readonly=False) as rgba:
+            ...     rgba[...] = 1<<15
+            >>> with surf.tile_request(1, 0, readonly=False) as rgba:
+            ...     rgba[...] = 0
+            >>> surf.end_atomic()
+            >>> surf.tiledict.keys()
+            [(0, 0)]
+
+        """
+        assert self._atomic_depth > 0, "end_atomic() without begin_atomic()"
+        self._atomic_depth -= 1
+        if self._atomic_depth > 0:
+            return
+        bbox = self._backend.end_atomic()
+        tiles = self._atomic_tiles
+        self._atomic_tiles = set()
+        self._remove_empty_tiles(tiles)
+        if (bbox[2] > 0 and bbox[3] > 0):
+            self.notify_observers(*bbox)
+
+    def _flush_atomic(self):
+        """Flush pending changes in an ongoing atomic section
+
+        Needed before anything makes the tiles read-only, because the
+        backend caches writeable tile memory until end_atomic().
+        """
+        if self._atomic_depth == 0:
+            return
         bbox = self._backend.end_atomic()
         if (bbox[2] > 0 and bbox[3] > 0):
             self.notify_observers(*bbox)
+        self._backend.begin_atomic()
 
     @property
     def backend(self):
@@ -154,7 +225,7 @@ class MyPaintSurface (TileAccessible, TileBlittable, TileCompositable):
 
     def clear(self):
         tiles = self.tiledict.keys()
-        self.tiledict = {}
+        self.tiledict = lib.surface.TileDict()
         self.notify_observers(*lib.surface.get_tiles_bbox(tiles))
         if self.mipmap:
             self.mipmap.clear()
@@ -169,37 +240,86 @@ class MyPaintSurface (TileAccessible, TileBlittable, TileCompositable):
         If a tile is neither fully inside nor fully outside the
         rectangle, the part of the tile outside the rectangle will be
         cleared.
+
+            >>> surf = MyPaintSurface()
+            >>> for tx in xrange(-2, 3):
+            ...     with surf.tile_request(tx, 0, readonly=False) as rgba:
+            ...         rgba[...] = 1<<15
+            >>> surf.trim((N/2, 0, N*2, N))
+            >>> sorted(surf.tiledict.keys())
+            [(0, 0), (1, 0), (2, 0)]
+            >>> with surf.tile_request(0, 0, readonly=True) as rgba:
+            ...     int(rgba[0, N/2-1, 3]), int(rgba[0, N/2, 3])
+            (0, 32768)
+
+        Tiles outside are found and dropped by range using the tiledict's
+        row index, at every mipmap level. Tiles shared with snapshots are
+        copied before their edges are cleared, so undo stays cheap.
         """
-        x, y, w, h = rect
+        x, y, w, h = [int(c) for c in rect]
         logger.info("Trim %dx%d%+d%+d", w, h, x, y)
-        trimmed = []
-        for tx, ty in list(self.tiledict.keys()):
-            if tx*N+N < x or ty*N+N < y or tx*N > x+w or ty*N > y+h:
-                trimmed.append((tx, ty))
-                self.tiledict.pop((tx, ty))
-                self._mark_mipmap_dirty(tx, ty)
-            elif (tx*N < x and x < tx*N+N
-                    or ty*N < y and y < ty*N+N
-                    or tx*N < x+w and x+w < tx*N+N
-                    or ty*N < y+h and y+h < ty*N+N):
-                trimmed.append((tx, ty))
-                with self.tile_request(tx, ty, readonly=False) as rgba:
-                    if tx*N < x and x < tx*N+N:
-                        rgba[:, 0:(x - tx*N), :] = 0  # Clear left edge
-
-                    if ty*N < y and y < ty*N+N:
-                        rgba[0:(y - ty*N), :, :] = 0  # Clear top edge
-
-                    if tx*N < x+w and x+w < tx*N+N:
-                        # This slice is [N-1-c for c in range(tx*N+N - (x+w))].
-                        rgba[:, (x+w - tx*N):N, :] = 0  # Clear right edge
-
-                    if ty*N < y+h and y+h < ty*N+N:
-                        # This slice is [N-1-r for r in range(ty*N+N - (y+h))].
-                        rgba[(y+h - ty*N):N, :, :] = 0  # Clear bottom edge
-                self._mark_mipmap_dirty(tx, ty)
-
-        self.notify_observers(*lib.surface.get_tiles_bbox(trimmed))
+        tiledict = self.tiledict
+        changed = tiledict.get_bbox()
+        if w <= 0 or h <= 0:
+            if tiledict:
+                self.clear()
+            return
+        tx0, ty0 = x // N, y // N
+        tx1, ty1 = (x+w-1) // N, (y+h-1) // N
+        # Whole tiles outside the rectangle
+        for pos in tiledict.keys_outside(tx0, ty0, tx1, ty1):
+            del tiledict[pos]
+        self._trim_mipmaps(tx0, ty0, tx1, ty1)
+        # Partial tiles along the edges: the parts outside are cleared
+        left, top = x - tx0*N, y - ty0*N
+        right, bottom = x+w - tx1*N, y+h - ty1*N
+        edges = set()
+        if left > 0:
+            edges.update(tiledict.keys_in_range(tx0, ty0, tx0, ty1))
+        if right < N:
+            edges.update(tiledict.keys_in_range(tx1, ty0, tx1, ty1))
+        if top > 0:
+            edges.update(tiledict.keys_in_range(tx0, ty0, tx1, ty0))
+        if bottom < N:
+            edges.update(tiledict.keys_in_range(tx0, ty1, tx1, ty1))
+        for tx, ty in edges:
+            with self.tile_request(tx, ty, readonly=False) as rgba:
+                if tx == tx0:
+                    rgba[:, :left] = 0
+                if tx == tx1:
+                    rgba[:, right:] = 0
+                if ty == ty0:
+                    rgba[:top] = 0
+                if ty == ty1:
+                    rgba[bottom:] = 0
+        self._remove_empty_tiles(edges)
+        if not changed.empty():
+            self.notify_observers(*changed)
+
+    def _trim_mipmaps(self, tx0, ty0, tx1, ty1):
+        """Drops mipmap tiles outside a range of level 0 tiles
+
+        Mipmap tiles straddling the edge of the range are marked dirty.
+        """
+        for level, mipmap in enumerate(self._mipmaps or ()):
+            if level == 0:
+                continue
+            tiledict = mipmap.tiledict
+            mx0, my0 = tx0 >> level, ty0 >> level
+            mx1, my1 = tx1 >> level, ty1 >> level
+            for pos in tiledict.keys_outside(mx0, my0, mx1, my1):
+                del tiledict[pos]
+            edges = []
+            if (mx0 << level) < tx0:
+                edges.extend(tiledict.keys_in_range(mx0, my0, mx0, my1))
+            if ((mx1+1) << level) - 1 > tx1:
+                edges.extend(tiledict.keys_in_range(mx1, my0, mx1, my1))
+            if (my0 << level) < ty0:
+                edges.extend(tiledict.keys_in_range(mx0, my0, mx1, my0))
+            if ((my1+1) << level) - 1 > ty1:
+                edges.extend(tiledict.keys_in_range(mx0, my1, mx1, my1))
+            for pos in edges:
+                tiledict[pos] = mipmap_dirty_tile
 
     @contextlib.contextmanager
     def tile_request(self, tx, ty, readonly):
@@ -246,6 +366,52 @@ class MyPaintSurface (TileAccessible, TileBlittable, TileCompositable):
         yield numpy_tile
         self._set_tile_numpy(tx, ty, numpy_tile, readonly)
 
+    @contextlib.contextmanager
+    def _display_tile_request(self, tx, ty):
+        """Read-only tile request, showing any ongoing move's offset
+
+        While a `_TiledSurfaceMove` is being dragged around, the tiles
+        are left where they are, and rendering assembles each tile from
+        up to four of the unmoved ones instead. This works at any
+        mipmap level, with the offset rounded down to that level.
+
+        """
+        offset = None
+        if self._mipmaps:
+            offset = self._mipmaps[0]._move_offset
+        if not offset:
+            with self.tile_request(tx, ty, readonly=True) as src:
+                yield src
+            return
+        level = self.mipmap_level
+        sx, rx = divmod(tx*N - (offset[0] >> level), N)
+        sy, ry = divmod(ty*N - (offset[1] >> level), N)
+        # Parts of the moved tile: (src_t, src_c0, src_c1, dst_c0)
+        xparts = [(sx, rx, N, 0)]
+        if rx:
+            xparts.append((sx+1, 0, rx, N-rx))
+        yparts = [(sy, ry, N, 0)]
+        if ry:
+            yparts.append((sy+1, 0, ry, N-ry))
+        dst = None
+        for src_tx, src_x0, src_x1, dst_x0 in xparts:
+            dst_x1 = dst_x0 + (src_x1 - src_x0)
+            for src_ty, src_y0, src_y1, dst_y0 in yparts:
+                dst_y1 = dst_y0 + (src_y1 - src_y0)
+                with self.tile_request(src_tx, src_ty, readonly=True) as src:
+                    if src is transparent_tile.rgba:
+                        continue
+                    if not (rx or ry):
+                        dst = src
+                        break
+                    if dst is None:
+                        dst = numpy.zeros((N, N, 4), 'uint16')
+                    dst[dst_y0:dst_y1, dst_x0:dst_x1] \
+                        = src[src_y0:src_y1, src_x0:src_x1]
+        if dst is None:
+            dst = transparent_tile.rgba
+        yield dst
+
     def _regenerate_mipmap(self, t, tx, ty):
         t = _Tile()
         self.tiledict[(tx, ty)] = t
@@ -291,6 +457,8 @@ class MyPaintSurface (TileAccessible, TileBlittable, TileCompositable):
         if not readonly:
             # assert self.mipmap_level == 0
             self._mark_mipmap_dirty(tx, ty)
+            if self._atomic_depth > 0:
+                self._atomic_tiles.add((tx, ty))
         return t.rgba
 
     def _set_tile_numpy(self, tx, ty, obj, readonly):
@@ -330,7 +498,7 @@ class MyPaintSurface (TileAccessible, TileBlittable, TileCompositable):
             raise ValueError('Unsupported destination buffer type %r', dst.dtype)
         dst_is_uint16 = (dst.dtype == 'uint16')
 
-        with self.tile_request(tx, ty, readonly=True) as src:
+        with self._display_tile_request(tx, ty) as src:
             if src is transparent_tile.rgba:
                 #dst[:] = 0 # <-- notably slower than memset()
                 if dst_is_uint16:
@@ -379,7 +547,7 @@ class MyPaintSurface (TileAccessible, TileBlittable, TileCompositable):
 
         # Tile request at the required level.
         # Try optimizations again if we got the special marker tile
-        with self.tile_request(tx, ty, readonly=True) as src:
+        with self._display_tile_request(tx, ty) as src:
             if src is transparent_tile.rgba:
                 if dst_has_alpha:
                     if mode in lib.modes.MODES_CLEARING_BACKDROP_AT_ZERO_ALPHA:
@@ -399,6 +567,7 @@ class MyPaintSurface (TileAccessible, TileBlittable, TileCompositable):
         tile_request() for how new read/write tiles can be unlocked.
 
         """
+        self._flush_atomic()
         sshot = _SurfaceSnapshot()
         for t in self.tiledict.itervalues():
             t.readonly = True
@@ -416,7 +585,10 @@ class MyPaintSurface (TileAccessible, TileBlittable, TileCompositable):
             # testcase: comparison above (if equal) takes 0.6ms, code below 30ms
             return
         old = set(self.tiledict.iteritems())
-        self.tiledict = d.copy()
+        if isinstance(d, lib.surface.TileDict):
+            self.tiledict = d.copy()
+        else:
+            self.tiledict = lib.surface.TileDict(d)
         new = set(self.tiledict.iteritems())
         dirty = old.symmetric_difference(new)
         for pos, tile in dirty:
@@ -433,7 +605,7 @@ class MyPaintSurface (TileAccessible, TileBlittable, TileCompositable):
 
     def _load_from_pixbufsurface(self, s):
         dirty_tiles = set(self.tiledict.keys())
-        self.tiledict = {}
+        self.tiledict = lib.surface.TileDict()
 
         for tx, ty in s.get_tiles():
             with self.tile_request(tx, ty, readonly=False) as dst:
@@ -482,7 +654,7 @@ class MyPaintSurface (TileAccessible, TileBlittable, TileCompositable):
 
         """
         dirty_tiles = set(self.tiledict.keys())
-        self.tiledict = {}
+        self.tiledict = lib.surface.TileDict()
 
         state = {}
         state['buf'] = None  # array of height N, width depends on image
@@ -568,7 +740,33 @@ class MyPaintSurface (TileAccessible, TileBlittable, TileCompositable):
         lib.surface.save_as_png(self, filename, *args, **kwargs)
 
     def get_bbox(self):
-        return lib.surface.get_tiles_bbox(self.tiledict)
+        """The data bounding box, following any ongoing move
+
+        While a move is being dragged, rendering and saving show the
+        content at its offset, so the bbox covers the tiles it is
+        drawn into too.
+
+            >>> surf = MyPaintSurface()
+            >>> with surf.tile_request(0, 0, readonly=False) as a:
+            ...     a[...] = 1<<15
+            >>> move = surf.get_move(0, 0)
+            >>> move.update(N/2, -N)
+            >>> tuple(surf.get_bbox()) == (0, -N, 2*N, N)
+            True
+            >>> move.cleanup()
+            >>> tuple(surf.get_bbox()) == (0, -N, 2*N, N)
+            True
+
+        """
+        bbox = self.tiledict.get_bbox()
+        offset = self._move_offset
+        if not offset or bbox.empty():
+            return bbox
+        x, y = bbox.x + offset[0], bbox.y + offset[1]
+        tx0, ty0 = x // N, y // N
+        tx1 = (x + bbox.w - 1) // N
+        ty1 = (y + bbox.h - 1) // N
+        return helpers.Rect(tx0*N, ty0*N, (tx1-tx0+1)*N, (ty1-ty0+1)*N)
 
     def get_tiles(self):
         return self.tiledict
@@ -577,10 +775,41 @@ class MyPaintSurface (TileAccessible, TileBlittable, TileCompositable):
         return not self.tiledict
 
     def remove_empty_tiles(self):
-        """Removes tiles from the tiledict which contain no data"""
-        for pos, data in self.tiledict.items():
-            if not data.rgba.any():
-                self.tiledict.pop(pos)
+        """Removes tiles from the tiledict which contain no data
+
+            >>> surf = MyPaintSurface()
+            >>> for tx in xrange(3):
+            ...     with surf.tile_request(tx, 0, readonly=False) as rgba:
+            ...         rgba[0, 0, 3] = tx % 2
+            >>> surf.remove_empty_tiles()
+            >>> surf.tiledict.keys()
+            [(1, 0)]
+
+        Surfaces release tiles written to in an atomic section which
+        become empty when it ends, so this is only needed for tiles
+        changed in other ways.
+        """
+        self._remove_empty_tiles(self.tiledict.keys())
+
+    def _remove_empty_tiles(self, tiles):
+        """Removes those of some tiles which contain no data
+
+        Observers are notified about the area of any tiles removed, so
+        that cached bounding boxes are updated.
+        """
+        tiledict = self.tiledict
+        removed = []
+        for pos in tiles:
+            tile = tiledict.get(pos)
+            if tile is None or tile is mipmap_dirty_tile:
+                continue
+            if _tile_is_empty(tile.rgba):
+                del tiledict[pos]
+                self._mark_mipmap_dirty(*pos)
+                removed.append(pos)
+        if removed:
+            bbox = lib.surface.get_tiles_bbox(removed)
+            self.notify_observers(*bbox)
 
     def get_move(self, x, y, sort=True):
         """Returns a move object for this surface
@@ -615,13 +844,14 @@ class MyPaintSurface (TileAccessible, TileBlittable, TileCompositable):
 
 
 class _TiledSurfaceMove (object):
-    """Ongoing move state for a tiled surface, processed in chunks
+    """Ongoing move state for a tiled surface
 
-    Tile move processing involves slicing and copying data from a
-    snapshot of the surface's original tile arrays into an active
-    surface within the model document. It's therefore potentially very
-    slow for huge layers: doing this interactively requires the move to
-    be processed in chunks in idle routines.
+    Moves are shown interactively without touching any tile data: while
+    a move is active, the surface renders itself offset by the current
+    move amount, assembling each displayed tile from the unmoved ones.
+    The real slicing and copying into new tiles happens only once, when
+    the move is cleaned up, and it is spread over the shared worker
+    pool.
 
     Moves are created by a surface's get_move() method starting at a
     particular point in model coordinates.
@@ -634,19 +864,16 @@ class _TiledSurfaceMove (object):
         >>> move = surf.get_move(N/2, N/2, sort=True)
 
     During an interactive move, the move object is typically updated in
-    response to the user moving the pointer,
+    response to the user moving the pointer. This is cheap: only the
+    offset and a redraw notification are involved.
 
         >>> move.update(N/2, N/2)
         >>> move.update(N/2 + 1, N/2 + 3)
+        >>> len(surf.tiledict)
+        1
 
-    while being processed in chunks of a few hundred tiles in an idle
-    routine.
-
-        >>> while move.process():
-        ...     pass
-
-    When the user is done moving things and releases the layer, or quits
-    the layer moving mode, the conventional way of finalizing things is
+    For compatibility with older callers, moves can still be processed,
+    but there's never any work to do until the cleanup.
 
         >>> move.process(n=-1)
         False
@@ -671,51 +898,35 @@ class _TiledSurfaceMove (object):
         [(-3, 2)]
         >>> move = surf.get_move(0, 0, sort=False)
         >>> move.update(N*3, -N*2)
-        >>> move.process(n=1)   # single op suffices
+        >>> move.process(n=1)
         False
         >>> move.cleanup()
         >>> surf.tiledict.keys()
         [(0, 0)]
-        >>> # Please excuse the doctest for this special case
-        >>> # just regression-proofing.
 
     Moves can be processed non-interactively by calling all the
     different phases together, as above.
 
     """
 
+    #: Target tiles sliced per worker pool job in cleanup()
+    SLICE_CHUNK_SIZE = 64
+
     def __init__(self, surface, x, y, sort=True):
         """Starts the move, recording state in the Move object
 
         :param x: Where to start, model X coordinate
         :param y: Where to start, model Y coordinate
-        :param sort: If true, sort tiles to move by distance from (x,y)
-
-        Sorting tiles by distance makes the move look nicer when moving
-        interactively, but it's pointless for non-interactive moves.
+        :param sort: Ignored; kept for compatibility
 
         """
         object.__init__(self)
         self.surface = surface
         self.snapshot = surface.save_snapshot()
-        self.chunks = self.snapshot.tiledict.keys()
-        self.sort = sort
-        tx = x // N
-        ty = y // N
         self.start_pos = (x, y)
-        if self.sort:
-            manhattan_dist = lambda p: abs(tx - p[0]) + abs(ty - p[1])
-            self.chunks.sort(key=manhattan_dist)
-        # High water mark of chunks processed so far.
-        # This is reset on every call to update().
-        self.chunks_i = 0
-        # Tile state tracking for individual update cycles
-        self.written = set()
-        self.blank_queue = []
-        # Tile offsets which we'll be applying,
-        # initially the move is zero.
-        self.slices_x = calc_translation_slices(0)
-        self.slices_y = calc_translation_slices(0)
+        self.dx = 0
+        self.dy = 0
+        surface._move_offset = (0, 0)
 
     def update(self, dx, dy):
         """Updates the offset during a move
@@ -723,139 +934,122 @@ class _TiledSurfaceMove (object):
         :param dx: New move offset: relative to the constructor x.
         :param dy: New move offset: relative to the constructor y.
 
-        This causes all the move's work to be re-queued.
+        The surface is redrawn at the new offset, but no tiles are moved
+        until `cleanup()`.
         """
-        # Nothing has been written in this pass yet
-        self.written = set()
-        # Tile indices to be cleared during processing,
-        # unless they've been written to
-        self.blank_queue = self.surface.tiledict.keys()  # fresh!
-        if self.sort:
-            x, y = self.start_pos
-            tx = (x + dx) // N
-            ty = (y + dy) // N
-            manhattan_dist = lambda p: abs(tx - p[0]) + abs(ty - p[1])
-            self.blank_queue.sort(key=manhattan_dist)
-        # Calculate offsets
-        self.slices_x = calc_translation_slices(int(dx))
-        self.slices_y = calc_translation_slices(int(dy))
-        # Need to process every source chunk
-        self.chunks_i = 0
+        dx, dy = int(dx), int(dy)
+        if (dx, dy) == (self.dx, self.dy):
+            return
+        bbox = lib.surface.get_tiles_bbox(self.snapshot.tiledict)
+        redraw = bbox.copy()
+        redraw.x += self.dx
+        redraw.y += self.dy
+        bbox.x += dx
+        bbox.y += dy
+        redraw.expandToIncludeRect(bbox)
+        self.dx, self.dy = dx, dy
+        self.surface._move_offset = (dx, dy)
+        if not redraw.empty():
+            self.surface.notify_observers(*redraw)
 
-    def cleanup(self):
-        """Cleans up after processing the move.
+    def process(self, n=200):
+        """Process pending tile moves (nothing to do)
 
-        This must be called after the move has been processed fully, and
-        should only be called after `process()` indicates that all tiles have
-        been sliced and moved.
+        :param int n: Ignored
+        :returns: False, since the work is done by `cleanup()`
+        :rtype: bool
 
         """
-        # Process any remaining work. Caller should have done this already.
-        if self.chunks_i < len(self.chunks) or len(self.blank_queue) > 0:
-            logger.warning("Stuff left to do at end of move cleanup(). May "
-                           "result in poor interactive appearance. "
-                           "chunks=%d/%d, blanks=%d", self.chunks_i,
-                           len(self.chunks), len(self.blank_queue))
-            logger.warning("Doing cleanup now...")
-            self.process(n=-1)
-        assert self.chunks_i >= len(self.chunks)
-        assert len(self.blank_queue) == 0
-        # Remove empty tiles created by Layer Move
-        self.surface.remove_empty_tiles()
-
-    def process(self, n=200):
-        """Process a number of pending tile moves
+        return False
 
-        :param int n: The number of source tiles to process in this call
-        :returns: whether there are any more tiles to process
-        :rtype: bool
+    def cleanup(self):
+        """Finishes the move, moving the tile data to its new position
 
-        Specify zero or negative `n` to process all remaining tiles.
+        This must be called exactly once at the end of the move.
 
         """
-        updated = set()
-        moves_remaining = self._process_moves(n, updated)
-        blanks_remaining = self._process_blanks(n, updated)
+        surface = self.surface
+        surface._move_offset = None
+        dx, dy = self.dx, self.dy
+        if dx == 0 and dy == 0:
+            return
+        src_tiles = self.snapshot.tiledict
+        if dx % N == 0 and dy % N == 0:
+            moved = self._move_integral(src_tiles, dx // N, dy // N)
+        else:
+            moved = self._move_sliced(src_tiles, dx, dy)
+        # Swap in the moved tiles, and tell everything about it
+        updated = set(src_tiles.iterkeys())
+        updated.update(surface.tiledict.iterkeys())
+        updated.update(moved.iterkeys())
+        surface.tiledict = moved
         for pos in updated:
-            self.surface._mark_mipmap_dirty(*pos)
+            surface._mark_mipmap_dirty(*pos)
         bbox = lib.surface.get_tiles_bbox(updated)
-        self.surface.notify_observers(*bbox)
-        return blanks_remaining or moves_remaining
+        surface.notify_observers(*bbox)
 
-    def _process_moves(self, n, updated):
-        """Internal: process pending tile moves
+    @staticmethod
+    def _move_integral(src_tiles, tdx, tdy):
+        """Moves by whole tiles, reusing the snapshot's tiles
 
-        :param int n: as for process()
-        :param set updated: Set of tile indices to be redrawn (in+out)
-        :returns: Whether moves need to be processed
-        :rtype: bool
+        The snapshot's tiles are all read-only, so they can be shared
+        with the surface under new keys. The first write to any of them
+        makes a private copy, as it would after any other snapshot.
 
         """
-        if self.chunks_i > len(self.chunks):
-            return False
-        if n <= 0:
-            n = len(self.chunks)  # process all remaining
-        is_integral = len(self.slices_x) == 1 and len(self.slices_y) == 1
-        for src_t in self.chunks[self.chunks_i:self.chunks_i + n]:
-            src_tx, src_ty = src_t
-            src_tile = self.snapshot.tiledict[src_t]
-            for slice_x in self.slices_x:
-                (src_x0, src_x1), (targ_tdx, targ_x0, targ_x1) = slice_x
-                for slice_y in self.slices_y:
-                    (src_y0, src_y1), (targ_tdy, targ_y0, targ_y1) = slice_y
-                    targ_tx = src_tx + targ_tdx
-                    targ_ty = src_ty + targ_tdy
-                    targ_t = targ_tx, targ_ty
-                    if is_integral:
-                        # We're lucky. Perform a straight data copy.
-                        self.surface.tiledict[targ_t] = src_tile.copy()
-                        updated.add(targ_t)
-                        self.written.add(targ_t)
-                        continue
-                    # Get a tile to write
-                    targ_tile = None
-                    if targ_t in self.written:
-                        # Reuse a target tile made earlier in this
-                        # update cycle
-                        targ_tile = self.surface.tiledict.get(targ_t, None)
-                    if targ_tile is None:
-                        # Create and store a new blank target tile
-                        # to avoid corruption
-                        targ_tile = _Tile()
-                        self.surface.tiledict[targ_t] = targ_tile
-                        self.written.add(targ_t)
-                    # Copy this source slice to the destination
-                    targ_tile.rgba[targ_y0:targ_y1, targ_x0:targ_x1] \
-                        = src_tile.rgba[src_y0:src_y1, src_x0:src_x1]
-                    updated.add(targ_t)
-            # The source tile has been fully processed at this point,
-            # and can be removed from the output dict if it hasn't
-            # also been written to.
-            if src_t in self.surface.tiledict and src_t not in self.written:
-                self.surface.tiledict.pop(src_t, None)
-                updated.add(src_t)
-        # Move on, and return whether we're complete
-        self.chunks_i += n
-        return self.chunks_i < len(self.chunks)
-
-    def _process_blanks(self, n, updated):
-        """Internal: process blanking-out queue
-
-        :param int n: as for process()
-        :param set updated: Set of tile indices to be redrawn (in+out)
-        :returns: Whether the blanking queue is empty
-        :rtype: bool
+        moved = lib.surface.TileDict()
+        for (tx, ty), tile in src_tiles.iteritems():
+            assert tile.readonly
+            moved[tx + tdx, ty + tdy] = tile
+        return moved
+
+    def _move_sliced(self, src_tiles, dx, dy):
+        """Moves by a non-integral number of tiles, in the worker pool"""
+        slices_x = calc_translation_slices(dx)
+        slices_y = calc_translation_slices(dy)
+        # Plan which parts of which source tiles make up each target
+        targets = {}
+        for (src_tx, src_ty), src_tile in src_tiles.iteritems():
+            for (src_x0, src_x1), (targ_tdx, targ_x0, targ_x1) in slices_x:
+                for (src_y0, src_y1), (targ_tdy, targ_y0, targ_y1) \
+                        in slices_y:
+                    targ_t = (src_tx + targ_tdx, src_ty + targ_tdy)
+                    targets.setdefault(targ_t, []).append((
+                        src_tile,
+                        (src_y0, src_y1, src_x0, src_x1),
+                        (targ_y0, targ_y1, targ_x0, targ_x1),
+                    ))
+        # Slice and copy in parallel
+        targets = targets.items()
+        pool = workerpool.get_shared_pool()
+        size = self.SLICE_CHUNK_SIZE
+        jobs = [
+            pool.add_work(_slice_moved_tiles, targets[i:i+size])
+            for i in xrange(0, len(targets), size)
+        ]
+        moved = lib.surface.TileDict()
+        for job in jobs:
+            for targ_t, tile in job.wait():
+                moved[targ_t] = tile
+        return moved
 
-        """
-        if n <= 0:
-            n = len(self.blank_queue)
-        while len(self.blank_queue) > 0 and n > 0:
-            t = self.blank_queue.pop(0)
-            if t not in self.written:
-                self.surface.tiledict.pop(t, None)
-                updated.add(t)
-                n -= 1
-        return len(self.blank_queue) > 0
+
+def _slice_moved_tiles(targets):
+    """Worker job: assemble moved tiles from slices of source tiles
+
+    :param list targets: [(targ_t, [(src_tile, src_slice, targ_slice)])]
+    :returns: [(targ_t, _Tile)] for the non-empty targets
+
+    """
+    results = []
+    for targ_t, parts in targets:
+        tile = _Tile()
+        dst = tile.rgba
+        for src_tile, (sy0, sy1, sx0, sx1), (ty0, ty1, tx0, tx1) in parts:
+            dst[ty0:ty1, tx0:tx1] = src_tile.rgba[sy0:sy1, sx0:sx1]
+        if not _tile_is_empty(dst):
+            results.append((targ_t, tile))
+    return results
 
 
 def calc_translation_slices(dc):
@@ -980,7 +1174,7 @@ class Background (Surface):
             return super(Background, self).load_from_numpy(arr, x, y)
 
 
-def flood_fill(src, x, y, color, bbox, tolerance, dst):
+def flood_fill(src, x, y, color, bbox, tolerance, dst, stats=None):
     """Fills connected areas of one surface into another
 
     :param src: Source surface-like object
@@ -995,8 +1189,73 @@ def flood_fill(src, x, y, color, bbox, tolerance, dst):
     :type tolerance: float [0.0, 1.0]
     :param dst: Target surface
     :type dst: lib.tiledsurface.MyPaintSurface
+    :param dict stats: optional counts to update; see fill_tiles()
 
     See also `lib.layer.Layer.flood_fill()`.
+    """
+    filled = fill_tiles(src, x, y, color, bbox, tolerance, stats=stats)
+    composite_fill(filled, dst)
+
+
+def composite_fill(filled, dst):
+    """Composites tiles made by fill_tiles() into a surface
+
+    :param dict filled: filled tiles, as returned by fill_tiles()
+    :param dst: Target surface
+    :type dst: lib.tiledsurface.MyPaintSurface
+
+    The target's observers are notified about the changed area.
+    """
+    if not filled:
+        return
+    mode = mypaintlib.CombineNormal
+    for (tx, ty), src_tile in filled.iteritems():
+        with dst.tile_request(tx, ty, readonly=False) as dst_tile:
+            mypaintlib.tile_combine(mode, src_tile, dst_tile, True, 1.0)
+        dst._mark_mipmap_dirty(tx, ty)
+    bbox = lib.surface.get_tiles_bbox(filled)
+    dst.notify_observers(*bbox)
+
+
+#: Largest number of fill buffers fill_tiles() allocates at once
+_FILL_BLOCK_SIZE = 64
+
+
+def fill_tiles(src, x, y, color, bbox, tolerance, stats=None):
+    """Flood-fills connected areas of a surface into new tiles
+
+    :param src: Source surface-like object
+    :type src: Anything supporting readonly tile_request()
+    :param x: Starting point X coordinate
+    :param y: Starting point Y coordinate
+    :param color: an RGB color
+    :type color: tuple
+    :param bbox: Bounding box: limits the fill
+    :type bbox: lib.helpers.Rect or equivalent 4-tuple
+    :param tolerance: how much filled pixels are permitted to vary
+    :type tolerance: float [0.0, 1.0]
+    :param dict stats: optional counts to update (see below)
+    :returns: the filled tiles, as {(tx, ty): NxNx4 uint16 array}
+    :rtype: dict
+
+    The fill spreads out from the seed point one tile at a time, using
+    the native scanline fill for each tile. Where it overflows a tile
+    edge, the overflow seeds are merged into a single set of pending
+    seeds for the neighbouring tile, and that tile is queued only if it
+    was not already waiting. Each tile is therefore filled once for all
+    the seeds that reached it in the meantime, rather than once for
+    every edge the fill crossed into it. Tiles which end up with no
+    filled pixels are left out of the result.
+
+    If `stats` is a dict, the following counts are added to it:
+
+    * "tiles": filled tiles returned
+    * "visits": calls to the per-tile fill
+    * "seeds": seeds passed to those calls, after merging
+
+    Each seed starts at most one scanline span, so "seeds" is an upper
+    bound on the number of spans the fill examined.
+
     """
     # Color to fill with
     fill_r, fill_g, fill_b = color
@@ -1007,7 +1266,7 @@ def flood_fill(src, x, y, color, bbox, tolerance, dst):
     # Maximum area to fill: tile and in-tile pixel extents
     bbx, bby, bbw, bbh = bbox
     if bbh <= 0 or bbw <= 0:
-        return
+        return {}
     bbbrx = bbx + bbw - 1
     bbbry = bby + bbh - 1
     min_tx = int(bbx // N)
@@ -1022,6 +1281,8 @@ def flood_fill(src, x, y, color, bbox, tolerance, dst):
     # Tile and pixel addressing for the seed point
     tx, ty = int(x // N), int(y // N)
     px, py = int(x % N), int(y % N)
+    if not (min_tx <= tx <= max_tx and min_ty <= ty <= max_ty):
+        return {}
 
     # Sample the pixel color there to obtain the target color
     with src.tile_request(tx, ty, readonly=True) as start:
@@ -1032,19 +1293,31 @@ def flood_fill(src, x, y, color, bbox, tolerance, dst):
         targ_b = 0
         targ_a = 0
 
-    # Flood-fill loop
+    # Work queue of tiles, and the seeds pending for each queued tile
+    queue = collections.deque([(tx, ty)])
+    pending = {(tx, ty): set([(px, py)])}
+
+    def _enqueue(tpos, seeds):
+        tile_seeds = pending.get(tpos)
+        if tile_seeds is None:
+            pending[tpos] = set(seeds)
+            queue.append(tpos)
+        else:
+            tile_seeds.update(seeds)
+
+    # Fill buffers are handed out as views of zeroed blocks, which grow
+    # with the fill so that small fills stay small.
     filled = {}
-    tileq = [
-        ((tx, ty),
-         [(px, py)])
-    ]
-    while len(tileq) > 0:
-        (tx, ty), seeds = tileq.pop(0)
-        # Bbox-derived limits
-        if tx > max_tx or ty > max_ty:
-            continue
-        if tx < min_tx or ty < min_ty:
-            continue
+    block = ()
+    block_used = 0
+    visits = 0
+    nseeds = 0
+
+    # Flood-fill loop
+    while queue:
+        tpos = queue.popleft()
+        seeds = list(pending.pop(tpos))
+        tx, ty = tpos
         # Pixel limits within this tile...
         min_x = 0
         min_y = 0
@@ -1060,11 +1333,16 @@ def flood_fill(src, x, y, color, bbox, tolerance, dst):
         if ty == max_ty:
             max_y = max_py
         # Flood-fill one tile
+        dst_tile = filled.get(tpos)
+        if dst_tile is None:
+            if block_used >= len(block):
+                size = min(_FILL_BLOCK_SIZE, max(1, len(filled)))
+                block = numpy.zeros((size, N, N, 4), 'uint16')
+                block_used = 0
+            dst_tile = block[block_used]
+            block_used += 1
+            filled[tpos] = dst_tile
         with src.tile_request(tx, ty, readonly=True) as src_tile:
-            dst_tile = filled.get((tx, ty), None)
-            if dst_tile is None:
-                dst_tile = numpy.zeros((N, N, 4), 'uint16')
-                filled[(tx, ty)] = dst_tile
             overflows = mypaintlib.tile_flood_fill(
                 src_tile, dst_tile, seeds,
                 targ_r, targ_g, targ_b, targ_a,
@@ -1072,29 +1350,111 @@ def flood_fill(src, x, y, color, bbox, tolerance, dst):
                 min_x, min_y, max_x, max_y,
                 tolerance
             )
-            seeds_n, seeds_e, seeds_s, seeds_w = overflows
-        # Enqueue overflows in each cardinal direction
+        visits += 1
+        nseeds += len(seeds)
+        seeds_n, seeds_e, seeds_s, seeds_w = overflows
+        # Merge overflows into the neighbours' pending seeds
         if seeds_n and ty > min_ty:
-            tpos = (tx, ty-1)
-            tileq.append((tpos, seeds_n))
+            _enqueue((tx, ty-1), seeds_n)
         if seeds_w and tx > min_tx:
-            tpos = (tx-1, ty)
-            tileq.append((tpos, seeds_w))
+            _enqueue((tx-1, ty), seeds_w)
         if seeds_s and ty < max_ty:
-            tpos = (tx, ty+1)
-            tileq.append((tpos, seeds_s))
+            _enqueue((tx, ty+1), seeds_s)
         if seeds_e and tx < max_tx:
-            tpos = (tx+1, ty)
-            tileq.append((tpos, seeds_e))
+            _enqueue((tx+1, ty), seeds_e)
+
+    # Drop tiles where none of the seeds turned out to match
+    for tpos, dst_tile in filled.items():
+        if not dst_tile[:, :, 3].any():
+            del filled[tpos]
+
+    if stats is not None:
+        stats["tiles"] = stats.get("tiles", 0) + len(filled)
+        stats["visits"] = stats.get("visits", 0) + visits
+        stats["seeds"] = stats.get("seeds", 0) + nseeds
+    return filled
+
+
+class FillDistances (TileAccessible):
+    """A fill source's color distances from its seed point, by tile
+
+    Flood fills compare the color of each pixel they reach with the
+    color at the seed point, and the result decides both whether the
+    pixel is filled and how strongly. This wraps a fill source, and
+    works out those distances lazily for each tile the fill reaches,
+    keeping them for later. Its tiles are grey and opaque, with each
+    pixel's distance as its color, so filling them from the same seed
+    point gives the same result as filling the source itself.
+
+    Changing only the tolerance of a fill therefore doesn't need the
+    source to be sampled or composited again, which makes it cheap to
+    preview fills while their tolerance is adjusted.
+
+        >>> src = Surface()
+        >>> with src.tile_request(0, 0, readonly=False) as rgba:
+        ...     rgba[:, N/2:] = (1<<15, 0, 0, 1<<15)
+        >>> dists = FillDistances(src, 0, 0)
+        >>> bbox = (0, 0, N*2, N)
+        >>> filled = fill_tiles(dists, 0, 0, (1.0, 1.0, 1.0), bbox, 0.5)
+        >>> sorted(filled.keys())
+        [(0, 0)]
+        >>> int(filled[(0, 0)][0, N/2-1, 3]), int(filled[(0, 0)][0, N/2, 3])
+        (32768, 0)
+        >>> len(dists.get_tiles())
+        1
 
-    # Composite filled tiles into the destination surface
-    mode = mypaintlib.CombineNormal
-    for (tx, ty), src_tile in filled.iteritems():
-        with dst.tile_request(tx, ty, readonly=False) as dst_tile:
-            mypaintlib.tile_combine(mode, src_tile, dst_tile, True, 1.0)
-        dst._mark_mipmap_dirty(tx, ty)
-    bbox = lib.surface.get_tiles_bbox(filled)
-    dst.notify_observers(*bbox)
+    """
+
+    def __init__(self, src, x, y):
+        """Initialize, sampling the seed color
+
+        :param src: Source surface-like object
+        :type src: Anything supporting readonly tile_request()
+        :param x: Seed point X coordinate
+        :param y: Seed point Y coordinate
+
+        """
+        super(FillDistances, self).__init__()
+        self._src = src
+        self._tiles = {}
+        tx, ty = int(x // N), int(y // N)
+        px, py = int(x % N), int(y % N)
+        with src.tile_request(tx, ty, readonly=True) as start:
+            targ = numpy.array(start[py, px], dtype='int64')
+        self._targ = self._unpremultiply(targ)
+
+    @staticmethod
+    def _unpremultiply(rgba):
+        """Un-premultiplied, clamped fix15 colors, as the fill sees them"""
+        rgba = numpy.asarray(rgba, dtype='int64')
+        alpha = rgba[..., 3:]
+        rgb = (rgba[..., :3] << 15) // numpy.maximum(alpha, 1)
+        rgb = numpy.where(alpha > 0, rgb, 0)
+        result = numpy.concatenate((rgb, alpha), axis=-1)
+        return numpy.clip(result, 0, 1<<15)
+
+    @contextlib.contextmanager
+    def tile_request(self, tx, ty, readonly):
+        """Context manager that fetches a tile of distances"""
+        if not readonly:
+            raise ValueError("Only readonly tile requests are supported")
+        tile = self._tiles.get((tx, ty))
+        if tile is None:
+            with self._src.tile_request(tx, ty, readonly=True) as src:
+                colors = self._unpremultiply(src)
+            dist = numpy.abs(colors - self._targ).max(axis=-1)
+            tile = numpy.empty((N, N, 4), 'uint16')
+            tile[..., :3] = dist[..., numpy.newaxis]
+            tile[..., 3] = 1 << 15
+            self._tiles[(tx, ty)] = tile
+        yield tile
+
+    def get_tiles(self):
+        """The tiles whose distances are known"""
+        return self._tiles
+
+    def get_bbox(self):
+        return self._src.get_bbox()
 
 
 class PNGFileUpdateTask (object):
@@ -1122,6 +1482,8 @@ class PNGFileUpdateTask (object):
             looped_size=surface.looped_size,
         )
         clone_surface.load_snapshot(surface.save_snapshot())
+        # Keep showing any ongoing move, as of now, to match the rect
+        clone_surface._move_offset = surface._move_offset
         # Open a tempfile for writing
         tmp_filename = filename + ".tmp"
         if os.path.exists(tmp_filename):
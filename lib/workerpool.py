@@ -0,0 +1,196 @@
+# This file is part of MyPaint.
+# Copyright (C) 2015 by the MyPaint Development Team
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+
+"""Threaded background processing for independent chunks of work.
+
+This is the threaded counterpart of `lib.idletask`. Work queued here
+runs in a small pool of daemon threads, and must not touch GTK or any
+mutable model state. It's intended for per-tile jobs over immutable
+data such as surface snapshots, where the heavy lifting happens in code
+which releases the GIL (zlib, most of NumPy).
+
+    >>> pool = Pool(nworkers=2)
+    >>> jobs = [pool.add_work(pow, i, 2) for i in xrange(10)]
+    >>> [j.wait() for j in jobs]
+    [0, 1, 4, 9, 16, 25, 36, 49, 64, 81]
+
+Exceptions raised by the work function are re-raised by `Job.wait()`.
+
+    >>> job = pool.add_work(int, "not a number")
+    >>> job.wait()
+    Traceback (most recent call last):
+    ...
+    ValueError: invalid literal for int() with base 10: 'not a number'
+    >>> pool.stop()
+
+"""
+
+
+## Imports
+
+import sys
+import threading
+import Queue
+import multiprocessing
+import logging
+logger = logging.getLogger(__name__)
+
+
+## Class defs
+
+class Job (object):
+    """Handle for a single unit of work queued on a `Pool`"""
+
+    def __init__(self, func, args, kwargs):
+        super(Job, self).__init__()
+        self._func = func
+        self._args = args
+        self._kwargs = kwargs
+        self._done = threading.Event()
+        self._result = None
+        self._exc_info = None
+
+    def done(self):
+        """Returns true if the work has finished (or failed)"""
+        return self._done.is_set()
+
+    def wait(self):
+        """Waits for the work to complete, and returns its result
+
+        If the work function raised an exception, it is re-raised here
+        in the waiting thread.
+
+        """
+        self._done.wait()
+        if self._exc_info is not None:
+            exc_type, exc_value, exc_tb = self._exc_info
+            raise exc_type, exc_value, exc_tb
+        return self._result
+
+    def _run(self):
+        """Internal: runs the work function (in a worker thread)"""
+        try:
+            self._result = self._func(*self._args, **self._kwargs)
+        except:
+            self._exc_info = sys.exc_info()
+        finally:
+            self._func = self._args = self._kwargs = None
+            self._done.set()
+
+
+class Pool (object):
+    """Pool of worker threads processing a FIFO queue of jobs"""
+
+    def __init__(self, nworkers=None):
+        """Initialize, with an optional number of worker threads
+
+        :param int nworkers: Number of threads; default: number of CPUs
+
+        Threads are started lazily, when work is first added.
+
+        """
+        super(Pool, self).__init__()
+        if nworkers is None:
+            try:
+                nworkers = multiprocessing.cpu_count()
+            except NotImplementedError:
+                nworkers = 2
+        self._nworkers = max(1, int(nworkers))
+        self._queue = Queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def add_work(self, func, *args, **kwargs):
+        """Queues work, returning a `Job` handle for its result
+
+        :param func: a callable, run exactly once in a worker thread
+        :param *args: passed to func
+        :param **kwargs: passed to func
+        :rtype: Job
+
+        """
+        job = Job(func, args, kwargs)
+        with self._lock:
+            if not self._threads:
+                self._start_threads()
+        self._queue.put(job)
+        return job
+
+    def map(self, func, iterable):
+        """Runs func over every item in parallel, returning the results
+
+        :param func: a callable taking one argument
+        :param iterable: items to process
+        :rtype: list
+
+        Blocks until all items have been processed. Results are in the
+        same order as the input.
+
+        """
+        jobs = [self.add_work(func, item) for item in iterable]
+        return [job.wait() for job in jobs]
+
+    def stop(self):
+        """Stops the worker threads after any queued work is done"""
+        with self._lock:
+            for thread in self._threads:
+                self._queue.put(None)
+            for thread in self._threads:
+                thread.join()
+            self._threads = []
+
+    def _start_threads(self):
+        for i in xrange(self._nworkers):
+            thread = threading.Thread(
+                target = self._worker,
+                name = "%s-%d" % (__name__, i),
+            )
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _worker(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                break
+            job._run()
+
+
+## Shared pool
+
+_shared_pool = None
+_shared_pool_lock = threading.Lock()
+
+
+def get_shared_pool():
+    """Returns the process-wide shared worker pool
+
+    :rtype: Pool
+
+    """
+    global _shared_pool
+    with _shared_pool_lock:
+        if _shared_pool is None:
+            _shared_pool = Pool()
+        return _shared_pool
+
+
+## Module testing
+
+
+def _test():
+    """Run doctest strings"""
+    import doctest
+    doctest.testmod(optionflags=doctest.ELLIPSIS)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.DEBUG)
+    _test()
@@ -91,3 +91,15 @@ class GUI:
         doc = self.app.doc
         for i in range(steps):
             doc.zoom(doc.ZOOM_OUTWARDS)
+
+    def zoom_smoothly(self, steps, N=20):
+        """Drag-zoom out by a number of zoom steps, then back in"""
+        tdw = self.app.doc.tdw
+        start = tdw.scale
+        self.zoom_out(steps)
+        end = tdw.scale
+        tdw.set_zoom(start)
+        self.wait_for_idle()
+        for zoom in list(numpy.linspace(start, end, N)) + [start]:
+            tdw.set_zoom(zoom, ongoing=True)
+            self.wait_for_idle()
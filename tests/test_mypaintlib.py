@@ -1,5 +1,6 @@
 #!/usr/bin/env python
 import numpy
+import math
 from time import time
 import sys
 import os
@@ -126,6 +127,150 @@ def brushPaint():
     s.save_as_png('test_brushPaint.png')
 
 
+def strokeReplay():
+    """Batched stroke replay paints the same as replaying event by event"""
+    from lib.stroke import Stroke
+    from lib.layer.data import PaintingLayer
+
+    bi = brush.BrushInfo(open('brushes/charcoal.myb').read())
+    bi.set_color_rgb((0.0, 0.9, 1.0))
+    b = brush.Brush(bi)
+    events = numpy.loadtxt('painting30sec.dat')
+
+    # Record a few strokes while painting, as Brushwork does
+    s = tiledsurface.Surface()
+    strokes = []
+    stroke = None
+    t_old = events[0][0]
+    for i, (t, x, y, pressure) in enumerate(events):
+        if stroke is None:
+            stroke = Stroke()
+            stroke.start_recording(b)
+        dtime = t - t_old
+        t_old = t
+        s.begin_atomic()
+        b.stroke_to(s.backend, x, y, pressure, 0.0, 0.0, dtime)
+        s.end_atomic()
+        stroke.record_event(dtime, x, y, pressure, 0.0, 0.0)
+        if i % 500 == 499:
+            stroke.stop_recording()
+            strokes.append(stroke)
+            stroke = None
+    if stroke is not None:
+        stroke.stop_recording()
+        strokes.append(stroke)
+
+    # The old replay: a fresh brush, and one stroke_to() per event
+    expected = tiledsurface.Surface()
+    for stroke in strokes:
+        rb = brush.Brush(brush.BrushInfo(stroke.brush_settings))
+        states = numpy.fromstring(stroke.brush_state, dtype='float32')
+        rb.set_states_from_array(states)
+        expected.begin_atomic()
+        for dtime, x, y, pressure, xtilt, ytilt in stroke.get_events():
+            rb.stroke_to(expected.backend, x, y, pressure, xtilt, ytilt,
+                         dtime)
+        expected.end_atomic()
+
+    layer = PaintingLayer()
+    t0 = time()
+    layer.render_strokes(strokes)
+    print 'Batched replay time:', time()-t0
+
+    actual = layer._surface
+    tiles = set(expected.get_tiles()) | set(actual.get_tiles())
+    assert tiles
+    for tx, ty in tiles:
+        with expected.tile_request(tx, ty, readonly=True) as exp_rgba:
+            with actual.tile_request(tx, ty, readonly=True) as act_rgba:
+                assert (exp_rgba == act_rgba).all(), \
+                    "tile %r differs" % ((tx, ty),)
+    print 'Batched replay matches for', len(tiles), 'tiles'
+
+
+def surfacePool():
+    """Pooled render surfaces are reused, and retarget cleanly"""
+    from lib.pixbufsurface import SurfacePool
+    N = mypaintlib.TILE_SIZE
+
+    # Areas like the ones render_prepare() asks for: full redraws of a
+    # 1920x1080 view panned around in a circle, then small redraws as
+    # if from painting along a line.
+    rects = []
+    for i in xrange(64):
+        a = 2 * math.pi * i / 64
+        x = int(300 * math.cos(a)) - 960
+        y = int(300 * math.sin(a)) - 540
+        rects.append((x, y, 1921, 1081))
+    for i in xrange(64):
+        rects.append((i*17 - 40, i*5 - 40, 81, 81))
+
+    pool = SurfacePool()
+    for rect in rects:
+        x, y, w, h = rect
+        surface = pool.get(x, y, w, h)
+        assert (surface.x, surface.y, surface.w, surface.h) == rect
+        assert surface.pixbuf.get_width() == w
+        assert surface.pixbuf.get_height() == h
+        # Tiles cover exactly the area, and are cleared
+        expected = set(
+            (tx, ty)
+            for ty in xrange(y // N, (y+h-1) // N + 1)
+            for tx in xrange(x // N, (x+w-1) // N + 1)
+        )
+        tiles = surface.get_tiles()
+        assert set(tiles) == expected
+        for tx, ty in tiles:
+            with surface.tile_request(tx, ty, readonly=False) as rgba:
+                assert not rgba.any()
+                rgba[...] = 255  # dirty it for the next user
+        # The pixbuf shares memory with the tiles, at the right offset
+        pixels = helpers.gdkpixbuf2numpy(surface.pixbuf)
+        assert pixels.shape[:2] == (h, w)
+        with surface.tile_request(x // N, y // N, readonly=False) as rgba:
+            rgba[y % N, x % N] = (1, 2, 3, 4)
+        assert tuple(pixels[0, 0]) == (1, 2, 3, 4)
+        pool.release(surface)
+
+    size_classes = set(pool._get_size_class(*r) for r in rects)
+    print 'Surface pool: %d allocations for %d requests' \
+        % (pool.allocations, pool.requests)
+    assert pool.requests == len(rects)
+    assert pool.allocations == len(size_classes)
+
+
+def batchRender():
+    """Headless batch rendering writes one file per job, or per tile"""
+    import tempfile
+    import shutil
+    from lib import batchrender
+    outdir = tempfile.mkdtemp(prefix='test_batchrender_')
+    try:
+        jobs = [
+            batchrender.RenderJob(
+                'smallimage.ora', os.path.join(outdir, 'whole.png'),
+            ),
+            batchrender.RenderJob(
+                'smallimage.ora', os.path.join(outdir, 'tiled.jpg'),
+                format='jpeg', frame=(0, 0, 100, 70), tile_size=64,
+            ),
+        ]
+        results = list(batchrender.run_jobs(jobs, nworkers=2))
+        assert len(results) == len(jobs)
+        written = {}
+        for job, files, error in results:
+            assert error is None, error
+            written[job.output] = files
+        assert written[jobs[0].output] == [jobs[0].output]
+        assert len(written[jobs[1].output]) == 4
+        for files in written.values():
+            for filename in files:
+                assert os.path.getsize(filename) > 0
+    finally:
+        shutil.rmtree(outdir)
+    print 'Batch rendering OK'
+
+
 def files_equal(a, b):
     return open(a, 'rb').read() == open(b, 'rb').read()
 
@@ -315,6 +460,9 @@ options, tests = parser.parse_args()
 #layerModes()
 directPaint()
 brushPaint()
+strokeReplay()
+surfacePool()
+batchRender()
 #    docPaint()
 
 #saveFrame()
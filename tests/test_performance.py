@@ -228,6 +228,26 @@ def brushengine_paint_hires():
     #s.save('test_paint_hires.png') # approx. 3000x3000
 
 
+@nogui_test
+def flood_fill_open_area():
+    from lib import tiledsurface
+    # A big empty area with a few strokes in it: most of the fill is
+    # spreading across open tiles.
+    src = tiledsurface.Surface()
+    dst = tiledsurface.Surface()
+    N = tiledsurface.N
+    for i in xrange(16):
+        with src.tile_request(i*5, i*3, readonly=False) as rgba:
+            rgba[::2, ...] = (0, 0, 0, 1<<15)
+    bbox = (0, 0, N*96, N*96)
+    stats = {}
+    yield start_measurement
+    tiledsurface.flood_fill(src, N*48+5, N*48+5, (1.0, 0.5, 0.0), bbox,
+                            0.1, dst, stats=stats)
+    yield stop_measurement
+    print 'fill: %(tiles)d tiles, %(visits)d visits, %(seeds)d seeds' % stats
+
+
 @gui_test
 def scroll_nozoom(gui):
     gui.wait_for_idle()
@@ -291,6 +311,45 @@ def scroll_zoomed_out_5x(gui):
     yield stop_measurement
 
 
+@gui_test
+def scroll_zoomed_out_5x_fractional(gui):
+    gui.wait_for_idle()
+    gui.app.preferences['view.mipmap_mode'] = 'fractional'
+    dw = gui.app.drawWindow
+    dw.fullscreen_cb()
+    gui.app.filehandler.open_file('bigimage.ora')
+    gui.zoom_out(5)
+    gui.wait_for_idle()
+    yield start_measurement
+    gui.scroll()
+    yield stop_measurement
+
+
+@gui_test
+def zoom_smoothly_5x(gui):
+    gui.wait_for_idle()
+    dw = gui.app.drawWindow
+    dw.fullscreen_cb()
+    gui.app.filehandler.open_file('bigimage.ora')
+    gui.wait_for_idle()
+    yield start_measurement
+    gui.zoom_smoothly(5)
+    yield stop_measurement
+
+
+@gui_test
+def zoom_smoothly_5x_fractional(gui):
+    gui.wait_for_idle()
+    gui.app.preferences['view.mipmap_mode'] = 'fractional'
+    dw = gui.app.drawWindow
+    dw.fullscreen_cb()
+    gui.app.filehandler.open_file('bigimage.ora')
+    gui.wait_for_idle()
+    yield start_measurement
+    gui.zoom_smoothly(5)
+    yield stop_measurement
+
+
 @gui_test
 def memory_zoomed_out_5x(gui):
     gui.wait_for_idle()
@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+"""Headless brushwork replay benchmark
+
+Replays recorded stylus input (painting30sec.dat) through
+lib.command.Brushwork on a lib.document.Document, without GTK windows.
+This exercises the same brush-to-canvas path as the freehand mode, so it
+gives repeatable numbers on machines without a display.
+
+Each run can vary the brush, the view zoom and mipmap level used for the
+simulated redraws, the number of layers, and painting symmetry. Results
+are printed, and can be written to a JSON file for comparing releases:
+
+    ./test_replay.py -b charcoal -b watercolor -l 1 -l 20 -o results.json
+
+"""
+
+import sys
+import os
+import json
+import resource
+import multiprocessing
+from time import time
+from optparse import OptionParser
+
+import numpy
+
+os.chdir(os.path.dirname(os.path.abspath(sys.argv[0])))
+sys.path.insert(0, '..')
+
+from lib import mypaintlib, tiledsurface, document, command
+
+N = mypaintlib.TILE_SIZE
+
+# Rate at which the replay simulates canvas redraws, in frames/s
+FPS = 60
+
+
+def load_events(filename='painting30sec.dat'):
+    """Loads recorded events as a list of (t, x, y, pressure)"""
+    return numpy.loadtxt(filename)
+
+
+def make_document(brush_name, nlayers, symmetry):
+    """Makes a document with a brush and some layers to paint over
+
+    :param str brush_name: basename of a brush in ./brushes
+    :param int nlayers: total number of layers
+    :param bool symmetry: whether to paint with symmetry on
+    :returns: the document, and the layer to paint onto
+    """
+    doc = document.Document(painting_only=True)
+    with open(os.path.join('brushes', brush_name + '.myb')) as fp:
+        doc.brush.brushinfo.load_from_string(fp.read())
+    root = doc.layer_stack
+    paint_layer = root.current
+    # Semi-transparent filler layers above and below the painting
+    # layer, so that compositing has real work to do.
+    filler = numpy.zeros((N*8, N*8, 4), 'uint8')
+    filler[...] = (64, 128, 192, 32)
+    for i in xrange(nlayers - 1):
+        surf = tiledsurface.Surface()
+        surf.load_from_numpy(filler, i*N, i*N)
+        insert_path = (0,) if (i % 2) else (len(root),)
+        doc.add_layer(path=insert_path)
+        root.current.load_from_surface(surf)
+    doc.select_layer(layer=paint_layer)
+    if symmetry:
+        root.symmetry_axis = 400.0
+    return doc, paint_layer
+
+
+def replay(doc, events, zoom=1.0, mipmap_level=0):
+    """Replays events through Brushwork, simulating redraws
+
+    :returns: per-event latencies (s), and the set of tiles touched
+
+    The model coordinates are the recorded ones divided by the zoom
+    factor, as with a view zoomed by that much. Every 1/FPS seconds of
+    recorded time, the tiles touched since the last frame are rendered
+    at the given mipmap level, as the display would.
+    """
+    model = doc
+    root = model.layer_stack
+    touched = set()
+    dirty = set()
+
+    def content_changed_cb(root, layer, x, y, w, h):
+        if w <= 0 or h <= 0:
+            return
+        for ty in xrange(int(y // N), int((y + h - 1) // N) + 1):
+            for tx in xrange(int(x // N), int((x + w - 1) // N) + 1):
+                dirty.add((tx, ty))
+
+    root.layer_content_changed += content_changed_cb
+    dst = numpy.empty((N, N, 4), 'uint8')
+    latencies = numpy.empty(len(events), 'float64')
+    cmd = None
+    t_old = events[0][0]
+    t_last_frame = t_old
+    try:
+        for i, (t, x, y, pressure) in enumerate(events):
+            if cmd is None or cmd.split_due:
+                if cmd is not None and cmd.stop_recording():
+                    model.do(cmd)
+                cmd = command.Brushwork(model, root.current_path)
+            dtime = t - t_old
+            t_old = t
+            t0 = time()
+            cmd.stroke_to(dtime, x / zoom, y / zoom, pressure, 0.0, 0.0)
+            latencies[i] = time() - t0
+            if t - t_last_frame >= 1.0 / FPS:
+                t_last_frame = t
+                _render_dirty(root, dirty, dst, mipmap_level)
+                touched.update(dirty)
+                dirty.clear()
+        if cmd is not None and cmd.stop_recording():
+            model.do(cmd)
+        _render_dirty(root, dirty, dst, mipmap_level)
+        touched.update(dirty)
+    finally:
+        root.layer_content_changed -= content_changed_cb
+    return latencies, touched
+
+
+def _render_dirty(root, dirty, dst, mipmap_level):
+    """Renders dirty tiles at a mipmap level, like the display would"""
+    tiles = set((tx >> mipmap_level, ty >> mipmap_level)
+                for (tx, ty) in dirty)
+    for tx, ty in tiles:
+        root.composite_tile(dst, False, tx, ty, mipmap_level)
+
+
+def run_case(events, brush, zoom, mipmap_level, nlayers, symmetry):
+    """Runs a single benchmark case, returning a dict of results"""
+    doc, layer = make_document(brush, nlayers, symmetry)
+    t0 = time()
+    latencies, touched = replay(doc, events, zoom, mipmap_level)
+    elapsed = time() - t0
+    maxrss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    result = {
+        "brush": brush,
+        "zoom": zoom,
+        "mipmap_level": mipmap_level,
+        "layers": nlayers,
+        "symmetry": symmetry,
+        "events": len(events),
+        "seconds": elapsed,
+        "events_per_second": len(events) / elapsed,
+        "latency_ms": dict(
+            (("p%d" % p), float(numpy.percentile(latencies, p)) * 1000)
+            for p in (50, 90, 99)
+        ),
+        "latency_max_ms": float(latencies.max()) * 1000,
+        "tiles_touched": len(touched),
+        "layer_tiles": len(layer.get_tile_coords()),
+        "maxrss_kb": maxrss_kb,
+    }
+    return result
+
+
+def run_case_in_child(*args):
+    """Runs run_case() in a child process of its own
+
+    The peak RSS that getrusage() reports never goes down, so each case
+    needs a fresh process for its "maxrss_kb" to be its own.
+    """
+    pool = multiprocessing.Pool(processes=1)
+    try:
+        return pool.apply(run_case, args)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def main():
+    parser = OptionParser('usage: %prog [options]')
+    parser.add_option('-b', '--brush', action='append', metavar='NAME',
+                      help='brush in ./brushes (repeatable; default: all)')
+    parser.add_option('-z', '--zoom', action='append', type='float',
+                      metavar='Z', help='view zoom factor (default: 1.0)')
+    parser.add_option('-m', '--mipmap', action='append', type='int',
+                      metavar='L', help='redraw mipmap level (default: 0)')
+    parser.add_option('-l', '--layers', action='append', type='int',
+                      metavar='N', help='number of layers (default: 1)')
+    parser.add_option('-s', '--symmetry', action='store_true',
+                      default=False, help='also run with symmetry on')
+    parser.add_option('-o', '--output', metavar='FILE',
+                      help='write results to FILE as JSON')
+    options, args = parser.parse_args()
+
+    brushes = options.brush
+    if not brushes:
+        brushes = sorted(os.path.splitext(f)[0] for f in os.listdir('brushes')
+                         if f.endswith('.myb'))
+    symmetries = [False, True] if options.symmetry else [False]
+
+    events = load_events()
+    results = []
+    for brush in brushes:
+        for zoom in (options.zoom or [1.0]):
+            for mipmap_level in (options.mipmap or [0]):
+                for nlayers in (options.layers or [1]):
+                    for symmetry in symmetries:
+                        res = run_case_in_child(events, brush, zoom,
+                                                mipmap_level, nlayers,
+                                                symmetry)
+                        print ('%(brush)s zoom=%(zoom)g mipmap=%(mipmap_level)d '
+                               'layers=%(layers)d symmetry=%(symmetry)r: '
+                               '%(events_per_second).0f events/s, '
+                               '%(tiles_touched)d tiles' % res),
+                        print 'p50/p90/p99 %(p50).3f/%(p90).3f/%(p99).3fms' \
+                            % res["latency_ms"]
+                        results.append(res)
+
+    if options.output:
+        info = {
+            "argv": sys.argv[1:],
+            "results": results,
+        }
+        with open(options.output, 'w') as fp:
+            json.dump(info, fp, indent=2, sort_keys=True)
+        print 'Results written to', options.output
+
+
+if __name__ == '__main__':
+    main()